@@ -1,45 +1,566 @@
 #!/usr/bin/python
-import sys
+import argparse
 import subprocess
 
 
-head = lambda arry: (arry[0], arry[1:])
-cmdline = list(sys.argv)
+def _serve(args, handler):
+    import io
+    import os
+    import sys
+    from btrfsbackup.common import Watchdog
+    if args.daemon:
+        from btrfsbackup import daemon
+        daemon.serve(daemon.listen(args.daemon), handler, args.timeout)
+        return
+    instream = io.open(sys.stdin.fileno(), 'rb')
+    outstream = sys.stdout
+    if args.timeout:
+        def _expire():
+            print >> sys.stderr, "Client stalled for %d seconds" % (
+                args.timeout)
+            # a partial upload is kept for the client to resume
+            os._exit(1)
+        watchdog = Watchdog(args.timeout, _expire)
+        instream = watchdog.reader(instream)
+        outstream = watchdog.writer(outstream)
+    handler(instream, outstream)
 
-if len(cmdline) < 2:
-    raise Exception("Invalid invocation")
+
+def _driver_factory(args):
+    from functools import partial
+    from btrfsbackup.chunkstore import ChunkStore
+    from btrfsbackup.objectstore import open_store
+    from btrfsbackup.server import (
+        CachedChunkStorageDriver, CachedStorageDriver, ChunkStorageDriver,
+        ObjectStorageDriver, StandardStorageDriver
+    )
+    if args.object_store:
+        def _object_driver(pool_root):
+            return ObjectStorageDriver(
+                open_store(pool_root, args.s3_endpoint),
+                compression=args.store_compressed
+            )
+        return _object_driver
+    if args.chunk_store:
+        return partial(
+            CachedChunkStorageDriver if args.daemon else ChunkStorageDriver,
+            store=ChunkStore(args.chunk_store)
+        )
+    if args.daemon:
+        return partial(
+            CachedStorageDriver,
+            compression=args.store_compressed,
+            index_pieces=args.scrub_index
+        )
+    return partial(
+        StandardStorageDriver,
+        compression=args.store_compressed,
+        index_pieces=args.scrub_index
+    )
 
 
-def _server(backup_root):
-    from btrfsbackup.server import server_io, StandardStorageDriver
-    server_io(
-        StandardStorageDriver(backup_root),
-        sys.stdin,
-        sys.stdout
+def _scheduler(args):
+    import os
+    import tempfile
+    from btrfsbackup.throttle import UploadScheduler, parse_rate
+    if not args.max_uploads:
+        return None
+    slot_dir = args.slot_dir or os.path.join(
+        tempfile.gettempdir(),
+        'btrfs-backup-slots'
     )
+    disk_rate = parse_rate(args.disk_rate) if args.disk_rate else None
+    return UploadScheduler(slot_dir, args.max_uploads, disk_rate)
 
 
-def _client(subvolume_path, local_repo, *args):
-    from btrfsbackup.client import client_io, StandardStorageDriver
-    from btrfsbackup.graphanalyze import MonthWeekDayHourTree
-    subproc = subprocess.Popen(
-        args,
+def _reporter(args):
+    from btrfsbackup.metrics import Reporter
+    if not (args.metrics_json or args.metrics_textfile or
+            args.metrics_statsd):
+        return None
+    return Reporter(
+        args.metrics_json,
+        args.metrics_textfile,
+        args.metrics_statsd
+    )
+
+
+def _server(args):
+    from btrfsbackup.metrics import Metrics
+    from btrfsbackup.server import server_io
+    driver = _driver_factory(args)(args.server)
+    scheduler = _scheduler(args)
+    reporter = _reporter(args)
+
+    def handler(instream, outstream):
+        if reporter is None:
+            return server_io(driver, instream, outstream, scheduler)
+        metrics = Metrics(role='server', pool=args.server)
+        try:
+            server_io(driver, instream, outstream, scheduler, metrics)
+        finally:
+            reporter.report(metrics)
+    _serve(args, handler)
+
+
+def _server_mux(args):
+    import threading
+    from functools import partial
+    from btrfsbackup.server import mux_server_io, resolve_pool
+    driver_factory = _driver_factory(args)
+    drivers = {}
+    lock = threading.Lock()
+
+    def driver_for_pool(pool_name):
+        pool_root = resolve_pool(args.server_mux, pool_name)
+        with lock:
+            if pool_root not in drivers:
+                drivers[pool_root] = driver_factory(pool_root)
+            return drivers[pool_root]
+    _serve(args, partial(
+        mux_server_io,
+        driver_for_pool,
+        scheduler=_scheduler(args),
+        reporter=_reporter(args)
+    ))
+
+
+def _scrub(args):
+    from btrfsbackup.scrub import damage, scrub
+    from btrfsbackup.throttle import TokenBucket, parse_rate
+    if args.object_store:
+        parser.error('--scrub cannot check pools kept in an object store')
+    driver = _driver_factory(args)(args.scrub)
+    bucket = None
+    if args.scrub_rate:
+        bucket = TokenBucket(parse_rate(args.scrub_rate))
+    counts = {'ok': 0, 'indexed': 0, 'damaged': 0}
+    damaged = []
+    for result in scrub(driver, args.jobs, bucket):
+        counts[result.status] += 1
+        if result.status == 'damaged':
+            damaged.append((result.from_node, result.to_node))
+            print "DAMAGED %s -> %s: %s" % (
+                result.from_node, result.to_node, result.detail)
+    print "%d edges: %d ok, %d indexed for the first time, %d damaged" % (
+        sum(counts.values()), counts['ok'], counts['indexed'],
+        counts['damaged'])
+    if not damaged:
+        return
+    affected, lost = damage(driver.get_edges(), damaged)
+    for from_, to_ in sorted(damaged):
+        print "%s -> %s is on the restore chains of: %s" % (
+            from_, to_, ' '.join(sorted(affected[(from_, to_)])))
+    if lost:
+        print "No longer restorable: %s" % ' '.join(sorted(lost))
+    raise SystemExit(1)
+
+
+def _prune(args):
+    import os
+    from btrfsbackup.graphanalyze import RetentionPolicy, graph_of
+    from btrfsbackup.server import ChunkStorageDriver
+    if not args.keep:
+        parser.error('--prune needs --keep')
+    try:
+        policy = RetentionPolicy.parse(args.keep)
+    except ValueError as e:
+        parser.error(str(e))
+    # a chunk store may be shared with other pools, so dropping manifests
+    # frees nothing and sweeping the chunks one pool no longer lists is
+    # not safe
+    if args.chunk_store or (not args.object_store and any(
+            filename.endswith(ChunkStorageDriver.manifest_suffix)
+            for filename in os.listdir(args.prune))):
+        parser.error('--prune cannot prune pools kept in a chunk store')
+    driver = _driver_factory(args)(args.prune)
+    keep, prunable = policy.prune(graph_of(driver.get_edges()))
+    reclaimed = sum(
+        driver.stored_size(from_, to_) for from_, to_ in prunable
+    )
+    for from_, to_ in sorted(prunable):
+        print "%s %s -> %s" % (
+            'would remove' if args.dry_run else 'removing', from_, to_)
+    if not args.dry_run:
+        driver.delete_edges(prunable)
+    print "%s %d edges, %d bytes; keeping %d snapshots" % (
+        'Would remove' if args.dry_run else 'Removed', len(prunable),
+        reclaimed, len(keep))
+
+
+def _graph_options(args, local_repo):
+    import os
+    graph_cache = None
+    if args.graph_cache:
+        graph_cache = os.path.join(local_repo, '.btrfs-backup-graph')
+    return dict(graph_cache=graph_cache, local_graph=args.local_graph)
+
+
+def _rate_limit(args):
+    from btrfsbackup.throttle import RateSchedule, ScheduledBucket
+    if not args.rate_limit:
+        return None
+    return ScheduledBucket(RateSchedule(args.rate_limit))
+
+
+def _encryption(args):
+    if not args.encrypt_key:
+        return None
+    from btrfsbackup.encryption import StreamKey, read_key
+    return StreamKey(read_key(args.encrypt_key), args.cipher)
+
+
+def _policy(args, storage_driver):
+    from functools import partial
+    from btrfsbackup.graphanalyze import CostAwarePolicy, MonthWeekDayHourTree
+    if args.policy == 'cost':
+        return partial(
+            CostAwarePolicy,
+            estimator=storage_driver.estimate_delta
+        )
+    return MonthWeekDayHourTree
+
+
+def _connect(command, timeout=None):
+    from btrfsbackup.common import WatchedProcess
+    process = subprocess.Popen(
+        command,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
     )
+    if timeout:
+        return WatchedProcess(process, timeout)
+    return process
+
 
+def _client(args):
+    from btrfsbackup.client import client_io, StandardStorageDriver
+    from btrfsbackup.metrics import Metrics, disabled
     storage_driver = StandardStorageDriver(
-        subvolume,
-        local_repo
+        args.subvolume,
+        args.local_repo
+    )
+    reporter = _reporter(args)
+    metrics = disabled
+    if reporter is not None:
+        metrics = Metrics(role='client', subvolume=args.subvolume)
+    try:
+        if args.upload_spool:
+            _spool_client(args, storage_driver, metrics)
+        elif args.replica:
+            _replicate_client(args, storage_driver, metrics)
+        else:
+            client_io(
+                storage_driver,
+                _policy(args, storage_driver),
+                _connect(args.command, args.timeout),
+                compression=args.compress,
+                hash_mode=args.hash,
+                dedup=args.dedup,
+                rate_limit=_rate_limit(args),
+                encryption=_encryption(args),
+                metrics=metrics,
+                **_graph_options(args, args.local_repo)
+            )
+    finally:
+        if reporter is not None:
+            reporter.report(metrics)
+    storage_driver.wait_deletions()
+
+
+def _spool_client(args, storage_driver, metrics):
+    import sys
+    from functools import partial
+    from btrfsbackup.client import spool_client_io
+    from btrfsbackup.spool import Spool
+    from btrfsbackup.throttle import parse_rate
+    budget = None
+    if args.spool_budget:
+        budget = parse_rate(args.spool_budget)
+    remaining = spool_client_io(
+        storage_driver,
+        _policy(args, storage_driver),
+        Spool(args.upload_spool, budget),
+        partial(_connect, args.command, args.timeout),
+        compression=args.compress,
+        hash_mode=args.hash,
+        rate_limit=_rate_limit(args),
+        encryption=_encryption(args),
+        metrics=metrics
+    )
+    if remaining:
+        print >> sys.stderr, "%d edges left in %s" % (
+            remaining, args.upload_spool)
+
+
+def _replicate_client(args, storage_driver, metrics):
+    import shlex
+    from btrfsbackup.client import replicate_client_io
+    commands = [args.command] + [shlex.split(arg) for arg in args.replica]
+    errors = replicate_client_io(
+        storage_driver,
+        _policy(args, storage_driver),
+        [_connect(command, args.timeout) for command in commands],
+        compression=args.compress,
+        hash_mode=args.hash,
+        local_graph=args.local_graph,
+        rate_limit=_rate_limit(args),
+        encryption=_encryption(args),
+        spool_dir=args.spool_dir,
+        metrics=metrics
+    )
+    failed = [
+        ' '.join(command)
+        for command, error in zip(commands, errors) if error is not None
+    ]
+    if failed:
+        raise SystemExit("Failed: %s" % '; '.join(failed))
+
+
+def _restore(args, local_repo, command):
+    from btrfsbackup.client import restore_io, StandardStorageDriver
+    restore_io(
+        StandardStorageDriver(None, local_repo),
+        _connect(command, args.timeout),
+        args.restore,
+        compression=args.compress,
+        hash_mode=args.hash,
+        spool_dir=args.spool_dir,
+        encryption=_encryption(args)
     )
-    client_io(storage_driver, MonthWeekDayHourTree, subproc)
 
 
-_, cmdline = head(cmdline)
-if cmdline[0] == "--server":
-    _server(cmdline[1])
+def _batch(args, command):
+    from btrfsbackup.client import (
+        batch_client_io, read_manifest, StandardStorageDriver
+    )
+    from btrfsbackup.graphanalyze import MonthWeekDayHourTree
+    from btrfsbackup.metrics import Metrics
+    with open(args.batch) as fh:
+        manifest = read_manifest(fh)
+    subproc = _connect(command, args.timeout)
+    reporter = _reporter(args)
+    jobs = []
+    for subvolume, local_repo, pool in manifest:
+        storage_driver = StandardStorageDriver(subvolume, local_repo)
+        options = _graph_options(args, local_repo)
+        options['selection_constructor'] = _policy(args, storage_driver)
+        if reporter is not None:
+            options['metrics'] = Metrics(role='client', pool=pool)
+        jobs.append((storage_driver, pool, options))
+    results = batch_client_io(
+        jobs,
+        MonthWeekDayHourTree,
+        subproc,
+        concurrency=args.jobs,
+        compression=args.compress,
+        hash_mode=args.hash,
+        dedup=args.dedup,
+        rate_limit=_rate_limit(args),
+        encryption=_encryption(args)
+    )
+    if reporter is not None:
+        for _, _, options in jobs:
+            reporter.report(options['metrics'])
+    for storage_driver, _, _ in jobs:
+        storage_driver.wait_deletions()
+    failed = [pool for pool, error in results if error is not None]
+    if failed:
+        raise SystemExit("Failed: %s" % ' '.join(failed))
+
+
+parser = argparse.ArgumentParser(prog='btrfs-backup')
+parser.add_argument(
+    '--server', metavar='POOL_ROOT',
+    help='serve the pool at POOL_ROOT over stdin/stdout')
+parser.add_argument(
+    '--server-mux', metavar='POOL_BASE',
+    help='serve a batch client over stdin/stdout; its pools are '
+         'directories below POOL_BASE')
+parser.add_argument(
+    '--chunk-store', metavar='DIR',
+    help='(server) keep edges as chunk lists, storing each distinct chunk '
+         'once in the chunk store at DIR; pools may share a chunk store')
+parser.add_argument(
+    '--object-store', action='store_true',
+    help='(server) keep edges as objects: POOL_ROOT (or the pools below '
+         'POOL_BASE) is s3://BUCKET/PREFIX, or a directory standing in '
+         'for an object store; needs boto3 for S3')
+parser.add_argument(
+    '--s3-endpoint', metavar='URL',
+    help='(object store) talk to the S3 compatible service at URL '
+         'instead of AWS')
+parser.add_argument(
+    '--scrub-index', action='store_true',
+    help='(server) keep the sha256 of every piece of an edge received '
+         'next to it, for --scrub')
+parser.add_argument(
+    '--scrub', metavar='POOL_ROOT',
+    help='read back every edge of the pool at POOL_ROOT, verify it and '
+         'report the damaged ones and the snapshots they affect')
+parser.add_argument(
+    '--scrub-rate', metavar='RATE',
+    help='(scrub) read at most RATE bytes per second (K, M and G '
+         'suffixes allowed) in all')
+parser.add_argument(
+    '--prune', metavar='POOL_ROOT',
+    help='delete the edges of the pool at POOL_ROOT that no snapshot kept '
+         'by --keep needs')
+parser.add_argument(
+    '--keep', metavar='POLICY',
+    help="(prune, required) the snapshots to keep: comma separated "
+         "`PERIOD=N', where PERIOD is last, hourly, daily, weekly, monthly "
+         "or yearly, e.g. last=3,daily=7,weekly=4,monthly=12")
+parser.add_argument(
+    '--dry-run', action='store_true',
+    help='(prune) only report what would be deleted')
+parser.add_argument(
+    '--daemon', metavar='ADDRESS',
+    help='(server) keep running and accept clients on ADDRESS, a Unix '
+         'socket path or HOST:PORT, instead of serving stdin/stdout')
+parser.add_argument(
+    '--timeout', metavar='SECONDS', type=float,
+    help='give up on a session once reading from or writing to the other '
+         'end has got nowhere for SECONDS')
+parser.add_argument(
+    '--max-uploads', metavar='N', type=int,
+    help='(server) receive at most N uploads at once, counting those of '
+         'every server sharing the slot directory; others wait their turn')
+parser.add_argument(
+    '--disk-rate', metavar='RATE',
+    help='(server) write uploads at RATE bytes per second (K, M and G '
+         'suffixes allowed) in all, split evenly between the uploads '
+         'received at once; needs --max-uploads')
+parser.add_argument(
+    '--slot-dir', metavar='DIR',
+    help='(server) where --max-uploads keeps its lock files, by default '
+         'btrfs-backup-slots in the temporary directory')
+parser.add_argument(
+    '--batch', metavar='MANIFEST',
+    help="back up every `SUBVOLUME SNAPSHOT_DIR POOL' line of MANIFEST "
+         "over one connection to `btrfs-backup --server-mux'")
+parser.add_argument(
+    '--restore', metavar='NODE',
+    help="receive snapshot NODE and the snapshots it needs into "
+         "SNAPSHOT_DIR (`--restore NODE SNAPSHOT_DIR COMMAND...')")
+parser.add_argument(
+    '--spool-dir', metavar='DIR',
+    help='(restore) where to keep an edge fetched while the one before it '
+         'is still going through btrfs receive; '
+         '(replicas) where to keep the stream for a server that falls '
+         'behind')
+parser.add_argument(
+    '--replica', metavar='COMMAND', action='append',
+    help='also send the same stream to the server COMMAND (a shell-quoted '
+         'string) starts; may be given more than once')
+parser.add_argument(
+    '--upload-spool', metavar='DIR',
+    help='send into DIR at disk speed, then upload everything in DIR, '
+         'oldest first; what cannot be uploaded waits for the next run')
+parser.add_argument(
+    '--spool-budget', metavar='SIZE',
+    help='(upload spool) keep at most SIZE bytes (K, M and G suffixes '
+         'allowed) in the upload spool')
+parser.add_argument(
+    '--jobs', metavar='N', type=int, default=4,
+    help='(batch) number of subvolumes sent at once; (scrub) number of '
+         'edges read at once')
+parser.add_argument(
+    '--compress', metavar='CODEC',
+    help="compress pieces on the wire with CODEC, or 'auto' to use "
+         "the server's preferred codec")
+parser.add_argument(
+    '--hash', metavar='MODE',
+    help="hash pieces with MODE (sha256-chain, sha256, blake2b or xxh64) "
+         "if the server supports it; per-piece modes verify in parallel")
+parser.add_argument(
+    '--dedup', action='store_true',
+    help='chunk the stream and only send the chunks a chunk store server '
+         'does not have yet')
+parser.add_argument(
+    '--encrypt-key', metavar='FILE',
+    help='encrypt streams on the client, and decrypt restored ones, with '
+         'the key in FILE (32 bytes, or 64 hex digits); needs the '
+         'cryptography package')
+parser.add_argument(
+    '--cipher', choices=['aes-gcm', 'chacha20-poly1305'], default='aes-gcm',
+    help='(encryption) the cipher new streams are sealed with')
+parser.add_argument(
+    '--rate-limit', metavar='SCHEDULE',
+    help="send at most RATE bytes per second (K, M and G suffixes "
+         "allowed), in all for a batch; SCHEDULE is a RATE or comma "
+         "separated `HH:MM-HH:MM=RATE' ranges of the day, "
+         "e.g. 08:00-18:00=2M,18:00-08:00=50M")
+parser.add_argument(
+    '--metrics-json', metavar='FILE',
+    help='append the time each stage of a session took and the bytes it '
+         'moved to FILE as a line of JSON, or to stderr for -')
+parser.add_argument(
+    '--metrics-textfile', metavar='FILE',
+    help='keep the totals of those metrics in FILE for the Prometheus '
+         'node exporter textfile collector')
+parser.add_argument(
+    '--metrics-statsd', metavar='HOST:PORT',
+    help='send those metrics to the StatsD daemon at HOST:PORT')
+parser.add_argument(
+    '--policy', choices=['calendar', 'cost'], default='calendar',
+    help="how to pick the parent of a new snapshot: by month, week, day "
+         "and hour (`calendar'), or by the bytes it will take to send and "
+         "to restore it (`cost')")
+parser.add_argument(
+    '--graph-cache', action='store_true',
+    help='keep the backup graph in the snapshot directory and only fetch '
+         'what changed since the last run')
+parser.add_argument(
+    '--local-graph', action='store_true',
+    help='only fetch the part of the backup graph the local snapshots need')
+parser.add_argument(
+    '--store-compressed', metavar='CODEC',
+    help='(server) keep received edges compressed with CODEC')
+parser.add_argument('subvolume', nargs='?')
+parser.add_argument('local_repo', nargs='?')
+parser.add_argument('command', nargs=argparse.REMAINDER)
+
+args = parser.parse_args()
+if args.chunk_store and args.store_compressed:
+    parser.error("--chunk-store and --store-compressed do not go together")
+if args.object_store and (args.chunk_store or args.scrub_index):
+    parser.error("--object-store goes with neither --chunk-store nor "
+                 "--scrub-index")
+if args.disk_rate and not args.max_uploads:
+    parser.error("--disk-rate needs --max-uploads")
+if args.upload_spool and (args.batch or args.dedup):
+    parser.error("--upload-spool goes with neither --batch nor --dedup")
+if args.replica and (args.batch or args.upload_spool or args.dedup or
+                     args.graph_cache):
+    parser.error("--replica goes with none of --batch, --upload-spool, "
+                 "--dedup and --graph-cache")
+if args.encrypt_key and args.dedup:
+    parser.error("--encrypt-key and --dedup do not go together")
+if args.encrypt_key and not args.hash:
+    # the server cannot look into the stream; let it verify in parallel
+    args.hash = 'sha256'
+if args.server:
+    _server(args)
+elif args.scrub:
+    _scrub(args)
+elif args.prune:
+    _prune(args)
+elif args.server_mux:
+    _server_mux(args)
+elif args.batch or args.restore:
+    # batch mode has no positional paths and restore only SNAPSHOT_DIR;
+    # the rest is all the command
+    command = [
+        arg for arg in (args.subvolume, args.local_repo) if arg is not None
+    ] + args.command
+    if args.batch and command:
+        _batch(args, command)
+    elif args.restore and len(command) > 1:
+        _restore(args, command[0], command[1:])
+    else:
+        parser.error("Invalid invocation")
+elif args.subvolume and args.local_repo and args.command:
+    _client(args)
 else:
-    args = cmdline
-    subvolume, args = head(args)
-    local_repo, args = head(args)
-    _client(subvolume, local_repo, *args)
+    parser.error("Invalid invocation")
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+"""
+A stand-in for the btrfs commands btrfs-backup runs, for benchmarks;
+pipeline_bench.py puts it on the PATH as `btrfs'.
+
+Snapshots are plain directories.  `btrfs send' writes BENCH_SEND_SIZE
+bytes (default 256MB) of which a BENCH_SEND_ENTROPY fraction (default 0.5)
+is random and the rest zeros, so codecs have about that much to work
+with.  `btrfs receive' reads its input and throws it away.
+"""
+import os
+import sys
+import random
+
+block_size = 64 * 1024
+
+
+def _send(target):
+    size = int(os.environ.get('BENCH_SEND_SIZE', 256 * 1024 ** 2))
+    entropy = float(os.environ.get('BENCH_SEND_ENTROPY', 0.5))
+    rng = random.Random(os.path.basename(target))
+    random_size = int(block_size * entropy)
+    # enough distinct blocks that no window or chunk store sees repeats
+    pool = [
+        ''.join(chr(rng.getrandbits(8)) for _ in xrange(random_size)) +
+        '\0' * (block_size - random_size)
+        for _ in xrange(16)
+    ]
+    out = os.fdopen(sys.stdout.fileno(), 'wb', 0)
+    sent = 0
+    index = 0
+    while sent < size:
+        block = pool[index % len(pool)]
+        # rotate it, so blocks repeat only after len(pool) ** 2 of them
+        shift = (index // len(pool)) % len(pool) * 4099 % block_size
+        block = block[shift:] + block[:shift]
+        block = block[:size - sent]
+        out.write(block)
+        sent += len(block)
+        index += 1
+
+
+def main(args):
+    if args[:3] == ['subvolume', 'snapshot', '-r']:
+        os.mkdir(args[4])
+    elif args[:2] == ['subvolume', 'delete']:
+        for path in args[2:]:
+            if not path.startswith('-'):
+                os.rmdir(path)
+    elif args[:2] == ['subvolume', 'find-new']:
+        print 'transid marker was 1'
+    elif args[0] == 'send':
+        _send(args[-1])
+    elif args[0] == 'receive':
+        while sys.stdin.read(block_size):
+            pass
+    else:
+        sys.exit("unsupported: %s" % ' '.join(args))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""
+Times the graphanalyze algorithms on synthetic backup graphs.
+
+    python bench/graphanalyze_bench.py [EDGES]
+
+Two graphs of about EDGES edges (default 200000) are built: the tree
+MonthWeekDayHourTree grows from hourly backups, and a layered DAG where
+every node has several parents, which has far more paths than edges.
+"""
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from btrfsbackup import wire_pb2
+from btrfsbackup.graphanalyze import DirectedGraph, MonthWeekDayHourTree
+
+
+def backup_tree(edge_count):
+    """Hourly backups under daily, weekly and monthly parents."""
+    graph = wire_pb2.Graph()
+    start = datetime(2000, 1, 1)
+    parents = {}
+    nodes = []
+    for hour in xrange(edge_count):
+        when = start + timedelta(hours=hour)
+        name = when.isoformat() + '.000000'
+        keys = [
+            (when.year, when.month),
+            (when.year, when.month, when.isocalendar()[1]),
+            (when.year, when.month, when.isocalendar()[1], when.day),
+        ]
+        parent = 'FULL'
+        for key in keys:
+            if key not in parents:
+                parents[key] = name
+                break
+            parent = parents[key]
+        edge = graph.edges.add()
+        edge.from_node = parent
+        edge.to_node = name
+        nodes.append(name)
+    return graph, nodes
+
+
+def layered_dag(edge_count, width=64, fan_in=4):
+    """Layers of `width' nodes with `fan_in' parents in the layer above."""
+    graph = wire_pb2.Graph()
+    previous = ['FULL']
+    nodes = []
+    layer = 0
+    while len(graph.edges) < edge_count:
+        current = ['l%d-%d' % (layer, i) for i in xrange(width)]
+        for name in current:
+            for parent in random.sample(previous, min(fan_in, len(previous))):
+                edge = graph.edges.add()
+                edge.from_node = parent
+                edge.to_node = name
+        nodes.extend(current)
+        previous = current
+        layer += 1
+    return graph, nodes
+
+
+def timed(label, func, *args):
+    started = time.time()
+    result = func(*args)
+    print '  %-34s %8.3fs' % (label, time.time() - started)
+    return result
+
+
+def main():
+    edge_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random.seed(0)
+    for name, build in [('backup tree', backup_tree),
+                        ('layered dag', layered_dag)]:
+        graph, nodes = build(edge_count)
+        print '%s: %d edges, %d nodes' % (name, len(graph.edges), len(nodes))
+        directed = timed('build', DirectedGraph, graph)
+        timed('node_heights', directed.node_heights)
+        timed('height', directed.height)
+        deepest = nodes[-1]
+        timed('min_path to FULL (bfs)', directed.min_path, deepest, 'FULL')
+        sizes = {}
+
+        def weight(from_node, to_node):
+            if (from_node, to_node) not in sizes:
+                sizes[from_node, to_node] = random.randint(1, 1 << 30)
+            return sizes[from_node, to_node]
+        timed(
+            'min_path to FULL (dijkstra)',
+            directed.min_path, deepest, 'FULL', weight
+        )
+        if build is backup_tree:
+            local_nodes = nodes[-24 * 40:]
+            tree = timed(
+                'MonthWeekDayHourTree',
+                MonthWeekDayHourTree, graph, local_nodes
+            )
+            timed('best_parent', tree.best_parent)
+
+
+if __name__ == '__main__':
+    main()
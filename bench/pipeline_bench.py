@@ -0,0 +1,258 @@
+#!/usr/bin/python
+"""
+Times whole backup sessions, client_io against server_io, without btrfs
+or a remote host.
+
+    python bench/pipeline_bench.py [--size MB] [--entropy E]
+                                   [--scenario NAME]... [--no-record]
+
+fake_btrfs.py stands in for btrfs and the two ends talk over a pair of
+socketpairs (or pipes) within one process.  Every scenario runs in a
+process of its own and reports MB/s, CPU seconds per GB sent, peak RSS
+and handshake latency: how long fetching and parsing the graph took, which
+the `handshake' scenario measures against a pool of three years of hourly
+backups.  Results are appended to bench/results.jsonl along with the
+commit they were measured at, and compared with the last results of
+another commit.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import resource
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from btrfsbackup import client, server
+from btrfsbackup.graphanalyze import MonthWeekDayHourTree
+from btrfsbackup.metrics import Metrics
+from graphanalyze_bench import backup_tree
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+default_results = os.path.join(bench_dir, 'results.jsonl')
+
+SCENARIOS = [
+    {'name': 'raw'},
+    {'name': 'raw-pipe', 'transport': 'pipe'},
+    {'name': 'sha256', 'hash_mode': 'sha256'},
+    {'name': 'zlib', 'compression': 'zlib'},
+    {'name': 'zlib-sha256', 'compression': 'zlib', 'hash_mode': 'sha256'},
+    {'name': 'handshake', 'edges': 3 * 365 * 24, 'size': 1},
+]
+
+
+def _channel(transport):
+    """(read_fd, write_fd) of a one way channel."""
+    if transport == 'pipe':
+        return os.pipe()
+    ends = socket.socketpair()
+    fds = [os.dup(end.fileno()) for end in ends]
+    for end in ends:
+        end.close()
+    return fds[0], fds[1]
+
+
+class _Transport(object):
+    """What client_io takes for a subprocess, with `handler' on a thread."""
+    def __init__(self, handler, transport):
+        up_read, up_write = _channel(transport)
+        down_read, down_write = _channel(transport)
+        self.stdin = os.fdopen(up_write, 'wb', 0)
+        self.stdout = io.open(down_read, 'rb')
+        self._error = None
+
+        def _run():
+            instream = io.open(up_read, 'rb')
+            outstream = io.open(down_write, 'wb')
+            try:
+                handler(instream, outstream)
+            except Exception as e:
+                self._error = e
+            finally:
+                outstream.close()
+                instream.close()
+        self._thread = threading.Thread(target=_run)
+        self._thread.start()
+
+    def wait(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return 0
+
+
+def _fake_btrfs(directory):
+    path = os.path.join(directory, 'btrfs')
+    with open(path, 'w') as fh:
+        fh.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+            sys.executable, os.path.join(bench_dir, 'fake_btrfs.py')))
+    os.chmod(path, 0755)
+
+
+def _synthetic_pool(pool, edge_count):
+    graph, _ = backup_tree(edge_count)
+    for edge in graph.edges:
+        name = '%s__%s.btrfs' % (edge.from_node, edge.to_node)
+        open(os.path.join(pool, name), 'w').close()
+
+
+def _cpu_seconds():
+    # both ends, but not the stand-in btrfs
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_scenario(scenario):
+    """Runs one session of `scenario'; returns what it measured."""
+    size = scenario['size'] * 1024 ** 2
+    root = tempfile.mkdtemp(prefix='btrfs-backup-bench-')
+    try:
+        paths = dict(
+            (name, os.path.join(root, name))
+            for name in ('bin', 'subvol', 'snaps', 'pool')
+        )
+        for path in paths.values():
+            os.mkdir(path)
+        _fake_btrfs(paths['bin'])
+        os.environ['PATH'] = paths['bin'] + os.pathsep + os.environ['PATH']
+        os.environ['BENCH_SEND_SIZE'] = str(size)
+        os.environ['BENCH_SEND_ENTROPY'] = str(scenario['entropy'])
+        if scenario.get('edges'):
+            _synthetic_pool(paths['pool'], scenario['edges'])
+
+        metrics = Metrics(role='client')
+        driver = server.StandardStorageDriver(paths['pool'])
+        transport = _Transport(
+            lambda instream, outstream: server.server_io(
+                driver, instream, outstream
+            ),
+            scenario.get('transport', 'socketpair')
+        )
+        cpu = _cpu_seconds()
+        started = time.time()
+        client.client_io(
+            client.StandardStorageDriver(paths['subvol'], paths['snaps']),
+            MonthWeekDayHourTree,
+            transport,
+            compression=scenario.get('compression'),
+            hash_mode=scenario.get('hash_mode'),
+            metrics=metrics
+        )
+        wall = time.time() - started
+        cpu = _cpu_seconds() - cpu
+    finally:
+        shutil.rmtree(root)
+    stages = metrics.summary()['stages']
+    handshake = sum(
+        stages.get(stage, {}).get('seconds', 0)
+        for stage in ('graph_fetch', 'graph_parse')
+    )
+    return {
+        'mb_per_s': size / wall / 1024 ** 2,
+        'cpu_per_gb': cpu / size * 1024 ** 3,
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'handshake_ms': handshake * 1000,
+    }
+
+
+def _commit():
+    def _git(*args):
+        return subprocess.Popen(
+            ['git'] + list(args),
+            cwd=bench_dir,
+            stdout=subprocess.PIPE
+        ).communicate()[0].strip()
+    commit = _git('rev-parse', '--short', 'HEAD') or 'unknown'
+    if _git('status', '--porcelain', '--untracked-files=no'):
+        commit += '+'
+    return commit
+
+
+def _previous(results_path, scenario, commit):
+    """The last result of `scenario' recorded at a commit but `commit'."""
+    previous = None
+    if not os.path.exists(results_path):
+        return None
+    with open(results_path) as fh:
+        for line in fh:
+            record = json.loads(line)
+            if (record['scenario'] == scenario and
+                    record['commit'] != commit):
+                previous = record
+    return previous
+
+
+def _change(value, record, key):
+    if record is None or not record['result'].get(key):
+        return ''
+    return '%+.0f%%' % ((value / record['result'][key] - 1) * 100)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='pipeline_bench.py')
+    parser.add_argument('--size', type=int, default=256,
+                        help='MB each session sends')
+    parser.add_argument('--entropy', type=float, default=0.5,
+                        help='fraction of the stream that is random')
+    parser.add_argument('--scenario', action='append',
+                        choices=[scenario['name'] for scenario in SCENARIOS])
+    parser.add_argument('--results', default=default_results)
+    parser.add_argument('--no-record', action='store_true')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        json.dump(run_scenario(json.loads(args.run)), sys.stdout)
+        return
+
+    commit = _commit()
+    print '%-12s %9s %11s %9s %13s   (change since %s)' % (
+        'scenario', 'MB/s', 'CPU s/GB', 'RSS MB', 'handshake ms',
+        'the last other commit')
+    for scenario in SCENARIOS:
+        if args.scenario and scenario['name'] not in args.scenario:
+            continue
+        scenario = dict(scenario)
+        scenario.setdefault('size', args.size)
+        scenario.setdefault('entropy', args.entropy)
+        output = subprocess.Popen(
+            [sys.executable, __file__, '--run', json.dumps(scenario)],
+            stdout=subprocess.PIPE
+        ).communicate()[0]
+        result = json.loads(output)
+        previous = _previous(args.results, scenario['name'], commit)
+        print '%-12s %9.1f %11.2f %9.1f %13.1f   %s' % (
+            scenario['name'],
+            result['mb_per_s'],
+            result['cpu_per_gb'],
+            result['peak_rss_mb'],
+            result['handshake_ms'],
+            ' '.join(
+                '%s %s' % (key, _change(result[key], previous, key))
+                for key in ('mb_per_s', 'cpu_per_gb', 'peak_rss_mb',
+                            'handshake_ms')
+            ) if previous is not None else '',
+        )
+        sys.stdout.flush()
+        if not args.no_record:
+            with open(args.results, 'a') as fh:
+                fh.write(json.dumps({
+                    'commit': commit,
+                    'time': time.time(),
+                    'scenario': scenario['name'],
+                    'settings': scenario,
+                    'result': result,
+                }, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,487 @@
+#!/usr/bin/python
+"""
+Content-defined chunking and a store that keeps every chunk once.
+
+Streams are cut after an anchor: four bytes in a row from a fixed set of
+16 byte values, which random data contains once every 64KB on average.
+Where a cut falls depends only on the bytes around it, so data shifted by
+an insertion upstream is still cut into the same chunks.  Chunks are at
+least `min_chunk' and at most `max_chunk' bytes; runs without an anchor
+(zeros, for one) are cut at `max_chunk'.  Anchors are found with the re
+module, which keeps chunking at C speed.
+
+Store layout, below its root:
+    packs/NNNNNNNN.pack     chunks back to back; each writing session
+                            appends to packs of its own
+    index.sqlite            sha256 of each chunk -> pack, offset, length
+
+Manifest layout, one per stored edge:
+    a 64 bit integer, network byte order: the size of the stream
+    for each chunk:
+        the sha256 of the chunk
+        a 32 bit integer, network byte order: the size of the chunk
+
+Dedup streams let a client skip sending chunks the server already has.
+The client chunks the stream itself and sends, as the pieces of a reliable
+stream, messages of two kinds:
+    `Q' and the sha256 of each chunk of a batch: which does the server lack?
+    `C' and, for each chunk of the batch the oldest unanswered `Q' asked
+        about, a manifest record followed by the chunk if the server
+        lacked it
+The server answers every `Q' as it arrives with a framed string holding a
+byte per chunk, \x01 for the chunks it wants.  Several queries are kept
+in flight so the round trips overlap with sending chunks.
+"""
+import os
+import re
+import struct
+import sqlite3
+import hashlib
+from itertools import islice
+from collections import deque
+from contextlib import closing, contextmanager
+
+from .reliable_rw import IntegrityError, piece_size
+from . import common
+
+
+min_chunk = 16 * 1024
+max_chunk = 256 * 1024
+
+_anchor_bytes = (
+    '\x0d\x6e\xcf\x30\x91\xf2\x53\xb4'
+    '\x15\x76\xd7\x38\x99\xfa\x5b\xbc'
+)
+_anchor = re.compile('[%s]{4}' % re.escape(_anchor_bytes))
+
+manifest_header = '!Q'
+manifest_record = '!32sI'
+
+dedup_batch = 64  # chunks per query
+dedup_depth = 4  # queries in flight
+
+
+class Chunker(object):
+    """Splits the data fed to it into content-defined chunks."""
+    def __init__(self):
+        self._buf = bytearray()
+
+    def _cut(self, start, final):
+        length = len(self._buf)
+        if length - start < min_chunk:
+            return length if final and length > start else None
+        match = _anchor.search(
+            self._buf,
+            start + min_chunk,
+            min(start + max_chunk, length)
+        )
+        if match is not None:
+            return match.end()
+        if length - start >= max_chunk:
+            return start + max_chunk
+        return length if final else None
+
+    def _chunks(self, final):
+        chunks = []
+        start = 0
+        view = memoryview(self._buf)
+        while True:
+            end = self._cut(start, final)
+            if end is None:
+                break
+            chunks.append(view[start:end].tobytes())
+            start = end
+        del view
+        del self._buf[:start]
+        return chunks
+
+    def feed(self, data):
+        """Returns the chunks completed by `data'."""
+        self._buf += data
+        return self._chunks(False)
+
+    def finish(self):
+        """Returns the chunks left over at the end of the stream."""
+        return self._chunks(True)
+
+
+class ChunkStore(object):
+    """Chunks kept once each, by sha256, in pack files below `root'."""
+    pack_size = 1024 ** 3
+    lookup_batch = 500  # digests per index query
+
+    def __init__(self, root):
+        self._root = root
+        self._packs = os.path.join(root, 'packs')
+        if not os.path.isdir(self._packs):
+            os.makedirs(self._packs)
+        with closing(self.connect()) as db:
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS packs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    digest BLOB PRIMARY KEY,
+                    pack INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL
+                );
+            ''')
+
+    def connect(self):
+        return sqlite3.connect(
+            os.path.join(self._root, 'index.sqlite'),
+            timeout=600
+        )
+
+    def pack_path(self, pack_id):
+        return os.path.join(self._packs, '%08d.pack' % pack_id)
+
+    def locate(self, db, digests):
+        """Maps the `digests' the store holds to (pack, offset, length)."""
+        digests = list(digests)
+        found = {}
+        for start in xrange(0, len(digests), self.lookup_batch):
+            batch = digests[start:start + self.lookup_batch]
+            rows = db.execute(
+                'SELECT digest, pack, offset, length FROM chunks '
+                'WHERE digest IN (%s)' % ','.join('?' * len(batch)),
+                [sqlite3.Binary(digest) for digest in batch]
+            )
+            for digest, pack, offset, length in rows:
+                found[str(digest)] = (pack, offset, length)
+        return found
+
+    def read_chunks(self, digests):
+        """Yields the chunks with `digests', in order, verifying each."""
+        packs = {}
+        with closing(self.connect()) as db:
+            try:
+                digests = iter(digests)
+                while True:
+                    batch = list(islice(digests, self.lookup_batch))
+                    if not batch:
+                        break
+                    found = self.locate(db, batch)
+                    for digest in batch:
+                        if digest not in found:
+                            raise IntegrityError(
+                                "Chunk missing: %s" % digest.encode('hex')
+                            )
+                        pack, offset, length = found[digest]
+                        if pack not in packs:
+                            packs[pack] = open(self.pack_path(pack), 'rb')
+                        packs[pack].seek(offset)
+                        chunk = packs[pack].read(length)
+                        if hashlib.sha256(chunk).digest() != digest:
+                            raise IntegrityError(
+                                "Chunk damaged: %s" % digest.encode('hex')
+                            )
+                        yield chunk
+            finally:
+                for fh in packs.values():
+                    fh.close()
+
+    @contextmanager
+    def session(self):
+        """
+        A ChunkWriter.  The chunks it adds are indexed when the block ends,
+        or dropped along with its packs if it raises.
+        """
+        writer = ChunkWriter(self)
+        try:
+            yield writer
+        except:
+            writer.abort()
+            raise
+        writer.commit()
+
+
+class ChunkWriter(object):
+    def __init__(self, store):
+        self._store = store
+        self._db = store.connect()
+        self._added = {}
+        self._pack_ids = []
+        self._pack = None
+        self.written = 0
+
+    def _new_pack(self):
+        self._close_pack()
+        with self._db:
+            pack_id = self._db.execute(
+                'INSERT INTO packs DEFAULT VALUES'
+            ).lastrowid
+        self._pack_ids.append(pack_id)
+        self._pack = open(self._store.pack_path(pack_id), 'wb')
+
+    def _close_pack(self):
+        if self._pack is not None:
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+            self._pack.close()
+            self._pack = None
+
+    def _append(self, digest, chunk):
+        if (self._pack is None or
+                self._pack.tell() + len(chunk) > self._store.pack_size):
+            self._new_pack()
+        self._added[digest] = (
+            self._pack_ids[-1], self._pack.tell(), len(chunk)
+        )
+        self._pack.write(chunk)
+        self.written += len(chunk)
+
+    def missing(self, digests):
+        """Those of `digests' neither the store nor this session holds."""
+        digests = set(digests) - set(self._added)
+        return digests - set(self._store.locate(self._db, digests))
+
+    def lengths(self, digests):
+        """
+        Maps those of `digests' the store or this session holds to their
+        lengths.
+        """
+        digests = set(digests)
+        found = dict(
+            (digest, self._added[digest][2])
+            for digest in digests if digest in self._added
+        )
+        located = self._store.locate(self._db, digests - set(found))
+        for digest, (_, _, length) in located.items():
+            found[digest] = length
+        return found
+
+    def add_chunk(self, digest, chunk):
+        """Stores `chunk', already known to hash to `digest', if new."""
+        if self.missing([digest]):
+            self._append(digest, chunk)
+
+    def add_chunks(self, chunks):
+        """Stores the chunks that are new; returns all their digests."""
+        digests = [hashlib.sha256(chunk).digest() for chunk in chunks]
+        missing = self.missing(digests)
+        for digest, chunk in zip(digests, chunks):
+            if digest in missing:
+                self._append(digest, chunk)
+                missing.discard(digest)
+        return digests
+
+    def commit(self):
+        self._close_pack()
+        with self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?)',
+                [
+                    (sqlite3.Binary(digest), pack, offset, length)
+                    for digest, (pack, offset, length) in self._added.items()
+                ]
+            )
+        self._db.close()
+
+    def abort(self):
+        if self._pack is not None:
+            self._pack.close()
+        for pack_id in self._pack_ids:
+            os.unlink(self._store.pack_path(pack_id))
+        self._db.close()
+
+
+class ManifestWriter(object):
+    """
+    A sink that stores what is written to it through a ChunkWriter, and the
+    manifest of the stream in `fh'.
+    """
+    def __init__(self, fh, session):
+        self._fh = fh
+        self._session = session
+        self._chunker = Chunker()
+        self.size = 0
+        fh.write(struct.pack(manifest_header, 0))
+
+    def _add(self, chunks):
+        digests = self._session.add_chunks(chunks)
+        self._fh.write(''.join(
+            struct.pack(manifest_record, digest, len(chunk))
+            for digest, chunk in zip(digests, chunks)
+        ))
+
+    def write(self, buf):
+        self.size += len(buf)
+        self._add(self._chunker.feed(buf))
+
+    def missing(self, digests):
+        return self._session.missing(digests)
+
+    def add_chunks(self, records):
+        """
+        Appends chunks chunked by the client, given as (digest, length,
+        chunk): each `chunk' is verified and stored, and a chunk of None
+        must be held by the store or this session, at that length.
+        """
+        for digest, length, chunk in records:
+            if chunk is None:
+                continue
+            if (len(chunk) != length or
+                    hashlib.sha256(chunk).digest() != digest):
+                raise IntegrityError(
+                    "Chunk damaged: %s" % digest.encode('hex')
+                )
+            self._session.add_chunk(digest, chunk)
+        # a chunk may repeat within the batch it is sent in
+        held = self._session.lengths(
+            digest for digest, _, chunk in records if chunk is None
+        )
+        for digest, length, chunk in records:
+            if chunk is None and held.get(digest) != length:
+                raise IntegrityError(
+                    "Chunk not stored: %s" % digest.encode('hex')
+                )
+        for digest, length, _ in records:
+            self.size += length
+            self._fh.write(struct.pack(manifest_record, digest, length))
+
+    def close(self):
+        self._add(self._chunker.finish())
+        self._fh.seek(0)
+        self._fh.write(struct.pack(manifest_header, self.size))
+        self._fh.seek(0, os.SEEK_END)
+
+
+def read_manifest_size(fh):
+    header = fh.read(struct.calcsize(manifest_header))
+    return struct.unpack(manifest_header, header)[0]
+
+
+def read_manifest(fh):
+    """Yields the (digest, length) of every chunk after the header."""
+    record_size = struct.calcsize(manifest_record)
+    while True:
+        record = fh.read(record_size)
+        if len(record) < record_size:
+            break
+        yield struct.unpack(manifest_record, record)
+
+
+class ManifestReader(common.IterableReader):
+    """Reads the stream a manifest describes from `store'."""
+    def __init__(self, store, fh):
+        read_manifest_size(fh)
+        super(ManifestReader, self).__init__(store.read_chunks(
+            digest for digest, _ in read_manifest(fh)
+        ))
+
+
+def _hashed_chunks(input_file):
+    chunker = Chunker()
+    while True:
+        buf = input_file.read(piece_size)
+        chunks = chunker.feed(buf) if buf else chunker.finish()
+        for chunk in chunks:
+            yield hashlib.sha256(chunk).digest(), chunk
+        if not buf:
+            break
+
+
+def _batches(chunks):
+    """Batches of chunks small enough for their `C' to fit a piece."""
+    record_size = struct.calcsize(manifest_record)
+    batch, size = [], 1
+    for digest, chunk in chunks:
+        if (len(batch) == dedup_batch or
+                size + record_size + len(chunk) > piece_size):
+            yield batch
+            batch, size = [], 1
+        batch.append((digest, chunk))
+        size += record_size + len(chunk)
+    if batch:
+        yield batch
+
+
+def dedup_messages(input_file, answers):
+    """
+    Yields the messages of a dedup stream of `input_file', then an empty
+    one to end it, reading the server's answers from `answers'.
+
+    Reading and chunking run on their own thread.  The messages must be
+    sent as soon as they are yielded, as each `C' waits for an answer.
+    """
+    pending = deque()
+
+    def _records(batch):
+        wanted = common.read_framed('!I', answers)
+        if len(wanted) != len(batch):
+            raise IntegrityError("Bad answer to a dedup query")
+        message = ['C']
+        for (digest, chunk), want in zip(batch, wanted):
+            message.append(struct.pack(manifest_record, digest, len(chunk)))
+            if want == '\x01':
+                message.append(chunk)
+        return ''.join(message)
+
+    chunks = common.threaded(_hashed_chunks(input_file))
+    for batch in _batches(chunks):
+        yield 'Q' + ''.join(digest for digest, _ in batch)
+        pending.append(batch)
+        if len(pending) >= dedup_depth:
+            yield _records(pending.popleft())
+    while pending:
+        yield _records(pending.popleft())
+    yield b''
+
+
+def receive_dedup(pieces, sink, answers):
+    """
+    Stores the dedup stream in `pieces' into the ManifestWriter `sink',
+    writing answers to `answers'.
+    """
+    digest_size = struct.calcsize('32s')
+    record_size = struct.calcsize(manifest_record)
+    queried = deque()
+    requested = set()
+    for piece, _ in pieces:
+        piece = memoryview(piece)
+        kind = piece[:1].tobytes()
+        body = piece[1:].tobytes()
+        if kind == 'Q':
+            digests = [
+                body[offset:offset + digest_size]
+                for offset in xrange(0, len(body), digest_size)
+            ]
+            # a chunk asked for in this batch or an earlier one arrives
+            # before any reference to it
+            missing = sink.missing(set(digests) - requested)
+            wanted = []
+            for digest in digests:
+                want = digest in missing and digest not in requested
+                if want:
+                    requested.add(digest)
+                wanted.append('\x01' if want else '\x00')
+            queried.append((digests, wanted))
+            common.write_framed('!I', answers, ''.join(wanted))
+            answers.flush()
+        elif kind == 'C' and queried:
+            # records answer the oldest query, chunk for chunk
+            records = []
+            offset = 0
+            for expected, want in zip(*queried.popleft()):
+                if offset + record_size > len(body):
+                    raise IntegrityError("Malformed dedup message")
+                digest, length = struct.unpack_from(
+                    manifest_record, body, offset
+                )
+                offset += record_size
+                if digest != expected:
+                    raise IntegrityError("Dedup record out of order")
+                chunk = None
+                if want == '\x01':
+                    chunk = body[offset:offset + length]
+                    offset += length
+                records.append((digest, length, chunk))
+            if offset != len(body):
+                raise IntegrityError("Malformed dedup message")
+            sink.add_chunks(records)
+        else:
+            raise IntegrityError("Unexpected dedup message")
+    if queried:
+        raise IntegrityError("Dedup stream ended early")
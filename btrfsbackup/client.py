@@ -1,18 +1,59 @@
 #!/usr/bin/python
 import os
+import re
+import sys
+import json
+import shlex
+# datetime.strptime imports this lazily, which is not thread safe
+import _strptime
 import subprocess
+import time
+import tempfile
+import threading
+import traceback
 from functools import partial
+from itertools import chain
+from collections import deque
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-from .reliable_rw import yield_pieces, yield_pieces_output_manager
+from .reliable_rw import (
+    frame_pieces, yield_pieces, yield_pieces_output_manager,
+    yield_input_pieces, choose_hash_mode, skip_pieces, ResumeMismatch,
+    piece_size, DEFAULT_HASH_MODE
+)
+from .compression import choose_codec
+from .chunkstore import dedup_messages
+from .throttle import throttled
+from .spool import read_edge
+from .encryption import is_encrypted, magic
+from .metrics import disabled
+from .graphanalyze import DirectedGraph
+from .mux import Multiplexer
 from . import wire_pb2
 from . import common
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 class NonZeroReturn(Exception):
     pass
 
 
+class SessionFailed(Exception):
+    pass
+
+
+class ParentGone(Exception):
+    pass
+
+
 class StorageDriver(object):
     def get_local_nodes(self):
         raise NotImplementedError
@@ -22,8 +63,12 @@ class StorageDriver(object):
         raise NotImplementedError
         return ""
 
+    def take_snapshot(self, node):
+        raise NotImplementedError
+
     @contextmanager
-    def get_snapstream(self, from_node, to_node, keep_node=False):
+    def get_snapstream(self, from_node, to_node, keep_node=False,
+                       existing=False):
         raise NotImplementedError
         # yield OutputStream
 
@@ -31,13 +76,35 @@ class StorageDriver(object):
         raise NotImplementedError
         return None
 
+    def wait_deletions(self):
+        pass
+
+    def receive(self, chunks):
+        """Feeds the strings `chunks' yields to `btrfs receive'."""
+        raise NotImplementedError
+
+    def estimate_delta(self, from_node):
+        raise NotImplementedError
+        return 0
+
 
 class StandardStorageDriver(StorageDriver):
+    # the generation of each snapshot, which never changes once it is taken
+    generations_filename = '.btrfs-backup-nodes'
+
     def __init__(self, target_subvol, node_root):
         self._target_subvol = target_subvol
         self._node_root = node_root
+        self._generations = None
+        self._deleting = []
 
     def get_local_nodes(self):
+        if scandir is not None:
+            # directory entries carry their type, no stat needed
+            return [
+                entry.name for entry in scandir(self._node_root)
+                if entry.is_dir()
+            ]
         return [
             x for x in os.listdir(self._node_root)
             if os.path.isdir(os.path.join(self._node_root, x))
@@ -46,15 +113,20 @@ class StandardStorageDriver(StorageDriver):
     def node_to_filename(self, node):
         return os.path.join(self._node_root, node)
 
-    @contextmanager
-    def get_snapstream(self, from_node, to_node, keep_node=False):
+    def take_snapshot(self, node):
         retval = subprocess.Popen([
             'btrfs', 'subvolume', 'snapshot', '-r',
             self._target_subvol,
-            self.node_to_filename(to_node)
+            self.node_to_filename(node)
         ]).wait()
         if 0 != retval:
             raise NonZeroReturn("btrfs command failure", retval)
+
+    @contextmanager
+    def get_snapstream(self, from_node, to_node, keep_node=False,
+                       existing=False):
+        if not existing:
+            self.take_snapshot(to_node)
         try:
             if from_node:
                 args = [
@@ -64,7 +136,7 @@ class StandardStorageDriver(StorageDriver):
                 ]
             else:
                 args = ['btrfs', 'send', self.node_to_filename(to_node)]
-            print ' '.join(args)
+            print >> sys.stderr, ' '.join(args)
             subproc = subprocess.Popen(args, stdout=subprocess.PIPE)
             yield subproc
             subproc.stdout.close()
@@ -88,53 +160,1097 @@ class StandardStorageDriver(StorageDriver):
                     raise NonZeroReturn("btrfs command failure", retval)
 
     def delete_node(self, node_names):
+        """
+        Starts deleting the snapshots `node_names' and returns; see
+        wait_deletions.  Nor does the deletion wait for btrfs to commit
+        it, the cleaner frees the space in the background.
+        """
         if isinstance(node_names, basestring):
             node_names = [node_names]
-        retval = subprocess.Popen(
+        self._deleting.append(subprocess.Popen(
             [
                 'btrfs', 'subvolume', 'delete',
             ] + map(self.node_to_filename, node_names)
-        ).wait()
+        ))
+        generations = self._load_generations()
+        if any(node in generations for node in node_names):
+            for node in node_names:
+                generations.pop(node, None)
+            self._save_generations()
+
+    def wait_deletions(self):
+        """Waits for the deletions delete_node started to finish."""
+        deleting, self._deleting = self._deleting, []
+        for subproc in deleting:
+            retval = subproc.wait()
+            if 0 != retval:
+                raise NonZeroReturn("btrfs command failure", retval)
+
+    def _generations_path(self):
+        return os.path.join(self._node_root, self.generations_filename)
+
+    def _load_generations(self):
+        if self._generations is None:
+            try:
+                with open(self._generations_path()) as fh:
+                    self._generations = json.load(fh)
+            except (IOError, ValueError):
+                self._generations = {}
+        return self._generations
+
+    def _save_generations(self):
+        path = self._generations_path()
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as fh:
+            json.dump(self._generations, fh)
+        os.rename(tmp_path, path)
+
+    def node_generation(self, node):
+        """The generation of the snapshot `node', looked up once."""
+        generations = self._load_generations()
+        if node not in generations:
+            generation = 0
+            path = self.node_to_filename(node)
+            for line in self._find_new(path, 2 ** 64 - 1):
+                match = re.match(r'transid marker was (\d+)', line)
+                if match:
+                    generation = int(match.group(1))
+            generations[node] = generation
+            self._save_generations()
+        return generations[node]
+
+    def _find_new(self, path, generation):
+        """Yields the lines of `btrfs subvolume find-new PATH GENERATION'."""
+        subproc = subprocess.Popen(
+            ['btrfs', 'subvolume', 'find-new', path, str(generation)],
+            stdout=subprocess.PIPE
+        )
+        for line in subproc.stdout:
+            yield line
+        retval = subproc.wait()
+        if 0 != retval:
+            raise NonZeroReturn("btrfs command failure", retval)
+
+    def estimate_delta(self, from_node):
+        """
+        Estimates the bytes `btrfs send' of the subvolume would produce
+        relative to `from_node' (or a full send, for None) by adding up the
+        extents written since the snapshot's generation.
+        """
+        generation = 0
+        if from_node:
+            generation = self.node_generation(from_node)
+        size = 0
+        for line in self._find_new(self._target_subvol, generation + 1):
+            match = re.search(r' len (\d+) ', line)
+            if match:
+                size += int(match.group(1))
+        return size
+
+    def receive(self, chunks):
+        args = ['btrfs', 'receive', self._node_root]
+        print >> sys.stderr, ' '.join(args)
+        subproc = subprocess.Popen(args, stdin=subprocess.PIPE)
+        try:
+            for buf in chunks:
+                subproc.stdin.write(buf)
+            subproc.stdin.close()
+        except IOError:
+            # btrfs receive went away; its status says why
+            if 0 != subproc.wait():
+                raise NonZeroReturn("btrfs command failure", subproc.wait())
+            raise
+        except:
+            subproc.kill()
+            subproc.wait()
+            raise
+        retval = subproc.wait()
         if 0 != retval:
             raise NonZeroReturn("btrfs command failure", retval)
 
 
-def client_io(storage_driver, selection_constructor, subprocess):
+def _find_resumable(partials, local_nodes):
+    for partial_upload in partials:
+        if partial_upload.to_node not in local_nodes:
+            continue
+        if partial_upload.from_node in ['FULL'] + local_nodes:
+            return partial_upload
+    return None
+
+
+def read_graph_cache(path):
+    graph = wire_pb2.Graph()
+    try:
+        with open(path, 'rb') as fh:
+            graph.ParseFromString(fh.read())
+    except IOError:
+        return None
+    return graph
+
+
+def write_graph_cache(path, graph):
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as fh:
+        fh.write(graph.SerializeToString())
+    os.rename(tmp_path, path)
+
+
+def apply_graph_delta(cached, delta):
+    """Returns the graph `delta' brings the graph `cached' up to."""
+    edges = dict(
+        ((edge.from_node, edge.to_node), edge) for edge in cached.edges
+    )
+    for edge in delta.removed_edges:
+        edges.pop((edge.from_node, edge.to_node), None)
+    for edge in delta.edges:
+        edges[edge.from_node, edge.to_node] = edge
+
+    graph = wire_pb2.Graph()
+    graph.CopyFrom(delta)
+    graph.ClearField('delta')
+    graph.ClearField('edges')
+    graph.ClearField('removed_edges')
+    for key in sorted(edges):
+        graph.edges.add().CopyFrom(edges[key])
+    return graph
+
+
+def _policy_class(selection_constructor):
+    # policies may come wrapped in functools.partial
+    return getattr(selection_constructor, 'func', selection_constructor)
+
+
+def _wants_edge_sizes(selection_constructor):
+    return getattr(
+        _policy_class(selection_constructor), 'wants_edge_sizes', False
+    )
+
+
+def _take_snapshot(storage_driver, selection_constructor, metrics):
+    """
+    Names the new snapshot and starts taking it on a thread of its own,
+    so it is taken at the time it is named for while the graph is
+    fetched and the parent picked.  Returns the name and an AsyncResult
+    to wait on.
+    """
+    node = _policy_class(selection_constructor).generate_node_name()
+
+    def _take():
+        with metrics.timer('snapshot'):
+            storage_driver.take_snapshot(node)
+    pool = ThreadPool(1)
+    try:
+        return node, pool.apply_async(_take)
+    finally:
+        pool.close()
+
+
+def _drop_snapshot(storage_driver, node, snapshot):
+    """Deletes a snapshot _take_snapshot took that will not be sent."""
+    try:
+        snapshot.get()
+    except Exception:
+        return
+    storage_driver.delete_node(node)
+
+
+def fetch_graph(subprocess, local_nodes, edge_sizes=False, graph_cache=None,
+                local_graph=False, metrics=disabled):
+    """
+    Starts a session on `subprocess' by reading the server's graph, as
+    client_io describes.
+    """
+    write_framed = partial(common.write_framed, '!I', subprocess.stdin)
+    read_framed = partial(common.read_framed, '!I', subprocess.stdout)
+
+    cached = None
+    with metrics.timer('graph_fetch'):
+        if graph_cache is None and not local_graph and not edge_sizes:
+            subprocess.stdin.write(common.magic_number)
+        else:
+            request = wire_pb2.GraphRequest()
+            request.sizes = edge_sizes
+            if local_graph:
+                request.roots.extend(local_nodes)
+            elif graph_cache is not None:
+                cached = read_graph_cache(graph_cache)
+            if cached is not None and cached.HasField('epoch'):
+                request.epoch = cached.epoch
+                request.generation = cached.generation
+            subprocess.stdin.write(common.sync_magic_number)
+            write_framed(request.SerializeToString())
+        serialized = read_framed()
+    metrics.count('graph_fetch', len(serialized))
+    with metrics.timer('graph_parse'):
+        graph = wire_pb2.Graph()
+        graph.ParseFromString(serialized)
+        if graph.delta:
+            graph = apply_graph_delta(cached, graph)
+        if graph_cache is not None and graph.HasField('epoch'):
+            write_graph_cache(graph_cache, graph)
+    return graph
+
+
+def _new_edge(parent, node, codec, hash_mode):
+    edge = wire_pb2.Graph.GraphEdge()
+    edge.from_node = parent or 'FULL'
+    edge.to_node = node
+    if codec is not None:
+        edge.compression = codec.name
+    if hash_mode is not DEFAULT_HASH_MODE:
+        edge.hash_mode = hash_mode.name
+    return edge
+
+
+def client_io(storage_driver, selection_constructor, subprocess,
+              compression=None, hash_mode=None, graph_cache=None,
+              local_graph=False, dedup=False, rate_limit=None,
+              encryption=None, metrics=disabled):
+    """
+    Backs up one snapshot over `subprocess'.  With `graph_cache' the graph
+    is kept in that file and only changes to it are fetched; with
+    `local_graph' only the part of the graph the local nodes need is.
+    Policies with `wants_edge_sizes' set get edge sizes and timestamps.
+    All of these need a server that knows sync_magic_number.  With `dedup'
+    the stream is sent as a dedup stream if the server takes them.
+    Uploads go no faster than the TokenBucket `rate_limit', if given,
+    which concurrent sessions may share.  With the StreamKey
+    `encryption' the stream is compressed and encrypted on the client,
+    and never resumed.  The time each stage takes is recorded in
+    `metrics'.
+    """
     write_framed = partial(
         common.write_framed,
         '!I',
         subprocess.stdin
     )
-    read_framed = partial(
-        common.read_framed,
-        '!I',
-        subprocess.stdout
+
+    # load graph, while the snapshot is being taken
+    local_nodes = storage_driver.get_local_nodes()
+    newshot_node, snapshot = _take_snapshot(
+        storage_driver, selection_constructor, metrics
     )
+    # a snapshot that is not going to be sent is dropped, or it would pass
+    # for a local node that has no backup
+    try:
+        graph = fetch_graph(
+            subprocess,
+            local_nodes,
+            _wants_edge_sizes(selection_constructor),
+            graph_cache,
+            local_graph,
+            metrics
+        )
+        codec = choose_codec(compression, graph.compression)
+        hash_mode = choose_hash_mode(hash_mode, graph.hash_modes)
+        inner_codec = None
+        if encryption is not None:
+            inner_codec, codec = codec, None
+
+        # select parent and make edge (parent, current), unless the server
+        # holds an interrupted upload of ours, which we carry on with instead.
+        # An encrypted stream never comes out the same twice.
+        resumable = None
+        if encryption is None:
+            resumable = _find_resumable(graph.partials, local_nodes)
+        if resumable is not None:
+            local_nodes.remove(resumable.to_node)
+            _drop_snapshot(storage_driver, newshot_node, snapshot)
+            snapshot = None
+        with metrics.timer('policy'):
+            policy = selection_constructor(graph, local_nodes)
+            if resumable is None:
+                best_parent = policy.best_parent()
+        if resumable is not None:
+            best_parent = resumable.from_node
+            if best_parent == 'FULL':
+                best_parent = None
+            newshot_node = resumable.to_node
+
+        edge = _new_edge(best_parent, newshot_node, codec, hash_mode)
+        if dedup and graph.dedup and resumable is None:
+            edge.dedup = True
+        # policies that estimate delta sizes let the server preallocate
+        estimate_delta = getattr(policy, 'estimate_delta', None)
+        if snapshot is not None:
+            with metrics.timer('snapshot_wait'):
+                snapshot.get()
+    except:
+        if snapshot is not None:
+            _drop_snapshot(storage_driver, newshot_node, snapshot)
+        raise
+
+    def _send(sink, pieces):
+        # time blocked on writes is time the transport holds us up
+        for piece in throttled(pieces, rate_limit):
+            with metrics.timer('wire'):
+                sink.write(piece)
+            metrics.count('wire', len(piece))
+
+    def _upload(btrfs_send, resume_pieces=0, hasher=None):
+        if resume_pieces:
+            edge.resume_pieces = resume_pieces
+            edge.resume_digest = hasher.digest()
+        elif estimate_delta is not None and not edge.HasField('size'):
+            # btrfs send is already under way
+            edge.size = int(estimate_delta(best_parent))
+        write_framed(edge.SerializeToString())
+        if resume_pieces and not resumable.HasField('digest'):
+            # the server checks the digest against its partial
+            subprocess.stdin.flush()
+            if common.read_framed('!I', subprocess.stdout) != '\x01':
+                edge.ClearField('resume_pieces')
+                edge.ClearField('resume_digest')
+                raise ResumeMismatch("Stream differs from the partial upload")
+        if edge.dedup:
+            _upload_dedup(btrfs_send)
+            return
+        subprocess.stdout.close()
+
+        with yield_pieces_output_manager(subprocess.stdin) as sink:
+            _send(sink, yield_pieces(
+                _source(btrfs_send, edge, inner_codec, encryption, metrics),
+                with_magic=False,
+                codec=codec,
+                hash_mode=hash_mode,
+                first_index=resume_pieces,
+                hasher=hasher,
+                metrics=metrics
+            ))
+
+    def _upload_dedup(btrfs_send):
+        # one piece at a time, as each may wait on the server's answer to
+        # a query in one sent before it
+        with yield_pieces_output_manager(subprocess.stdin) as sink:
+            messages = dedup_messages(
+                metrics.timed_reader(btrfs_send.stdout, 'send'),
+                subprocess.stdout
+            )
+            _send(sink, frame_pieces(
+                messages,
+                codec,
+                workers=1,
+                hash_mode=hash_mode,
+                metrics=metrics
+            ))
+        subprocess.stdout.close()
+
+    # skip what the server already has, but only if the regenerated
+    # stream matches it; otherwise send the edge again from the start.
+    try:
+        started = time.time()
+        with storage_driver.get_snapstream(
+                best_parent, newshot_node, True,
+                existing=True) as btrfs_send:
+            if resumable is None:
+                _upload(btrfs_send)
+            else:
+                hasher = skip_pieces(btrfs_send.stdout, resumable.pieces)
+                if (resumable.HasField('digest') and
+                        hasher.digest() != resumable.digest):
+                    raise ResumeMismatch(
+                        "Stream differs from the partial upload")
+                _upload(btrfs_send, resumable.pieces, hasher)
+    except ResumeMismatch:
+        with storage_driver.get_snapstream(
+                best_parent, newshot_node, True,
+                existing=True) as btrfs_send:
+            _upload(btrfs_send)
+    metrics.add_time('upload', time.time() - started)
+
+    # the server syncs and renames the edge into place before it exits
+    with metrics.timer('server_commit'):
+        subprocess.stdin.close()
+        subprocess.wait()
+
+    # deleting snapshots goes on in the background, see wait_deletions
+    with metrics.timer('cleanup'):
+        policy.clean_local_nodes(storage_driver)
 
-    # load graph
-    subprocess.stdin.write(common.magic_number)
-    graph = wire_pb2.Graph()
-    graph.ParseFromString(read_framed())
 
-    # select parent and make edge (parent, current)
+def _source(btrfs_send, edge, codec, encryption, metrics):
+    """What to send of `btrfs send': its stream, or that encrypted."""
+    stream = metrics.timed_reader(btrfs_send.stdout, 'send')
+    if encryption is None:
+        return stream
+    return encryption.encrypt(stream, edge.from_node, edge.to_node, codec)
+
+
+def _spool_graph(spool, connect, edge_sizes, metrics):
+    """
+    The graph of the last upload through `spool' with the edges spooled
+    since.  Without one the server's graph is fetched over `connect()',
+    and only if that fails is the spool gone by alone.
+    """
+    graph = read_graph_cache(spool.graph_path)
+    if graph is None:
+        try:
+            subprocess = connect()
+            graph = fetch_graph(subprocess, [], edge_sizes, spool.graph_path,
+                                metrics=metrics)
+            # the server takes our hanging up as the end of the session
+            subprocess.stdin.close()
+            subprocess.wait()
+            write_graph_cache(spool.graph_path, graph)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            graph = wire_pb2.Graph()
+    return spool.with_queued(graph)
+
+
+def _plan_spooled(graph, selection_constructor, local_nodes, newshot_node,
+                  compression, hash_mode, encryption, metrics):
+    """
+    Returns (policy, parent, edge, codec, inner_codec, hash_mode) for
+    spooling `newshot_node', going by `graph'.
+    """
+    codec = choose_codec(compression, graph.compression)
+    hash_mode = choose_hash_mode(hash_mode, graph.hash_modes)
+    inner_codec = None
+    if encryption is not None:
+        inner_codec, codec = codec, None
+    with metrics.timer('policy'):
+        policy = selection_constructor(graph, local_nodes)
+        best_parent = policy.best_parent()
+
+    edge = _new_edge(best_parent, newshot_node, codec, hash_mode)
+    estimate_delta = getattr(policy, 'estimate_delta', None)
+    if estimate_delta is not None:
+        edge.size = int(estimate_delta(best_parent))
+    return policy, best_parent, edge, codec, inner_codec, hash_mode
+
+
+def spool_client_io(storage_driver, selection_constructor, spool, connect,
+                    compression=None, hash_mode=None, rate_limit=None,
+                    encryption=None, metrics=disabled):
+    """
+    Backs up one snapshot through the Spool `spool': `btrfs send' writes
+    into the spool, then every spooled edge is uploaded, oldest first,
+    each over a new subprocess from `connect()'.  The parent is picked
+    from the graph of the last upload, or the server's if there is none
+    yet, and the edges spooled since, so snapshots are still taken and
+    spooled while the server is out of reach.  A spool too full to take
+    the new edge is drained first, as far as the server lets it.
+    `encryption' is as for client_io.  Returns the number of edges left
+    in the spool.
+    """
+    edge_sizes = _wants_edge_sizes(selection_constructor)
     local_nodes = storage_driver.get_local_nodes()
-    policy = selection_constructor(graph, local_nodes)
-    best_parent = policy.best_parent()
+    newshot_node, snapshot = _take_snapshot(
+        storage_driver, selection_constructor, metrics
+    )
+    plan = (selection_constructor, local_nodes, newshot_node, compression,
+            hash_mode, encryption, metrics)
 
-    newshot_node = policy.generate_node_name()
+    # the snapshot's send is done as soon as the stream is on local disk;
+    # whatever is spooled goes up even if this one fails, and a snapshot
+    # that did not make it into the spool is dropped
+    try:
+        (policy, best_parent, edge, codec, inner_codec,
+         hash_mode) = _plan_spooled(
+            _spool_graph(spool, connect, edge_sizes, metrics), *plan)
+        if spool.near_full(edge.size or None):
+            # what the server takes now makes room, and may drop spooled
+            # edges the new one would have gone on from
+            drain_spool(spool, connect, edge_sizes, rate_limit, metrics)
+            (policy, best_parent, edge, codec, inner_codec,
+             hash_mode) = _plan_spooled(
+                _spool_graph(spool, connect, edge_sizes, metrics), *plan)
+        with metrics.timer('snapshot_wait'):
+            snapshot.get()
+        with storage_driver.get_snapstream(
+                best_parent, newshot_node, True,
+                existing=True) as btrfs_send:
+            with spool.add(edge) as sink:
+                with metrics.timer('spool'):
+                    source = _source(btrfs_send, edge, inner_codec,
+                                     encryption, metrics)
+                    for piece in yield_pieces(
+                            source,
+                            codec=codec,
+                            hash_mode=hash_mode,
+                            metrics=metrics):
+                        sink.write(piece)
+                        metrics.count('spool', len(piece))
+    except:
+        _drop_snapshot(storage_driver, newshot_node, snapshot)
+        raise
+    finally:
+        remaining = drain_spool(spool, connect, edge_sizes, rate_limit,
+                                metrics)
 
-    edge = wire_pb2.Graph.GraphEdge()
-    edge.from_node = best_parent or 'FULL'
-    edge.to_node = newshot_node
-    write_framed(edge.SerializeToString())
+    with metrics.timer('cleanup'):
+        policy.clean_local_nodes(storage_driver)
+    return remaining
+
+
+def drain_spool(spool, connect, edge_sizes=False, rate_limit=None,
+                metrics=disabled):
+    """
+    Uploads the edges of `spool' in order, as spool_client_io does, and
+    stops at the first that fails.  Edges whose parent the server no
+    longer has can never be restored and are dropped.  Returns the number
+    of edges left.
+    """
+    remaining = list(spool.queued())
+    while remaining:
+        path, edge = remaining[0]
+        try:
+            _upload_spooled(connect(), path, edge, edge_sizes,
+                            spool.graph_path, rate_limit, metrics)
+        except ParentGone:
+            print >> sys.stderr, "dropping spooled %s->%s: %s is gone" % (
+                edge.from_node, edge.to_node, edge.from_node)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            break
+        os.unlink(path)
+        remaining.pop(0)
+    return len(remaining)
+
+
+def _upload_spooled(subprocess, path, edge, edge_sizes, graph_cache,
+                    rate_limit, metrics):
+    graph = fetch_graph(subprocess, [], edge_sizes, graph_cache,
+                        metrics=metrics)
+    edges = set((stored.from_node, stored.to_node) for stored in graph.edges)
+    nodes = set([DirectedGraph.ROOT_NODE] + [to_ for _, to_ in edges])
+    if (edge.from_node, edge.to_node) in edges or edge.from_node not in nodes:
+        # the server takes our hanging up as the end of the session
+        subprocess.stdin.close()
+        subprocess.wait()
+        if (edge.from_node, edge.to_node) in edges:
+            return
+        raise ParentGone(edge.from_node)
+
+    common.write_framed('!I', subprocess.stdin, edge.SerializeToString())
     subprocess.stdout.close()
+    with open(path, 'rb') as fh:
+        read_edge(fh)
+        chunks = iter(partial(fh.read, 1024 ** 2), '')
+        for chunk in throttled(chunks, rate_limit):
+            with metrics.timer('wire'):
+                subprocess.stdin.write(chunk)
+            metrics.count('wire', len(chunk))
+    with metrics.timer('server_commit'):
+        subprocess.stdin.close()
+        retval = subprocess.wait()
+    if 0 != retval:
+        raise NonZeroReturn("server failure", retval)
+    graph.edges.add().CopyFrom(edge)
+    write_graph_cache(graph_cache, graph)
 
-    with yield_pieces_output_manager(subprocess.stdin) as sink:
-        with storage_driver.get_snapstream(best_parent, newshot_node, True) as btrfs_send:
-            for piece in yield_pieces(btrfs_send.stdout, with_magic=False):
-                sink.write(piece)
 
+# bytes of stream held in memory for each server of replicate_client_io
+replica_buffer = 16 * piece_size
+
+
+def _intersect_graphs(graphs):
+    """The edges, codecs and hash modes all of `graphs' have."""
+    shared = set.intersection(*[
+        set((edge.from_node, edge.to_node) for edge in graph.edges)
+        for graph in graphs
+    ])
+    graph = wire_pb2.Graph()
+    for edge in graphs[0].edges:
+        if (edge.from_node, edge.to_node) in shared:
+            graph.edges.add().CopyFrom(edge)
+    for field in ('compression', 'hash_modes'):
+        getattr(graph, field).extend(
+            value for value in getattr(graphs[0], field)
+            if all(value in getattr(other, field) for other in graphs[1:])
+        )
+    return graph
+
+
+class _Replica(object):
+    """
+    Uploads `edge' over `subprocess' on a thread of its own, from the
+    pieces put to it.  Up to `buffer_size' bytes wait in memory; once the
+    server falls further behind, the rest of the stream waits in a file in
+    `spool_dir' instead, so a slow server never holds up the others.
+    """
+    def __init__(self, subprocess, edge, buffer_size, spool_dir, metrics):
+        self._subprocess = subprocess
+        self._edge = edge
+        self._buffer_size = buffer_size
+        self._spool_dir = spool_dir
+        self._metrics = metrics
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._buffered = 0
+        self._spill = None
+        self._spilled = self._unspilled = 0
+        self._ended = self._complete = False
+        self.error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, piece):
+        with self._cond:
+            if self.error is not None:
+                return
+            if (self._spill is None and
+                    self._buffered + len(piece) <= self._buffer_size):
+                self._pending.append(piece)
+                self._buffered += len(piece)
+            else:
+                # once spilling, everything after goes through the file
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile(dir=self._spool_dir)
+                self._spill.seek(0, os.SEEK_END)
+                self._spill.write(piece)
+                self._spilled += len(piece)
+                self._metrics.count('spill', len(piece))
+            self._cond.notify()
+
+    def end(self, complete):
+        """No more pieces; `complete' if the stream is all there."""
+        with self._cond:
+            self._ended = True
+            self._complete = complete
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    piece = self._pending.popleft()
+                    self._buffered -= len(piece)
+                    return piece
+                if self._unspilled < self._spilled:
+                    self._spill.seek(self._unspilled)
+                    chunk = self._spill.read(
+                        min(piece_size, self._spilled - self._unspilled)
+                    )
+                    self._unspilled += len(chunk)
+                    return chunk
+                if self._ended:
+                    if not self._complete:
+                        raise SessionFailed("Stream was cut short")
+                    return None
+                self._cond.wait()
+
+    def _run(self):
+        subprocess = self._subprocess
+        try:
+            common.write_framed(
+                '!I', subprocess.stdin, self._edge.SerializeToString()
+            )
+            subprocess.stdout.close()
+            # a failure here poisons the stream, and the server gives up
+            with yield_pieces_output_manager(subprocess.stdin) as sink:
+                for piece in iter(self._next, None):
+                    sink.write(piece)
+                    self._metrics.count('wire', len(piece))
+            retval = subprocess.wait()
+            if retval != 0:
+                raise NonZeroReturn("server failure", retval)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            with self._cond:
+                self.error = e
+                self._pending.clear()
+                if self._spill is not None:
+                    self._spill.close()
+
+    def join(self):
+        """Waits for the upload; returns what it failed with, or None."""
+        self._thread.join()
+        return self.error
+
+
+def replicate_client_io(storage_driver, selection_constructor, subprocesses,
+                        compression=None, hash_mode=None, local_graph=False,
+                        rate_limit=None, encryption=None, spool_dir=None,
+                        buffer_size=replica_buffer, metrics=disabled):
+    """
+    Backs up one snapshot to several servers, one over each of
+    `subprocesses', from a single `btrfs send'.  The parent is picked from
+    the edges all of them have, and the stream is compressed, hashed and
+    encrypted once for all of them.  Each server is fed as fast as it
+    takes the stream, as _Replica describes; one that cannot be reached
+    is left out.  Uploads are neither resumed nor deduplicated.  Returns
+    an exception or None for every server, in order; local snapshots are
+    only cleaned up once every server has the new one.
+    """
+    local_nodes = storage_driver.get_local_nodes()
+    edge_sizes = _wants_edge_sizes(selection_constructor)
+    newshot_node, snapshot = _take_snapshot(
+        storage_driver, selection_constructor, metrics
+    )
+
+    def _handshake(subprocess):
+        try:
+            return fetch_graph(
+                subprocess,
+                local_nodes,
+                edge_sizes,
+                local_graph=local_graph,
+                metrics=metrics
+            ), None
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return None, e
+
+    handshakes = ThreadPool(len(subprocesses))
+    try:
+        results = handshakes.map(_handshake, subprocesses)
+    finally:
+        handshakes.close()
+    errors = [error for _, error in results]
+    reachable = [
+        index for index, error in enumerate(errors) if error is None
+    ]
+    if not reachable:
+        _drop_snapshot(storage_driver, newshot_node, snapshot)
+        raise errors[0]
+    graph = _intersect_graphs([results[index][0] for index in reachable])
+    codec = choose_codec(compression, graph.compression)
+    hash_mode = choose_hash_mode(hash_mode, graph.hash_modes)
+    inner_codec = None
+    if encryption is not None:
+        inner_codec, codec = codec, None
+    with metrics.timer('policy'):
+        policy = selection_constructor(graph, local_nodes)
+        best_parent = policy.best_parent()
+
+    edge = _new_edge(best_parent, newshot_node, codec, hash_mode)
+    estimate_delta = getattr(policy, 'estimate_delta', None)
+    if estimate_delta is not None:
+        edge.size = int(estimate_delta(best_parent))
+    with metrics.timer('snapshot_wait'):
+        snapshot.get()
+
+    replicas = dict(
+        (index, _Replica(subprocesses[index], edge, buffer_size, spool_dir,
+                         metrics))
+        for index in reachable
+    )
+    complete = False
+    started = time.time()
+    try:
+        with storage_driver.get_snapstream(
+                best_parent, newshot_node, True,
+                existing=True) as btrfs_send:
+            source = _source(btrfs_send, edge, inner_codec, encryption,
+                             metrics)
+            pieces = yield_pieces(
+                source,
+                with_magic=False,
+                codec=codec,
+                hash_mode=hash_mode,
+                metrics=metrics
+            )
+            for piece in throttled(pieces, rate_limit):
+                for replica in replicas.values():
+                    replica.put(piece)
+        complete = True
+    finally:
+        for replica in replicas.values():
+            replica.end(complete)
+        with metrics.timer('server_commit'):
+            for index, replica in replicas.items():
+                errors[index] = replica.join()
+    metrics.add_time('upload', time.time() - started)
+
+    if not any(errors):
+        with metrics.timer('cleanup'):
+            policy.clean_local_nodes(storage_driver)
+    return errors
+
+
+def restore_chain(graph, target, local_nodes):
+    """
+    The (from_node, to_node) edges to receive, in order, to restore
+    `target': the chain with the fewest bytes to transfer that starts at
+    FULL or at a node we still have.
+    """
+    # a node we have costs nothing to get to
+    local_nodes = set(local_nodes)
+    if target in local_nodes:
+        return []
+    sizes = {}
+    augmented = wire_pb2.Graph()
+    augmented.CopyFrom(graph)
+    for edge in graph.edges:
+        sizes[edge.from_node, edge.to_node] = (
+            edge.size if edge.HasField('size') else 1
+        )
+    for node in local_nodes:
+        edge = augmented.edges.add()
+        edge.from_node = DirectedGraph.ROOT_NODE
+        edge.to_node = node
+        sizes[DirectedGraph.ROOT_NODE, node] = 0
+
+    path = DirectedGraph(augmented).min_path(
+        target,
+        DirectedGraph.ROOT_NODE,
+        lambda from_node, to_node: sizes[from_node, to_node]
+    )
+    path.reverse()
+    for index in xrange(len(path) - 1, 0, -1):
+        if path[index] in local_nodes:
+            path = path[index:]
+            break
+    return zip(path, path[1:])
+
+
+def _strings(pieces):
+    # received pieces are only valid until the next one is read
+    for piece, _ in pieces:
+        yield piece.tobytes() if isinstance(piece, memoryview) else piece
+
+
+class KeyRequired(Exception):
+    pass
+
+
+def _restored(pieces, edge, encryption):
+    """
+    Yields the send stream of the edge (from_node, to_node) `edge' in the
+    received `pieces', decrypted with the StreamKey `encryption' if it was
+    sent encrypted.  A pool that took to encryption later has both kinds
+    of edges.
+    """
+    strings = (buf for buf in _strings(pieces) if buf)
+    head = ''
+    for buf in strings:
+        head += buf
+        if len(head) >= len(magic):
+            break
+    stream = chain([head], strings)
+    if not is_encrypted(head):
+        return stream
+    if encryption is None:
+        raise KeyRequired(
+            "%s->%s is encrypted; restoring it needs --encrypt-key" % edge
+        )
+    plain = encryption.decrypt(common.IterableReader(stream), *edge)
+    return iter(partial(plain.read, piece_size), '')
+
+
+class _Handoff(object):
+    """
+    Passes the stream of an edge from the thread reading it off the
+    transport to the one receiving it: a few strings at a time, or through
+    a spool file in `spool_dir' if `spooled', for an edge read ahead of
+    its receive.  The spool file is read as it is written.
+    """
+    live_buffers = 4
+
+    def __init__(self, spool_dir=None, spooled=False):
+        self._cond = threading.Condition()
+        self._bufs = deque()
+        self._unread = 0
+        self._done = False
+        self._error = None
+        self._abandoned = None
+        self._spool = None
+        if spooled:
+            fd, path = tempfile.mkstemp(dir=spool_dir)
+            self._spool = os.fdopen(fd, 'wb')
+            self._spooled = open(path, 'rb')
+            os.unlink(path)
+
+    def put(self, buf):
+        """Raises what the receive failed with, if it did."""
+        if self._spool is not None:
+            self._spool.write(buf)
+            self._spool.flush()
+        with self._cond:
+            while (self._spool is None and self._abandoned is None and
+                    len(self._bufs) >= self.live_buffers):
+                self._cond.wait()
+            if self._abandoned is not None:
+                raise self._abandoned
+            if self._spool is None:
+                self._bufs.append(buf)
+            self._unread += len(buf)
+            self._cond.notify_all()
+
+    def close(self, error=None):
+        """Ends the stream, or fails the receive with `error'."""
+        if self._spool is not None:
+            self._spool.close()
+        with self._cond:
+            if self._done:
+                return
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+    def abandon(self, error):
+        """Tells the reading thread the receive failed with `error'."""
+        with self._cond:
+            self._abandoned = error
+            self._cond.notify_all()
+
+    def chunks(self):
+        """Yields the stream as it comes in."""
+        try:
+            while True:
+                with self._cond:
+                    while not (self._unread or self._done):
+                        self._cond.wait()
+                    if self._error is not None:
+                        raise self._error
+                    if not self._unread:
+                        return
+                    unread, self._unread = self._unread, 0
+                    if self._spool is None:
+                        buf = self._bufs.popleft()
+                        self._unread = unread - len(buf)
+                    self._cond.notify_all()
+                if self._spool is None:
+                    yield buf
+                    continue
+                while unread:
+                    buf = self._spooled.read(min(unread, piece_size))
+                    unread -= len(buf)
+                    yield buf
+        finally:
+            if self._spool is not None:
+                self._spooled.close()
+
+
+def restore_io(storage_driver, subprocess, target, compression=None,
+               hash_mode=None, spool_dir=None, encryption=None):
+    """
+    Restores the node `target' from the server on `subprocess' into the
+    local snapshot directory.  Each edge is verified as it is streamed
+    into `btrfs receive', except that one fetched while the edge before it
+    is still being received goes through a spool file in `spool_dir'.
+    Edges sent encrypted are decrypted with the StreamKey `encryption'.
+    """
+    write_framed = partial(common.write_framed, '!I', subprocess.stdin)
+    read_framed = partial(common.read_framed, '!I', subprocess.stdout)
+
+    request = wire_pb2.GraphRequest()
+    request.roots.append(target)
+    request.sizes = True
+    subprocess.stdin.write(common.restore_magic_number)
+    write_framed(request.SerializeToString())
+    graph = wire_pb2.Graph()
+    graph.ParseFromString(read_framed())
+    codec = choose_codec(compression, graph.compression)
+    hash_mode = choose_hash_mode(hash_mode, graph.hash_modes)
+
+    chain = restore_chain(graph, target, storage_driver.get_local_nodes())
+    restore_request = wire_pb2.RestoreRequest()
+    for from_node, to_node in chain:
+        edge = restore_request.chain.add()
+        edge.from_node = from_node
+        edge.to_node = to_node
+    if codec is not None:
+        restore_request.compression = codec.name
+    if hash_mode is not DEFAULT_HASH_MODE:
+        restore_request.hash_mode = hash_mode.name
+    write_framed(restore_request.SerializeToString())
     subprocess.stdin.close()
+
+    failed = threading.Event()
+
+    def _receive(handoff, (from_node, to_node)):
+        if failed.is_set():
+            return
+        print >> sys.stderr, "restoring: %s->%s" % (from_node, to_node)
+        try:
+            storage_driver.receive(handoff.chunks())
+        except Exception as e:
+            handoff.abandon(e)
+            raise
+
+    # edges are received in order, on a thread of their own; the transport
+    # is read at most one edge ahead of the receive in progress
+    receiver = ThreadPool(1)
+    receiving = deque()  # (AsyncResult, _Handoff) of edges not received
+    try:
+        for edge in chain:
+            while receiving and (len(receiving) > 1 or
+                                 receiving[0][0].ready()):
+                receiving.popleft()[0].get()
+            handoff = _Handoff(spool_dir, spooled=bool(receiving))
+            receiving.append(
+                (receiver.apply_async(_receive, (handoff, edge)), handoff)
+            )
+            pieces = yield_input_pieces(
+                subprocess.stdout,
+                codec,
+                hash_mode=hash_mode
+            )
+            for buf in _restored(pieces, edge, encryption):
+                handoff.put(buf)
+            handoff.close()
+        while receiving:
+            receiving.popleft()[0].get()
+    except Exception as e:
+        # an edge fully read is still received, the rest are not started
+        failed.set()
+        for _, handoff in receiving:
+            handoff.close(e)
+        raise
+    finally:
+        receiver.close()
+        receiver.join()
+
+    subprocess.stdout.close()
     subprocess.wait()
 
-    policy.clean_local_nodes(storage_driver)
+
+def read_manifest(fh):
+    """
+    Parses a batch manifest: one `SUBVOLUME SNAPSHOT_DIR POOL' per line,
+    with shell-style quoting.  Blank lines and `#' comments are skipped.
+    """
+    jobs = []
+    for line in fh:
+        fields = shlex.split(line, comments=True)
+        if not fields:
+            continue
+        if len(fields) != 3:
+            raise ValueError("Invalid manifest line: %r" % line)
+        jobs.append(tuple(fields))
+    return jobs
+
+
+def batch_client_io(jobs, selection_constructor, subprocess, concurrency=4,
+                    **kwargs):
+    """
+    Runs client_io for each (storage_driver, pool, options) in `jobs', all
+    over the one transport `subprocess' and at most `concurrency' at a
+    time.  `options' are keyword arguments for that job's client_io, on top
+    of `kwargs', and may replace its `selection_constructor'.  Returns
+    (pool, exception or None) for every job, in order.
+    """
+    mux = Multiplexer(subprocess.stdout, subprocess.stdin)
+    mux.start_client()
+
+    def _run((storage_driver, pool, options)):
+        channel = mux.open_channel()
+        try:
+            common.write_framed('!I', channel.stdin, pool)
+            options = dict(kwargs, **options)
+            client_io(
+                storage_driver,
+                options.pop('selection_constructor', selection_constructor),
+                channel,
+                **options
+            )
+            status = channel.wait()
+            if status != 0:
+                raise SessionFailed(pool, status)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return pool, e
+        return pool, None
+
+    workers = ThreadPool(concurrency)
+    try:
+        results = workers.map(_run, jobs)
+    finally:
+        workers.close()
+    mux.close()
+    subprocess.wait()
+    return results
@@ -1,7 +1,40 @@
+import sys
+import time
+import Queue
 import struct
+import threading
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 magic_number = "\xa8\x5b\x4b\x2b\x1b\xf7\x4c\x0a"
+# like magic_number, but followed by a framed GraphRequest
+sync_magic_number = "\xa8\x5b\x4b\x2b\x1b\xf7\x4c\x0b"
+# starts a restore session; also followed by a framed GraphRequest
+restore_magic_number = "\xa8\x5b\x4b\x2b\x1b\xf7\x4c\x0c"
+
+
+class TruncatedRead(EOFError):
+    pass
+
+
+def read_exact(fh, size):
+    """
+    Reads `size' bytes, however many reads that takes; pipes and sockets
+    may return less than asked for.  Raises TruncatedRead at EOF.
+    """
+    chunks = []
+    left = size
+    while left:
+        buf = fh.read(left)
+        if not buf:
+            raise TruncatedRead(
+                "Stream ended after %d of %d bytes" % (size - left, size))
+        chunks.append(buf)
+        left -= len(buf)
+    return b''.join(chunks)
 
 
 def write_framed(pack_format, fh, buf):
@@ -9,5 +42,213 @@ def write_framed(pack_format, fh, buf):
 
 
 def read_framed(pack_format, fh):
-    header = fh.read(struct.calcsize(pack_format))
-    return fh.read(struct.unpack(pack_format, header)[0])
+    header = read_exact(fh, struct.calcsize(pack_format))
+    return read_exact(fh, struct.unpack(pack_format, header)[0])
+
+
+def default_workers():
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def bounded_imap(func, iterable, workers=None, depth=None):
+    """
+    Like itertools.imap, but runs `func' on a pool of `workers' threads.
+
+    Results come back in input order and at most `depth' items are in
+    flight at once, so memory stays bounded no matter how long the input
+    is.  Only useful when `func' releases the GIL (zlib, hashlib, ...).
+    """
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    if depth is None:
+        depth = 2 * workers
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def threaded(iterable, depth=4):
+    """
+    Runs `iterable' on its own thread, at most `depth' items ahead of the
+    consumer.  Exceptions raised by `iterable' are re-raised in the consumer.
+    """
+    queue = Queue.Queue(depth)
+    queue_full = Queue.Full
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except queue_full:
+                pass
+        return False
+
+    def _run():
+        try:
+            for item in iterable:
+                if not _put((True, item)):
+                    return
+        except:
+            _put((False, sys.exc_info()))
+        else:
+            _put((False, None))
+
+    thread = threading.Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if ok:
+                yield item
+            elif item is None:
+                break
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        stop.set()
+
+
+class IterableReader(object):
+    """A file-like reader over the strings `iterable' yields."""
+    def __init__(self, iterable):
+        self._chunks = iter(iterable)
+        self._buf = b''
+
+    def read(self, size):
+        chunks = []
+        while size:
+            if not self._buf:
+                self._buf = next(self._chunks, b'')
+                if not self._buf:
+                    break
+            if len(self._buf) <= size:
+                chunk, self._buf = self._buf, b''
+            else:
+                chunk, self._buf = self._buf[:size], self._buf[size:]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+
+class Watchdog(object):
+    """
+    Calls `expire' once a read or write on the streams it watches has
+    been waiting `timeout' seconds with none of them getting anywhere.
+    Time spent between reads and writes does not count.
+    """
+    def __init__(self, timeout, expire):
+        self._timeout = timeout
+        self._expire = expire
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._since = time.time()
+        self._stopped = threading.Event()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(min(self._timeout, 1.0)):
+            with self._lock:
+                stalled = (self._waiting and
+                           time.time() - self._since > self._timeout)
+            if stalled:
+                self._expire()
+                return
+
+    @contextmanager
+    def waiting(self):
+        with self._lock:
+            if not self._waiting:
+                self._since = time.time()
+            self._waiting += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                self._since = time.time()
+
+    def stop(self):
+        self._stopped.set()
+
+    def reader(self, fh):
+        return _WatchedReader(fh, self)
+
+    def writer(self, fh):
+        return _WatchedWriter(fh, self)
+
+
+class _WatchedReader(object):
+    # no peek: splicing would move data past the watchdog
+    def __init__(self, fh, watchdog):
+        self._fh = fh
+        self._watchdog = watchdog
+
+    def read(self, size=-1):
+        with self._watchdog.waiting():
+            return self._fh.read(size)
+
+    def readinto(self, view):
+        with self._watchdog.waiting():
+            return self._fh.readinto(view)
+
+    def close(self):
+        self._fh.close()
+
+
+class _WatchedWriter(object):
+    def __init__(self, fh, watchdog):
+        self._fh = fh
+        self._watchdog = watchdog
+
+    def write(self, buf):
+        with self._watchdog.waiting():
+            self._fh.write(buf)
+
+    def flush(self):
+        with self._watchdog.waiting():
+            self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+
+class WatchedProcess(object):
+    """
+    A subprocess.Popen with pipes to a server, killed once reading from or
+    writing to it has got nowhere for `timeout' seconds.
+    """
+    def __init__(self, process, timeout):
+        self._process = process
+        self._timeout = timeout
+        self._watchdog = Watchdog(timeout, self._expire)
+        self.stdin = self._watchdog.writer(process.stdin)
+        self.stdout = self._watchdog.reader(process.stdout)
+
+    def _expire(self):
+        print >> sys.stderr, "Transport stalled for %d seconds, giving up" % (
+            self._timeout)
+        self._process.kill()
+
+    def wait(self):
+        self._watchdog.stop()
+        return self._process.wait()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""
+Per-piece compression for the reliable encapsulation.
+
+Every piece is compressed on its own, so pieces can be (de)compressed on
+a pool of threads.  The running hash always covers the uncompressed
+data, which lets the server verify a stream no matter how it was
+encoded on the wire or how it is kept on disk.
+
+Stored layout for compressed edges:
+    while we have data:
+        a 32 bit integer, network byte order specifying the size `n'
+        n bytes of compressed piece
+    a zero size terminates the file
+"""
+import zlib
+import struct
+
+from . import common
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class UnknownCodec(ValueError):
+    pass
+
+
+class Codec(object):
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return 'Codec(%r)' % self.name
+
+
+def _as_string(buf):
+    # zlib on Python 2 only takes strings, not memoryviews
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return buf
+
+
+def _zlib_compress(buf):
+    return zlib.compress(_as_string(buf), 6)
+
+
+def _zlib_decompress(buf):
+    return zlib.decompress(_as_string(buf))
+
+
+def _zstd_compress(buf):
+    return zstandard.ZstdCompressor(level=3).compress(buf)
+
+
+def _zstd_decompress(buf):
+    return zstandard.ZstdDecompressor().decompress(buf)
+
+
+# In order of preference.
+CODECS = []
+if zstandard is not None:
+    CODECS.append(Codec('zstd', _zstd_compress, _zstd_decompress))
+if lz4 is not None:
+    CODECS.append(Codec('lz4', lz4.frame.compress, lz4.frame.decompress))
+CODECS.append(Codec('zlib', _zlib_compress, _zlib_decompress))
+
+_CODECS_BY_NAME = dict((codec.name, codec) for codec in CODECS)
+
+
+def available_codecs():
+    return [codec.name for codec in CODECS]
+
+
+def get_codec(name):
+    try:
+        return _CODECS_BY_NAME[name]
+    except KeyError:
+        raise UnknownCodec(name)
+
+
+def choose_codec(preference, offered):
+    """
+    Pick the codec for an edge.  `preference' is None (no compression),
+    'auto' (the first codec `offered' by the server that we also
+    have) or a codec name, which is only honoured if the server offers it.
+    """
+    if preference is None:
+        return None
+    for name in offered:
+        if name not in _CODECS_BY_NAME:
+            continue
+        if preference in ('auto', name):
+            return _CODECS_BY_NAME[name]
+    return None
+
+
+def compress_pieces(codec, pieces, workers=None):
+    """Yields (piece, compressed_piece); empty pieces stay empty."""
+    def _compress(buf):
+        return buf, codec.compress(buf) if buf else buf
+    return common.bounded_imap(_compress, pieces, workers)
+
+
+def decompress_pieces(codec, payloads, workers=None):
+    """Yields (piece, compressed_piece); empty payloads stay empty."""
+    def _decompress(payload):
+        return codec.decompress(payload) if payload else payload, payload
+    return common.bounded_imap(_decompress, payloads, workers)
+
+
+class CompressedWriter(object):
+    def __init__(self, fh, codec):
+        self._fh = fh
+        self.codec = codec
+
+    def write(self, buf):
+        if buf:
+            self.write_encoded(self.codec.compress(buf))
+
+    def write_encoded(self, payload):
+        if payload:
+            self._fh.write(struct.pack('!I', len(payload)))
+            self._fh.write(payload)
+
+    def close(self):
+        common.write_framed('!I', self._fh, b'')
+
+
+def read_encoded(fh):
+    while True:
+        payload = common.read_framed('!I', fh)
+        if not payload:
+            break
+        yield payload
+
+
+def read_compressed(fh, codec, workers=None):
+    for piece, _ in decompress_pieces(codec, read_encoded(fh), workers):
+        yield piece
+
+
+class CompressedReader(common.IterableReader):
+    """Reads the uncompressed data of a file CompressedWriter wrote."""
+    def __init__(self, fh, codec, workers=None):
+        super(CompressedReader, self).__init__(
+            read_compressed(fh, codec, workers)
+        )
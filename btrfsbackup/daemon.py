@@ -0,0 +1,78 @@
+#!/usr/bin/python
+"""
+Long-running servers: accept connections on a Unix or TCP socket and run a
+session handler for each of them on its own thread.  A thread blocked on
+a dead peer only holds its own session up, and is freed by the timeout.
+"""
+import io
+import os
+import sys
+import socket
+import threading
+import traceback
+from functools import partial
+
+from . import common
+
+
+def listen(address):
+    """
+    Listens on `address': a path for a Unix socket (anything with a `/'
+    in it), otherwise HOST:PORT for TCP.
+    """
+    if '/' in address:
+        if os.path.exists(address):
+            os.unlink(address)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+    else:
+        host, port = address.rsplit(':', 1)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+    listener.listen(128)
+    return listener
+
+
+def _hang_up(connection, timeout):
+    print >> sys.stderr, "Client stalled for %d seconds, hanging up" % (
+        timeout)
+    # wakes the session's blocked reads and writes
+    connection.shutdown(socket.SHUT_RDWR)
+
+
+def _handle(handler, connection, timeout):
+    instream = io.open(connection.fileno(), 'rb', closefd=False)
+    outstream = io.open(connection.fileno(), 'wb', closefd=False)
+    watchdog = None
+    if timeout:
+        watchdog = common.Watchdog(
+            timeout, partial(_hang_up, connection, timeout)
+        )
+        instream = watchdog.reader(instream)
+        outstream = watchdog.writer(outstream)
+    try:
+        handler(instream, outstream)
+        outstream.flush()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        if watchdog is not None:
+            watchdog.stop()
+        connection.close()
+
+
+def serve(listener, handler, timeout=None):
+    """
+    Calls handler(instream, outstream) for every connection, forever.
+    A session whose reads or writes get nowhere for `timeout' seconds is
+    hung up on.
+    """
+    while True:
+        connection, _ = listener.accept()
+        session = threading.Thread(
+            target=_handle,
+            args=(handler, connection, timeout)
+        )
+        session.daemon = True
+        session.start()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+"""
+Client-side encryption of send streams, so that the server only ever
+holds ciphertext.
+
+An encrypted stream is what the client frames and sends in place of the
+`btrfs send' stream:
+    8 bytes     "bbaead01"
+    8 bits      the cipher: 1 for AES-256-GCM, 2 for ChaCha20-Poly1305
+    8 bits      the size of the codec name, then the name ("" for none)
+    16 bytes    a random salt
+    for every piece, the last one empty:
+        a 32 bit integer, network byte order: the size of the record
+        8 bits: 1 for the last record, 0 otherwise
+        the piece, compressed with the codec, sealed with the cipher
+
+The key of a stream is derived with HKDF-SHA256 from the user's key, the
+names of the edge's nodes and the header above, so a stream cannot pass
+for another edge's and one whose header was tampered with opens no
+record.  The nonce of a record is its index, and the index and the last
+flag are authenticated along with it, so records cannot be reordered,
+dropped or cut off at the end.  Every record is sealed and
+opened on its own, on a pool of threads.
+
+The stream is opaque to the server, which verifies and stores it like any
+other; a per-piece hash mode lets it do that in parallel too.
+"""
+import os
+import struct
+
+from .reliable_rw import IntegrityError, piece_size
+from .compression import get_codec
+from .common import IterableReader, bounded_imap, threaded
+
+magic = 'bbaead01'
+key_size = 32
+salt_size = 16
+_record_header = '!IB'
+
+# cipher name -> (id in the stream header, AEAD class in cryptography)
+CIPHERS = {
+    'aes-gcm': (1, 'AESGCM'),
+    'chacha20-poly1305': (2, 'ChaCha20Poly1305'),
+}
+_CIPHERS_BY_ID = dict((value[0], name) for name, value in CIPHERS.items())
+
+
+class UnknownCipher(ValueError):
+    pass
+
+
+def read_key(path):
+    """Reads a key file: 32 bytes, or 64 hex digits."""
+    with open(path, 'rb') as fh:
+        key = fh.read()
+    if len(key.strip()) == 2 * key_size:
+        try:
+            key = key.strip().decode('hex')
+        except TypeError:
+            pass
+    if len(key) != key_size:
+        raise ValueError("A key is %d bytes or %d hex digits: %s" % (
+            key_size, 2 * key_size, path))
+    return key
+
+
+def _pieces(input_file):
+    while True:
+        buf = input_file.read(piece_size)
+        yield buf
+        if not buf:
+            break
+
+
+def _nonce(index):
+    return struct.pack('!IQ', 0, index)
+
+
+def _header(cipher, codec_name, salt):
+    return ''.join([
+        magic,
+        struct.pack('!BB', CIPHERS[cipher][0], len(codec_name)),
+        codec_name,
+        salt
+    ])
+
+
+def _aad(index, last):
+    return struct.pack('!Q?', index, last)
+
+
+def _as_string(buf):
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return buf
+
+
+def is_encrypted(head):
+    """Whether a stream starting with `head' is an encrypted stream."""
+    return head.startswith(magic)
+
+
+class StreamKey(object):
+    """The user's `key', used with the cipher named `cipher'."""
+    def __init__(self, key, cipher='aes-gcm'):
+        if cipher not in CIPHERS:
+            raise UnknownCipher(cipher)
+        self._key = key
+        self.cipher = cipher
+
+    def _aead(self, cipher, codec_name, salt, from_node, to_node):
+        # cryptography is only imported once a stream is sealed or opened
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers import aead
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        # the whole stream header goes into the key, so tampering with it
+        # fails every record
+        subkey = HKDF(
+            algorithm=hashes.SHA256(),
+            length=key_size,
+            salt=salt,
+            info=(u'btrfs-backup\0%s\0%s\0' % (
+                from_node, to_node)).encode('utf-8') +
+            _header(cipher, codec_name, salt),
+            backend=default_backend()
+        ).derive(self._key)
+        return getattr(aead, CIPHERS[cipher][1])(subkey)
+
+    def encrypt(self, input_file, from_node, to_node, codec=None,
+                workers=None):
+        """
+        A reader of the encrypted stream of the edge (`from_node',
+        `to_node') whose send stream is `input_file'.  Pieces are
+        compressed with `codec' and sealed on a pool of `workers'.
+        """
+        salt = os.urandom(salt_size)
+        codec_name = codec.name if codec is not None else ''
+        aead = self._aead(self.cipher, codec_name, salt, from_node, to_node)
+
+        def _seal((index, buf)):
+            last = not buf
+            payload = codec.compress(buf) if codec and buf else buf
+            sealed = aead.encrypt(
+                _nonce(index), _as_string(payload), _aad(index, last)
+            )
+            return struct.pack(_record_header, len(sealed), last) + sealed
+
+        def _records():
+            yield _header(self.cipher, codec_name, salt)
+            pieces = enumerate(threaded(_pieces(input_file)))
+            for record in bounded_imap(_seal, pieces, workers):
+                yield record
+        return IterableReader(_records())
+
+    def decrypt(self, input_file, from_node, to_node, workers=None):
+        """
+        A reader of the send stream in the encrypted stream `input_file'
+        of the edge (`from_node', `to_node'), opened on a pool of
+        `workers'.  Reading it raises IntegrityError on any tampering.
+        """
+        from cryptography.exceptions import InvalidTag
+
+        def _read_exact(size):
+            buf = input_file.read(size)
+            if len(buf) != size:
+                raise IntegrityError("Encrypted stream is truncated")
+            return buf
+
+        def _plain():
+            if _read_exact(len(magic)) != magic:
+                raise IntegrityError("Not an encrypted stream")
+            cipher_id, name_size = struct.unpack('!BB', _read_exact(2))
+            if cipher_id not in _CIPHERS_BY_ID:
+                raise UnknownCipher(cipher_id)
+            codec_name = _read_exact(name_size)
+            codec = get_codec(codec_name) if codec_name else None
+            aead = self._aead(
+                _CIPHERS_BY_ID[cipher_id],
+                codec_name,
+                _read_exact(salt_size),
+                from_node,
+                to_node
+            )
+
+            def _records():
+                header_size = struct.calcsize(_record_header)
+                index = 0
+                while True:
+                    size, last = struct.unpack(
+                        _record_header, _read_exact(header_size)
+                    )
+                    yield index, _read_exact(size), bool(last)
+                    if last:
+                        break
+                    index += 1
+
+            def _open((index, sealed, last)):
+                try:
+                    payload = aead.decrypt(
+                        _nonce(index), sealed, _aad(index, last)
+                    )
+                except InvalidTag:
+                    raise IntegrityError(
+                        "Piece %d of the encrypted stream is damaged" % index
+                    )
+                if codec is not None and payload:
+                    return codec.decompress(payload)
+                return payload
+
+            for buf in bounded_imap(_open, _records(), workers):
+                # an empty string would end the reader early
+                if buf:
+                    yield buf
+            if input_file.read(1):
+                raise IntegrityError("Data after the encrypted stream")
+        return IterableReader(_plain())
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+"""
+Thin wrappers around Linux system calls that Python 2 does not expose.
+Each wrapper is None where the platform lacks the call, so callers can
+fall back to plain reads and writes.
+"""
+import os
+import stat
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+
+def _load_libc():
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    try:
+        return ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+
+
+_libc = _load_libc()
+
+
+def _check(result):
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+if hasattr(os, 'splice'):
+    def _splice(fd_in, fd_out, count):
+        return os.splice(fd_in, fd_out, count,
+                         flags=SPLICE_F_MOVE | SPLICE_F_MORE)
+elif _libc is not None and hasattr(_libc, 'splice'):
+    _libc.splice.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint
+    ]
+    _libc.splice.restype = ctypes.c_ssize_t
+
+    def _splice(fd_in, fd_out, count):
+        return _check(_libc.splice(
+            fd_in, None, fd_out, None, count, SPLICE_F_MOVE | SPLICE_F_MORE
+        ))
+else:
+    _splice = None
+
+
+def can_splice(fd_in):
+    """splice(2) needs a pipe on one end; our output is always a file."""
+    return _splice is not None and stat.S_ISFIFO(os.fstat(fd_in).st_mode)
+
+
+def splice(fd_in, fd_out, count):
+    """
+    Moves `count' bytes from the pipe `fd_in' to `fd_out' without copying
+    them through user space.  Returns the number of bytes moved, which is
+    only short at end of file.
+    """
+    total = 0
+    while total < count:
+        moved = _splice(fd_in, fd_out, count - total)
+        if not moved:
+            break
+        total += moved
+    return total
+
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def _libc_call(names, argtypes):
+    """The first of `names' libc has, taking `argtypes', or None."""
+    for name in names:
+        if _libc is not None and hasattr(_libc, name):
+            func = getattr(_libc, name)
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int
+            return func
+    return None
+
+
+_off_t = ctypes.c_longlong
+_posix_fadvise = _libc_call(
+    ['posix_fadvise64', 'posix_fadvise'],
+    [ctypes.c_int, _off_t, _off_t, ctypes.c_int]
+)
+_sync_file_range = _libc_call(
+    ['sync_file_range'],
+    [ctypes.c_int, _off_t, _off_t, ctypes.c_uint]
+)
+_fallocate = _libc_call(
+    ['fallocate64', 'fallocate'],
+    [ctypes.c_int, ctypes.c_int, _off_t, _off_t]
+)
+
+
+if _posix_fadvise is not None:
+    def fadvise(fd, offset, length, advice):
+        # returns the error number rather than setting errno
+        error = _posix_fadvise(fd, offset, length, advice)
+        if error:
+            raise OSError(error, os.strerror(error))
+else:
+    fadvise = None
+
+if _sync_file_range is not None:
+    def sync_file_range(fd, offset, length, flags):
+        _check(_sync_file_range(fd, offset, length, flags))
+else:
+    sync_file_range = None
+
+if _fallocate is not None:
+    def fallocate(fd, offset, length, mode=FALLOC_FL_KEEP_SIZE):
+        _check(_fallocate(fd, mode, offset, length))
+else:
+    fallocate = None
+
+
+def drop_cache(fd):
+    """Drops the written back pages of `fd' from the page cache."""
+    if fadvise is not None:
+        try:
+            fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def fsync_directory(path):
+    """Makes the entries of the directory `path', renames too, durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Writeback(object):
+    """
+    Keeps the data written to `fd' past `offset' from piling up in the page
+    cache: on a thread of its own, starts writing back every `window'
+    bytes once they are written, then waits for the window before it and
+    drops it from the cache.  A final fsync then has little left to do.
+    """
+    window = 8 * 1024 ** 2
+    interval = 0.25
+
+    def __init__(self, fd, offset=0):
+        self._fd = fd
+        self._offset = offset
+        self._previous = None
+        self._stop = threading.Event()
+        self._thread = None
+        if sync_file_range is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                self._advance()
+        except OSError:
+            # the filesystem will not have it; the fsync does it all
+            pass
+
+    def _advance(self):
+        size = os.fstat(self._fd).st_size
+        while size - self._offset >= self.window:
+            sync_file_range(
+                self._fd, self._offset, self.window, SYNC_FILE_RANGE_WRITE
+            )
+            if self._previous is not None:
+                sync_file_range(
+                    self._fd, self._previous, self.window,
+                    SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                    SYNC_FILE_RANGE_WAIT_AFTER
+                )
+                if fadvise is not None:
+                    fadvise(
+                        self._fd, self._previous, self.window,
+                        POSIX_FADV_DONTNEED
+                    )
+            self._previous = self._offset
+            self._offset += self.window
+
+    def stop(self):
+        """Stops the thread; `fd' must stay open until this returns."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_CLOEXEC = 0o2000000
+
+_inotify_event = struct.Struct('=iIII')
+
+inotify_available = _libc is not None and hasattr(_libc, 'inotify_init1')
+
+
+class Inotify(object):
+    def __init__(self):
+        self._fd = _check(_libc.inotify_init1(IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        return _check(_libc.inotify_add_watch(self._fd, path, mask))
+
+    def read_events(self):
+        """Blocks until there are events; returns (mask, name) for each."""
+        buf = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = _inotify_event.unpack_from(buf, offset)
+            offset += _inotify_event.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self._fd)
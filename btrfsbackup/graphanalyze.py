@@ -1,4 +1,7 @@
 #!/usr/bin/python
+import time
+import heapq
+from collections import deque, namedtuple
 from datetime import datetime
 
 
@@ -7,61 +10,228 @@ class PathNotFound(Exception):
 
 
 class DirectedGraph(object):
+    """
+    The backup graph.  Nodes are interned to integer ids once and every
+    algorithm works on the id adjacency lists, iteratively, so graphs of
+    years of backups need neither deep recursion nor repeated walks.
+    """
     ROOT_NODE = 'FULL'
 
-    @classmethod
-    def make_node_dict(cls, graph):
-        out = dict()
-        for edge in graph.edges:
-            if edge.from_node not in out:
-                out[edge.from_node] = []
-            out[edge.from_node].append(edge.to_node)
-        return out
-
-    @classmethod
-    def make_inverted_node_dict(cls, graph):
-        out = dict()
-        for edge in graph.edges:
-            if edge.to_node not in out:
-                out[edge.to_node] = []
-            out[edge.to_node].append(edge.from_node)
-        return out
-
     def __init__(self, graph):
-        self._forward = self.make_node_dict(graph)
-        self._reverse = self.make_inverted_node_dict(graph)
-
-    def _height_helper(self, from_subroot):
-        children = self._forward.get(from_subroot, [])
-        if not children:
-            return 0
-        return 1 + max(self._height_helper(child) for child in children)
+        self._ids = {}
+        self._names = []
+        self._children = []
+        self._parents = []
+        self._node_id(self.ROOT_NODE)
+        for edge in graph.edges:
+            from_id = self._node_id(edge.from_node)
+            to_id = self._node_id(edge.to_node)
+            self._children[from_id].append(to_id)
+            self._parents[to_id].append(from_id)
+        self._heights = None
+
+    def _node_id(self, node_name):
+        node_id = self._ids.get(node_name)
+        if node_id is None:
+            node_id = self._ids[node_name] = len(self._names)
+            self._names.append(node_name)
+            self._children.append([])
+            self._parents.append([])
+        return node_id
+
+    def children(self, node_name):
+        node_id = self._ids.get(node_name)
+        if node_id is None:
+            return []
+        return [self._names[child] for child in self._children[node_id]]
+
+    def parents(self, node_name):
+        node_id = self._ids.get(node_name)
+        if node_id is None:
+            return []
+        return [self._names[parent] for parent in self._parents[node_id]]
+
+    def backed_up_nodes(self):
+        """Nodes that are the target of at least one edge."""
+        return set(
+            self._names[node_id]
+            for node_id, parents in enumerate(self._parents) if parents
+        )
+
+    def edges(self):
+        """Yields every edge as (from_node, to_node)."""
+        for node_id, children in enumerate(self._children):
+            for child in children:
+                yield self._names[node_id], self._names[child]
+
+    def ancestors(self, node_names):
+        """`node_names' and every node on a path from the root to them."""
+        seen = set(
+            self._ids[node_name] for node_name in node_names
+            if node_name in self._ids
+        )
+        pending = list(seen)
+        while pending:
+            for parent in self._parents[pending.pop()]:
+                if parent not in seen:
+                    seen.add(parent)
+                    pending.append(parent)
+        return set(self._names[node_id] for node_id in seen)
+
+    def _all_heights(self):
+        # breadth first from the root: the first time a node is reached is
+        # along one of its shortest paths
+        if self._heights is None:
+            heights = [None] * len(self._names)
+            root = self._ids[self.ROOT_NODE]
+            heights[root] = 0
+            queue = deque([root])
+            while queue:
+                node_id = queue.popleft()
+                for child in self._children[node_id]:
+                    if heights[child] is None:
+                        heights[child] = heights[node_id] + 1
+                        queue.append(child)
+            self._heights = heights
+        return self._heights
+
+    def node_heights(self):
+        """Maps every node reachable from the root to its node_height."""
+        return dict(
+            (self._names[node_id], height)
+            for node_id, height in enumerate(self._all_heights())
+            if height is not None
+        )
+
+    def distances(self, weight):
+        """
+        Maps every node reachable from the root to the cost of its cheapest
+        path from the root, where weight(from_node, to_node) is the cost of
+        an edge.
+        """
+        root = self._ids[self.ROOT_NODE]
+        costs = {root: 0}
+        heap = [(0, root)]
+        done = set()
+        while heap:
+            cost, node_id = heapq.heappop(heap)
+            if node_id in done:
+                continue
+            done.add(node_id)
+            for child in self._children[node_id]:
+                child_cost = cost + weight(
+                    self._names[node_id],
+                    self._names[child]
+                )
+                if child not in costs or child_cost < costs[child]:
+                    costs[child] = child_cost
+                    heapq.heappush(heap, (child_cost, child))
+        return dict(
+            (self._names[node_id], cost) for node_id, cost in costs.items()
+        )
 
     def height(self):
-        return self._height_helper('FULL')
+        """The length of the longest path from the root."""
+        # longest paths in topological order, over the nodes reachable from
+        # the root; nodes on a cycle are never released and do not count
+        reachable = self._all_heights()
+        pending = [0] * len(self._names)
+        for node_id, children in enumerate(self._children):
+            if reachable[node_id] is not None:
+                for child in children:
+                    pending[child] += 1
+        longest = [0] * len(self._names)
+        ready = [self._ids[self.ROOT_NODE]]
+        height = 0
+        while ready:
+            node_id = ready.pop()
+            height = max(height, longest[node_id])
+            for child in self._children[node_id]:
+                longest[child] = max(longest[child], longest[node_id] + 1)
+                pending[child] -= 1
+                if not pending[child]:
+                    ready.append(child)
+        return height
 
     def node_height(self, node_name):
-        if node_name == 'FULL':
-            return 0
-        return 1 + min(map(self.node_height, self._reverse[node_name]))
+        """The number of edges on the shortest path from the root."""
+        node_id = self._ids.get(node_name)
+        height = None if node_id is None else self._all_heights()[node_id]
+        if height is None:
+            raise PathNotFound(node_name)
+        return height
 
     def paths_from(self, source):
-        parents = self._reverse.get(source, [])
-        for parent in parents:
-            for path in self.paths_from(parent):
-                yield [source] + path
-        yield [source]
-
-    def min_path(self, source, target):
-        print "searching: %s->%s" % (source, target)
-        try:
-            return min(
-                (len(path) - 1, path)
-                for path in self.paths_from(source)
-                if path[-1] == target
-            )[1]
-        except ValueError:
+        """Yields every path from `source' up its parents, `source' first."""
+        if source not in self._ids:
+            yield [source]
+            return
+        stack = [[self._ids[source]]]
+        while stack:
+            path = stack.pop()
+            for parent in self._parents[path[-1]]:
+                stack.append(path + [parent])
+            yield [self._names[node_id] for node_id in path]
+
+    def min_path(self, source, target, weight=None):
+        """
+        The shortest path from `source' up its parents to `target', as a
+        list of node names starting with `source'.  Without `weight' every
+        edge counts as one; otherwise weight(from_node, to_node) gives the
+        cost of each edge.
+        """
+        if source not in self._ids or target not in self._ids:
+            if source == target:
+                return [source]
+            raise PathNotFound
+        source_id, target_id = self._ids[source], self._ids[target]
+        previous = {source_id: None}
+        if weight is None:
+            queue = deque([source_id])
+            while queue and target_id not in previous:
+                node_id = queue.popleft()
+                for parent in self._parents[node_id]:
+                    if parent not in previous:
+                        previous[parent] = node_id
+                        queue.append(parent)
+        else:
+            costs = {source_id: 0}
+            heap = [(0, source_id)]
+            done = set()
+            while heap:
+                cost, node_id = heapq.heappop(heap)
+                if node_id in done:
+                    continue
+                done.add(node_id)
+                if node_id == target_id:
+                    break
+                for parent in self._parents[node_id]:
+                    parent_cost = cost + weight(
+                        self._names[parent],
+                        self._names[node_id]
+                    )
+                    if parent not in costs or parent_cost < costs[parent]:
+                        costs[parent] = parent_cost
+                        previous[parent] = node_id
+                        heapq.heappush(heap, (parent_cost, parent))
+        if target_id not in previous:
             raise PathNotFound
+        path = []
+        node_id = target_id
+        while node_id is not None:
+            path.append(self._names[node_id])
+            node_id = previous[node_id]
+        path.reverse()
+        return path
+
+
+_Edge = namedtuple('_Edge', ['from_node', 'to_node'])
+_EdgeList = namedtuple('_EdgeList', ['edges'])
+
+
+def graph_of(edges):
+    """The DirectedGraph of (from_node, to_node) pairs."""
+    return DirectedGraph(_EdgeList([_Edge(*edge) for edge in edges]))
 
 
 class BackupDirectedGraph(DirectedGraph):
@@ -87,11 +257,13 @@ class BackupDirectedGraph(DirectedGraph):
     def __init__(self, graph, local_nodes):
         super(BackupDirectedGraph, self).__init__(graph)
         self._local_nodes = local_nodes
-        self._available_parents = set(self._local_nodes) & set(self._reverse)
+        self._available_parents = (
+            set(self._local_nodes) & self.backed_up_nodes()
+        )
 
     def clean_local_nodes(self, storage_driver):
         for node in sorted(self._local_nodes, reverse=True):
-            if self.MAX_CHILDREN <= len(self._forward.get(node, [])):
+            if self.MAX_CHILDREN <= len(self.children(node)):
                 storage_driver.delete_node(node)
                 self._local_nodes.remove(node)
 
@@ -104,7 +276,7 @@ class BackupDirectedGraph(DirectedGraph):
         for node in sorted(self._local_nodes, reverse=True):
             depth = len(self.min_path(node, self.ROOT_NODE)) - 1
             assert depth > 0
-            child_count = len(self._forward.get(node, []))
+            child_count = len(self.children(node))
             child_max = self.MAX_CHILDREN_FOR_DEPTH[depth]
             if child_count < child_max and depth < self.MAX_HEIGHT:
                 return node
@@ -162,46 +334,57 @@ class MonthWeekDayHourTree(DirectedGraph):
     def _serialize_node_name(cls, node_datetime):
         return node_datetime.isoformat()
 
+    # how long a local node at each height is kept as a parent
+    KEEP_WHILE = {
+        MONTHLY_DEPTH: _same_month,
+        WEEKLY_DEPTH: _same_week,
+        DAILY_DEPTH: _same_week,
+    }
+
+    # node name -> datetime, or None if it is not one; names never change
+    # meaning, so every policy of the process shares them
+    _parsed = {}
+
     @classmethod
     def _parse_node_name(cls, node_name):
         return datetime.strptime(node_name, "%Y-%m-%dT%H:%M:%S.%f")
 
+    @classmethod
+    def _node_time(cls, node_name):
+        if node_name not in cls._parsed:
+            try:
+                cls._parsed[node_name] = cls._parse_node_name(node_name)
+            except ValueError:
+                cls._parsed[node_name] = None
+        return cls._parsed[node_name]
+
     def __init__(self, graph, local_nodes):
         super(MonthWeekDayHourTree, self).__init__(graph)
-        # self._to_nodes = set(self._reverse)
-        # self._from_nodes = set(self._forward)
         self._local_nodes = set(local_nodes)
-        self._available_parents = set(self._reverse) & self._local_nodes
+        self._available_parents = self.backed_up_nodes() & self._local_nodes
         self._nodes_by_height = {}
+        self._parent_heights = {}
+        heights = self.node_heights()
         for parent in self._available_parents:
-            height = self.node_height(parent)
+            # a parent FULL cannot be reached from is useless for restores
+            height = heights.get(parent)
+            if height is None:
+                continue
+            self._parent_heights[parent] = height
             if height not in self._nodes_by_height:
                 self._nodes_by_height[height] = []
             self._nodes_by_height[height].append(parent)
 
     def clean_local_nodes(self, storage_driver):
         now = datetime.now()
-        local_nodes = set()
-        keep = set()
+        to_delete = []
         for node in self._local_nodes:
-            try:
-                node_obj = self._parse_node_name(node)
-            except ValueError:
+            node_obj = self._node_time(node)
+            if node_obj is None:
                 continue
-            local_nodes.add(node)
-            if self.MONTHLY_DEPTH in self._nodes_by_height:
-                if node in self._nodes_by_height[self.MONTHLY_DEPTH]:
-                    if _same_month(node_obj, now):
-                        keep.add(node)
-            if self.WEEKLY_DEPTH in self._nodes_by_height:
-                if node in self._nodes_by_height[self.WEEKLY_DEPTH]:
-                    if _same_week(node_obj, now):
-                        keep.add(node)
-            if self.DAILY_DEPTH in self._nodes_by_height:
-                if node in self._nodes_by_height[self.DAILY_DEPTH]:
-                    if _same_week(node_obj, now):
-                        keep.add(node)
-        to_delete = list(local_nodes - keep)
+            keep_while = self.KEEP_WHILE.get(self._parent_heights.get(node))
+            if keep_while is None or not keep_while(node_obj, now):
+                to_delete.append(node)
         if to_delete:
             storage_driver.delete_node(to_delete)
 
@@ -210,16 +393,217 @@ class MonthWeekDayHourTree(DirectedGraph):
             if depth in self._nodes_by_height:
                 candidates = list()
                 for parent in self._nodes_by_height[depth]:
-                    try:
-                        parent_obj = self._parse_node_name(parent)
-                    except ValueError:
-                        pass
-                    else:
-                        if self.ALLOW_CHILD[depth](parent_obj, now):
-                            candidates.append((parent_obj, parent))
+                    parent_obj = self._node_time(parent)
+                    if parent_obj is None:
+                        continue
+                    if self.ALLOW_CHILD[depth](parent_obj, now):
+                        candidates.append((parent_obj, parent))
                 if candidates:
                     return max(candidates)[1]
         return None
 
     def best_parent(self):
         return self._scan_for_parent(datetime.now())
+
+
+class CostAwarePolicy(DirectedGraph):
+    """
+    Picks the parent that minimizes the bytes to send now plus, weighted by
+    `chain_weight', the bytes a restore of the new node will have to fetch.
+
+    It wants the size and time of every edge from the server.  The size of
+    a new delta comes from `estimator(parent)' (parent None for a full
+    send), if given; otherwise it is extrapolated from how fast earlier
+    deltas grew with the time between their snapshots.  Edges whose size
+    is unknown (missing, or 0) count as the mean of the known ones, and a
+    delta that cannot be estimated as the mean known delta.  Of parents
+    that cost the same, the most recent is picked, and a full send last.
+    """
+    wants_edge_sizes = True
+    MAX_DEPTH = 8  # edges on the restore chain of a new node, at most
+    CANDIDATES = 8  # most recent local nodes considered as parents
+    KEEP_NODES = 8  # most recent backed up local nodes kept
+
+    @classmethod
+    def generate_node_name(cls):
+        return datetime.now().isoformat()
+
+    def __init__(self, graph, local_nodes, estimator=None, chain_weight=0.25):
+        super(CostAwarePolicy, self).__init__(graph)
+        self._local_nodes = set(local_nodes)
+        self._estimator = estimator
+        self._chain_weight = chain_weight
+        self._estimates = {}
+        self._sizes = {}
+        self._times = {}
+        for edge in graph.edges:
+            if edge.size:
+                self._sizes[edge.from_node, edge.to_node] = edge.size
+            if edge.HasField('timestamp'):
+                self._times[edge.to_node] = min(
+                    edge.timestamp,
+                    self._times.get(edge.to_node, edge.timestamp)
+                )
+        self._typical_size = self._mean(self._sizes.values())
+        self._typical_delta = self._mean([
+            size for (from_node, _), size in self._sizes.items()
+            if from_node != self.ROOT_NODE
+        ])
+        self._restore_bytes = self.distances(
+            lambda from_node, to_node: self._sizes.get(
+                (from_node, to_node), self._typical_size
+            )
+        )
+        self._depths = self.node_heights()
+
+    @staticmethod
+    def _mean(sizes):
+        return float(sum(sizes)) / len(sizes) if sizes else 0
+
+    def _growth_rate(self):
+        """Bytes per second earlier deltas grew by, or None if unknown."""
+        size = seconds = 0
+        for (from_node, to_node), edge_size in self._sizes.items():
+            if from_node not in self._times or to_node not in self._times:
+                continue
+            elapsed = self._times[to_node] - self._times[from_node]
+            if elapsed > 0:
+                size += edge_size
+                seconds += elapsed
+        return float(size) / seconds if seconds else None
+
+    def estimate_delta(self, parent):
+        if self._estimator is not None:
+            if parent not in self._estimates:
+                self._estimates[parent] = self._estimator(parent)
+            return self._estimates[parent]
+        if parent is None:
+            full_sends = [
+                (self._times.get(to_node, 0), size)
+                for (from_node, to_node), size in self._sizes.items()
+                if from_node == self.ROOT_NODE
+            ]
+            return max(full_sends)[1] if full_sends else self._typical_size
+        rate = self._growth_rate()
+        if rate is None or parent not in self._times:
+            return self._typical_delta
+        return rate * max(0, time.time() - self._times[parent])
+
+    def cost(self, parent):
+        delta = self.estimate_delta(parent)
+        restore = delta
+        if parent is not None:
+            restore += self._restore_bytes.get(parent, 0)
+        return delta + self._chain_weight * restore
+
+    def candidates(self):
+        """The local nodes that may be parents, most recent first."""
+        nodes = [
+            node for node in self._local_nodes
+            if self._depths.get(node, self.MAX_DEPTH) < self.MAX_DEPTH
+        ]
+        return sorted(nodes, reverse=True)[:self.CANDIDATES]
+
+    def best_parent(self):
+        costs = [(self.cost(node), node) for node in self.candidates()]
+        costs.append((self.cost(None), None))
+        # None sorts before any name; on a tie an incremental send wins
+        return min(costs, key=lambda (cost, node): (cost, node is None))[1]
+
+    def clean_local_nodes(self, storage_driver):
+        backed_up = sorted(
+            self._local_nodes & self.backed_up_nodes(),
+            reverse=True
+        )
+        to_delete = backed_up[self.KEEP_NODES:]
+        if to_delete:
+            storage_driver.delete_node(to_delete)
+
+
+def _parse_timestamp(node_name):
+    for node_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(node_name, node_format)
+        except ValueError:
+            pass
+    return None
+
+
+class RetentionPolicy(object):
+    """
+    Which backed up nodes a pool keeps: the `last' newest ones, and the
+    newest node of each of the `hourly' most recent hours that have one,
+    of the `daily' most recent days, and so on.  Nodes whose names are not
+    timestamps are always kept.
+
+    Pruning removes every edge that is on no path from FULL to a kept
+    node, so all restore chains of the kept nodes stay whole.
+    """
+    PERIODS = [
+        ('hourly', lambda when: when.strftime('%Y-%m-%dT%H')),
+        ('daily', lambda when: when.date()),
+        ('weekly', lambda when: when.isocalendar()[:2]),
+        ('monthly', lambda when: (when.year, when.month)),
+        ('yearly', lambda when: when.year),
+    ]
+
+    def __init__(self, last=1, **counts):
+        unknown = set(counts) - set(name for name, _ in self.PERIODS)
+        if unknown:
+            raise ValueError(
+                "Unknown retention period: %s" % ', '.join(sorted(unknown))
+            )
+        if not last and not any(counts.values()):
+            raise ValueError("Retention policy keeps no snapshots")
+        self.last = last
+        self.counts = counts
+
+    @classmethod
+    def parse(cls, text):
+        """A policy from `PERIOD=N,...', e.g. last=3,daily=7,monthly=12."""
+        counts = {}
+        for entry in text.split(','):
+            name, sep, count = entry.strip().partition('=')
+            if not sep or not count.isdigit():
+                raise ValueError("Invalid retention entry: %s" % entry)
+            counts[name] = int(count)
+        return cls(**counts)
+
+    def retained(self, nodes):
+        """The ones of `nodes' to keep, in a single pass, newest first."""
+        keep = set()
+        stamped = []
+        for node in nodes:
+            when = _parse_timestamp(node)
+            if when is None:
+                keep.add(node)
+            else:
+                stamped.append((when, node))
+        stamped.sort(reverse=True)
+        periods = [
+            (key, self.counts[name], [None, 0])
+            for name, key in self.PERIODS if self.counts.get(name)
+        ]
+        for position, (when, node) in enumerate(stamped):
+            if position < self.last:
+                keep.add(node)
+            for key, limit, state in periods:
+                # state: the last period seen, and how many were kept
+                period = key(when)
+                if period != state[0] and state[1] < limit:
+                    state[0] = period
+                    state[1] += 1
+                    keep.add(node)
+        return keep
+
+    def prune(self, graph):
+        """
+        Returns (kept nodes, prunable edges) of the DirectedGraph `graph'.
+        """
+        keep = self.retained(graph.backed_up_nodes())
+        needed = graph.ancestors(keep)
+        prunable = [
+            (from_node, to_node) for from_node, to_node in graph.edges()
+            if to_node not in needed
+        ]
+        return keep, prunable
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+"""
+Per-run metrics: the time spent in each stage of a backup session and
+the bytes that went through it, so it shows whether btrfs, the CPU, the
+disk or the network holds a run up.
+
+Stages may run on several threads at once; their seconds are then added
+up across threads.  A stage and a byte counter of the same name give a
+rate.  A Reporter writes the summary of every session as a line of JSON,
+keeps a Prometheus textfile of the totals of the sessions so far and
+sends them to StatsD.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """Stage timings and byte counts of one session, tagged with `labels'."""
+    def __init__(self, **labels):
+        self.labels = labels
+        self.started = self.updated = time.time()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            total, calls = self._stages.get(stage, (0.0, 0))
+            self._stages[stage] = (total + seconds, calls + 1)
+            self.updated = time.time()
+
+    def count(self, counter, amount):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+            self.updated = time.time()
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - started)
+
+    def timed_reader(self, fh, stage):
+        """`fh', with its reads timed as `stage' and counted as bytes."""
+        return _TimedReader(self, fh, stage)
+
+    def summary(self):
+        with self._lock:
+            stages = dict(self._stages)
+            counters = dict(self._counters)
+        rates = {}
+        for name, amount in counters.items():
+            seconds = stages.get(name, (0, 0))[0]
+            if seconds > 0:
+                rates[name] = amount / seconds
+        return {
+            'labels': self.labels,
+            'started': self.started,
+            # up to the last thing recorded, not to when it is reported
+            'elapsed': self.updated - self.started,
+            'stages': dict(
+                (stage, {'seconds': seconds, 'calls': calls})
+                for stage, (seconds, calls) in stages.items()
+            ),
+            'bytes': counters,
+            'rates': rates,
+        }
+
+
+class _TimedReader(object):
+    def __init__(self, metrics, fh, stage):
+        self._metrics = metrics
+        self._fh = fh
+        self._stage = stage
+
+    def read(self, size=-1):
+        with self._metrics.timer(self._stage):
+            buf = self._fh.read(size)
+        self._metrics.count(self._stage, len(buf))
+        return buf
+
+
+class _DisabledMetrics(object):
+    """Takes the calls a Metrics does, and keeps nothing."""
+    labels = {}
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, counter, amount):
+        pass
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def timed_reader(self, fh, stage):
+        return fh
+
+
+disabled = _DisabledMetrics()
+
+
+class Reporter(object):
+    """
+    Reports sessions' Metrics: appended as JSON lines to `json_path' ("-"
+    for stderr), added to the totals in the Prometheus textfile
+    `textfile_path', and sent to the StatsD daemon at `statsd_address',
+    HOST:PORT.  Any of them may be None.
+    """
+    prefix = 'btrfs_backup'
+
+    def __init__(self, json_path=None, textfile_path=None,
+                 statsd_address=None):
+        self._json_path = json_path
+        self._textfile_path = textfile_path
+        self._statsd = None
+        if statsd_address is not None:
+            host, port = statsd_address.rsplit(':', 1)
+            self._statsd = (host, int(port))
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def report(self, metrics):
+        summary = metrics.summary()
+        with self._lock:
+            if self._json_path is not None:
+                self._write_json(summary)
+            if self._textfile_path is not None:
+                self._add_totals(summary)
+                self._write_textfile()
+        if self._statsd is not None:
+            self._send_statsd(summary)
+
+    def _write_json(self, summary):
+        line = json.dumps(summary, sort_keys=True) + '\n'
+        if self._json_path == '-':
+            sys.stderr.write(line)
+            return
+        with open(self._json_path, 'a') as fh:
+            fh.write(line)
+
+    def _add_totals(self, summary):
+        labels = tuple(sorted(summary['labels'].items()))
+        totals = self._totals.setdefault(labels, {
+            'sessions': 0, 'stages': {}, 'bytes': {}, 'last': 0
+        })
+        totals['sessions'] += 1
+        totals['last'] = summary['started'] + summary['elapsed']
+        for stage, values in summary['stages'].items():
+            seconds, calls = totals['stages'].get(stage, (0.0, 0))
+            totals['stages'][stage] = (
+                seconds + values['seconds'],
+                calls + values['calls']
+            )
+        for counter, amount in summary['bytes'].items():
+            totals['bytes'][counter] = (
+                totals['bytes'].get(counter, 0) + amount
+            )
+
+    def _write_textfile(self):
+        def _labels(labels, **extra):
+            pairs = sorted(labels + tuple(extra.items()))
+            return '{%s}' % ','.join(
+                '%s="%s"' % (key, str(value).replace('"', '\\"'))
+                for key, value in pairs
+            )
+        lines = []
+        for labels, totals in sorted(self._totals.items()):
+            lines.append('%s_sessions_total%s %d' % (
+                self.prefix, _labels(labels), totals['sessions']))
+            lines.append('%s_last_session_timestamp_seconds%s %f' % (
+                self.prefix, _labels(labels), totals['last']))
+            for stage, (seconds, calls) in sorted(totals['stages'].items()):
+                lines.append('%s_stage_seconds_total%s %f' % (
+                    self.prefix, _labels(labels, stage=stage), seconds))
+                lines.append('%s_stage_calls_total%s %d' % (
+                    self.prefix, _labels(labels, stage=stage), calls))
+            for counter, amount in sorted(totals['bytes'].items()):
+                lines.append('%s_bytes_total%s %d' % (
+                    self.prefix, _labels(labels, stage=counter), amount))
+        # node_exporter may read it at any time
+        tmp_path = '%s.tmp' % self._textfile_path
+        with open(tmp_path, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self._textfile_path)
+
+    def _send_statsd(self, summary):
+        prefix = '.'.join(
+            [self.prefix] + [
+                str(value) for _, value in sorted(summary['labels'].items())
+            ]
+        ).replace('/', '_').replace(':', '_')
+        lines = []
+        for stage, values in summary['stages'].items():
+            lines.append('%s.%s:%d|ms' % (
+                prefix, stage, values['seconds'] * 1000))
+        for counter, amount in summary['bytes'].items():
+            lines.append('%s.%s_bytes:%d|c' % (prefix, counter, amount))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line, self._statsd)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
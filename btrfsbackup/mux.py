@@ -0,0 +1,260 @@
+#!/usr/bin/python
+"""
+Runs several btrfs-backup sessions over one transport.
+
+Pattern:
+    magic number (client to server only)
+    in both directions, frames of:
+        a 32 bit channel id, network byte order
+        an 8 bit frame kind
+        a 32 bit integer, network byte order specifying the payload size `n'
+        the payload: n bytes
+
+A channel is opened by the client sending its first frame.  DATA carries
+the bytes of a session.  The receiving end grants CREDIT (a 32 bit byte
+count) as it consumes them, so no channel has more than `window' bytes in
+flight and a slow session cannot hold up the others.  EOF ends one
+direction of a channel; the server sends CLOSE (an 8 bit status, zero on
+success) once its session is over.
+"""
+import sys
+import Queue
+import struct
+import threading
+from collections import deque
+
+from . import common
+
+
+mux_magic = b'btrfs-backup-mux'
+
+DATA, EOF, CREDIT, CLOSE = range(4)
+header_format = '!IBI'
+window = 16 * 1024 ** 2
+max_frame = 256 * 1024
+
+
+class TransportClosed(IOError):
+    pass
+
+
+class _ChannelReader(object):
+    def __init__(self, channel):
+        self._channel = channel
+        self._cond = threading.Condition()
+        self._chunks = deque()
+        self._eof = False
+        self._closed = False
+        self._unacked = 0
+
+    def _feed(self, data):
+        with self._cond:
+            if not self._closed:
+                self._chunks.append(data)
+                self._cond.notify()
+                return
+        self._consumed(len(data))
+
+    def _feed_eof(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def _consumed(self, count):
+        with self._cond:
+            self._unacked += count
+            if self._unacked < window // 2:
+                return
+            granted, self._unacked = self._unacked, 0
+        self._channel._send(CREDIT, struct.pack('!I', granted))
+
+    def _read_some(self, size):
+        with self._cond:
+            while not self._chunks and not self._eof:
+                self._cond.wait()
+            if not self._chunks:
+                return b''
+            data = self._chunks.popleft()
+            if len(data) > size:
+                self._chunks.appendleft(data[size:])
+                data = data[:size]
+        self._consumed(len(data))
+        return data
+
+    def read(self, size):
+        chunks = []
+        while size:
+            data = self._read_some(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def readinto(self, view):
+        data = self._read_some(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            pending, self._chunks = self._chunks, deque()
+        self._consumed(sum(len(data) for data in pending))
+
+
+class _ChannelWriter(object):
+    def __init__(self, channel):
+        self._channel = channel
+        self._cond = threading.Condition()
+        self._credit = window
+        self._broken = False
+        self._closed = False
+
+    def _grant(self, count):
+        with self._cond:
+            self._credit += count
+            self._cond.notify()
+
+    def _break(self):
+        with self._cond:
+            self._broken = True
+            self._cond.notify_all()
+
+    def write(self, buf):
+        if isinstance(buf, memoryview):
+            buf = buf.tobytes()
+        for offset in xrange(0, len(buf), max_frame):
+            chunk = buf[offset:offset + max_frame]
+            with self._cond:
+                while self._credit < len(chunk) and not self._broken:
+                    self._cond.wait()
+                if self._broken:
+                    raise TransportClosed("Transport closed")
+                self._credit -= len(chunk)
+            self._channel._send(DATA, chunk)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._channel._send(EOF)
+
+
+class Channel(object):
+    """
+    One session inside a Multiplexer.  It looks like a subprocess.Popen
+    with pipes to the peer: write to `stdin', read from `stdout'.
+    """
+    def __init__(self, mux, channel_id):
+        self.id = channel_id
+        self._mux = mux
+        self.stdout = self.reader = _ChannelReader(self)
+        self.stdin = self.writer = _ChannelWriter(self)
+        self._status = None
+        self._done = threading.Event()
+
+    def _send(self, kind, payload=b''):
+        self._mux._send(self.id, kind, payload)
+
+    def _finish(self, status):
+        self._status = status
+        self.reader._feed_eof()
+        self.writer._break()
+        self._done.set()
+
+    def close(self, status=0):
+        self.writer.close()
+        self._send(CLOSE, struct.pack('!B', status))
+
+    def wait(self):
+        self._done.wait()
+        return self._status
+
+
+class Multiplexer(object):
+    def __init__(self, instream, outstream):
+        self._in = instream
+        self._out = outstream
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._accepted = Queue.Queue()
+        self._next_id = 1
+        self._thread = threading.Thread(target=self._demux)
+        self._thread.daemon = True
+
+    def start_client(self):
+        self._out.write(mux_magic)
+        self._thread.start()
+
+    def start_server(self):
+        if common.read_exact(self._in, len(mux_magic)) != mux_magic:
+            raise Exception("Invalid magic number")
+        self._thread.start()
+
+    def open_channel(self):
+        with self._lock:
+            channel = Channel(self, self._next_id)
+            self._channels[channel.id] = channel
+            self._next_id += 1
+        return channel
+
+    def accept(self):
+        """Yields the channels opened by the peer until the transport ends."""
+        while True:
+            channel = self._accepted.get()
+            if channel is None:
+                break
+            yield channel
+
+    def close(self):
+        self._out.close()
+
+    def _send(self, channel_id, kind, payload=b''):
+        header = struct.pack(header_format, channel_id, kind, len(payload))
+        with self._lock:
+            self._out.write(header)
+            if payload:
+                self._out.write(payload)
+            self._out.flush()
+
+    def _channel(self, channel_id):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                channel = Channel(self, channel_id)
+                self._channels[channel_id] = channel
+                self._accepted.put(channel)
+        return channel
+
+    def _demux(self):
+        header_size = struct.calcsize(header_format)
+        try:
+            while True:
+                try:
+                    header = common.read_exact(self._in, header_size)
+                except common.TruncatedRead:
+                    break
+                channel_id, kind, length = struct.unpack(header_format, header)
+                payload = common.read_exact(self._in, length)
+                channel = self._channel(channel_id)
+                if kind == DATA:
+                    channel.reader._feed(payload)
+                elif kind == EOF:
+                    channel.reader._feed_eof()
+                elif kind == CREDIT:
+                    channel.writer._grant(struct.unpack('!I', payload)[0])
+                elif kind == CLOSE:
+                    channel._finish(struct.unpack('!B', payload)[0])
+        except Exception:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            with self._lock:
+                channels = self._channels.values()
+            for channel in channels:
+                if not channel._done.is_set():
+                    channel._finish(-1)
+            self._accepted.put(None)
@@ -0,0 +1,369 @@
+#!/usr/bin/python
+"""
+Object stores a pool can be kept in: an S3 compatible service, through
+boto3, or a directory that stands in for one.
+
+Objects are written whole, or in numbered parts of a multipart upload
+that only become the object once the upload is completed, and are read
+whole or by byte range.  A stored edge is written as a multipart upload,
+with several parts in flight at once and parts large enough for the
+edge to fit in S3's 10,000, and read back as ranged reads run in
+parallel.
+
+Filesystem layout, below its root:
+    KEY                     each object
+    .multipart/ID/NNNNNNNN  the parts of an upload not yet completed
+"""
+import os
+import calendar
+import shutil
+import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from . import fsutil
+from . import common
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+part_size = 16 * 1024 ** 2
+transfers = 4  # parts moving at once, per edge
+
+# S3's limits on multipart uploads
+max_parts = 10000
+min_part_size = 5 * 1024 ** 2
+max_part_size = 5 * 1024 ** 3
+part_growth = 1000  # parts between doublings of the part size
+
+
+# The size of an object in bytes and when it was written, in seconds since
+# the epoch.
+ObjectStat = namedtuple('ObjectStat', ['size', 'timestamp'])
+
+
+class ObjectStore(object):
+    def get(self, key, start=0, end=None):
+        """The bytes [`start', `end') of an object, or all after `start'."""
+        raise NotImplementedError
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def stat(self, key):
+        """An ObjectStat of the object, or None if there is none."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """Yields the key and ObjectStat of every object below `prefix'."""
+        raise NotImplementedError
+
+    def start_upload(self, key):
+        """Starts a multipart upload; returns its id."""
+        raise NotImplementedError
+
+    def upload_part(self, key, upload_id, number, data):
+        """Uploads part `number' (from 1); returns its tag."""
+        raise NotImplementedError
+
+    def complete_upload(self, key, upload_id, tags):
+        raise NotImplementedError
+
+    def abort_upload(self, key, upload_id):
+        raise NotImplementedError
+
+
+class FilesystemObjectStore(ObjectStore):
+    """Objects kept as files below `root', as a stand-in for a service."""
+    def __init__(self, root):
+        self._root = root
+        self._uploads = os.path.join(root, '.multipart')
+        if not os.path.isdir(self._uploads):
+            os.makedirs(self._uploads)
+
+    def _path(self, key):
+        return os.path.join(self._root, key)
+
+    def get(self, key, start=0, end=None):
+        with open(self._path(key), 'rb') as fh:
+            fh.seek(start)
+            if end is None:
+                return fh.read()
+            return fh.read(end - start)
+
+    @contextmanager
+    def _writing(self, key):
+        # objects are replaced whole, like in the real thing
+        path = self._path(key)
+        tmp_path = '%s.tmp' % path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        try:
+            with open(tmp_path, 'wb') as fh:
+                yield fh
+                fh.flush()
+                os.fsync(fh.fileno())
+        except:
+            os.unlink(tmp_path)
+            raise
+        os.rename(tmp_path, path)
+        fsutil.fsync_directory(os.path.dirname(path) or '.')
+
+    def put(self, key, data):
+        with self._writing(key) as fh:
+            fh.write(data)
+
+    def stat(self, key):
+        try:
+            st = os.stat(self._path(key))
+        except OSError:
+            return None
+        return ObjectStat(st.st_size, int(st.st_mtime))
+
+    def delete(self, key):
+        os.unlink(self._path(key))
+
+    def list(self, prefix):
+        directory, start = os.path.split(prefix)
+        try:
+            filenames = os.listdir(os.path.join(self._root, directory))
+        except OSError:
+            return
+        for filename in filenames:
+            # objects being written are not there yet
+            if filename.startswith(start) and not filename.endswith('.tmp'):
+                key = os.path.join(directory, filename)
+                stat = self.stat(key)
+                if stat is not None:
+                    yield key, stat
+
+    def start_upload(self, key):
+        upload_id = os.urandom(8).encode('hex')
+        os.mkdir(os.path.join(self._uploads, upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        path = os.path.join(self._uploads, upload_id, '%08d' % number)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_upload(self, key, upload_id, tags):
+        upload_dir = os.path.join(self._uploads, upload_id)
+        with self._writing(key) as fh:
+            for number, tag in enumerate(tags, 1):
+                with open(os.path.join(upload_dir, '%08d' % number)) as part:
+                    data = part.read()
+                if hashlib.md5(data).hexdigest() != tag:
+                    raise Exception("Part %d of %s changed" % (number, key))
+                fh.write(data)
+        shutil.rmtree(upload_dir)
+
+    def abort_upload(self, key, upload_id):
+        shutil.rmtree(os.path.join(self._uploads, upload_id), True)
+
+
+class S3ObjectStore(ObjectStore):
+    """
+    Objects below `prefix' in an S3 bucket, or in a bucket of another
+    service speaking S3 at `endpoint_url'.  Needs boto3.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None):
+        if boto3 is None:
+            raise Exception("S3 object stores need the boto3 package")
+        self._client = boto3.client('s3', endpoint_url=endpoint_url)
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _key(self, key):
+        return self._prefix + key
+
+    def get(self, key, start=0, end=None):
+        byte_range = 'bytes=%d-' % start
+        if end is not None:
+            if end <= start:
+                return ''
+            byte_range += '%d' % (end - 1)
+        response = self._client.get_object(
+            Bucket=self._bucket, Key=self._key(key), Range=byte_range
+        )
+        return response['Body'].read()
+
+    def put(self, key, data):
+        self._client.put_object(
+            Bucket=self._bucket, Key=self._key(key), Body=data
+        )
+
+    def stat(self, key):
+        try:
+            response = self._client.head_object(
+                Bucket=self._bucket, Key=self._key(key)
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return ObjectStat(
+            response['ContentLength'],
+            calendar.timegm(response['LastModified'].utctimetuple())
+        )
+
+    def delete(self, key):
+        self._client.delete_object(Bucket=self._bucket, Key=self._key(key))
+
+    def list(self, prefix):
+        pages = self._client.get_paginator('list_objects_v2').paginate(
+            Bucket=self._bucket, Prefix=self._key(prefix)
+        )
+        for page in pages:
+            for listed in page.get('Contents', []):
+                yield listed['Key'][len(self._prefix):], ObjectStat(
+                    listed['Size'],
+                    calendar.timegm(listed['LastModified'].utctimetuple())
+                )
+
+    def start_upload(self, key):
+        return self._client.create_multipart_upload(
+            Bucket=self._bucket, Key=self._key(key)
+        )['UploadId']
+
+    def upload_part(self, key, upload_id, number, data):
+        return self._client.upload_part(
+            Bucket=self._bucket, Key=self._key(key), UploadId=upload_id,
+            PartNumber=number, Body=data
+        )['ETag']
+
+    def complete_upload(self, key, upload_id, tags):
+        self._client.complete_multipart_upload(
+            Bucket=self._bucket, Key=self._key(key), UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'ETag': tag, 'PartNumber': number}
+                for number, tag in enumerate(tags, 1)
+            ]}
+        )
+
+    def abort_upload(self, key, upload_id):
+        self._client.abort_multipart_upload(
+            Bucket=self._bucket, Key=self._key(key), UploadId=upload_id
+        )
+
+
+def open_store(url, endpoint_url=None):
+    """The store at `s3://BUCKET/PREFIX', or the one in a directory."""
+    if url.startswith('s3:/'):
+        # pool paths may have gone through os.path.normpath
+        bucket, _, prefix = url[len('s3:/'):].lstrip('/').partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3ObjectStore(bucket, prefix, endpoint_url)
+    return FilesystemObjectStore(url)
+
+
+def _part_size(first, number):
+    """The size of part `number' (from 0) of an upload."""
+    return min(first * 2 ** (number // part_growth), max_part_size)
+
+
+def _capacity(first):
+    """The most an upload whose first part is `first' bytes can hold."""
+    return sum(
+        _part_size(first, number) * part_growth
+        for number in xrange(0, max_parts, part_growth)
+    )
+
+
+class MultipartWriter(object):
+    """
+    Writes an object as a multipart upload, at most `workers' parts
+    uploading at once while the next one fills up.  Parts are `part_size'
+    bytes, or more if that many would not fit `size_hint' bytes in the
+    store's limit on parts, and double every `part_growth' parts so that a
+    stream larger than its hint still fits.  The object only appears once
+    the writer is closed; `abort' drops it.
+    """
+    def __init__(self, store, key, size_hint=None, part_size=part_size,
+                 workers=transfers):
+        part_size = max(part_size, min_part_size)
+        if size_hint:
+            part_size = max(part_size, -(-size_hint // max_parts))
+            if _capacity(part_size) < size_hint:
+                raise Exception("%s is too large for an object: %d bytes" % (
+                    key, size_hint))
+        self._store = store
+        self._key = key
+        self._first_part = part_size
+        self._part_size = part_size
+        self._upload_id = store.start_upload(key)
+        self._pool = ThreadPool(workers)
+        self._slots = threading.Semaphore(workers)
+        self._parts = []
+        self._buf = bytearray()
+        self.size = 0
+
+    def _upload(self, number, data):
+        try:
+            return self._store.upload_part(
+                self._key, self._upload_id, number, data
+            )
+        finally:
+            self._slots.release()
+
+    def _submit(self, data):
+        # fail early rather than after the whole stream was received
+        for part in self._parts:
+            if part.ready() and not part.successful():
+                part.get()
+        if len(self._parts) == max_parts:
+            raise Exception("%s is too large for an object" % self._key)
+        self._slots.acquire()
+        self._parts.append(self._pool.apply_async(
+            self._upload, (len(self._parts) + 1, data)
+        ))
+        self._part_size = _part_size(self._first_part, len(self._parts))
+
+    def write(self, buf):
+        self._buf += buf
+        self.size += len(buf)
+        while len(self._buf) >= self._part_size:
+            data = bytes(self._buf[:self._part_size])
+            del self._buf[:len(data)]
+            self._submit(data)
+
+    def close(self):
+        if self._buf or not self._parts:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        tags = [part.get() for part in self._parts]
+        self._pool.close()
+        self._store.complete_upload(self._key, self._upload_id, tags)
+
+    def abort(self):
+        self._pool.terminate()
+        self._store.abort_upload(self._key, self._upload_id)
+
+
+class RangedReader(common.IterableReader):
+    """
+    Reads the `size' byte object `key' of `store' as ranged reads of
+    `part_size' bytes, `workers' of them running ahead at once.
+    """
+    def __init__(self, store, key, size, part_size=part_size,
+                 workers=transfers):
+        ranges = [
+            (start, min(start + part_size, size))
+            for start in xrange(0, size, part_size)
+        ]
+        super(RangedReader, self).__init__(common.bounded_imap(
+            lambda (start, end): store.get(key, start, end),
+            ranges,
+            workers
+        ))
@@ -7,15 +7,48 @@ Pattern:
         the piece: n bytes of data (read from the input stream)
         the sha256 up until this point.
     end magic number
+
+When a codec is in use each piece is compressed on its own before it is
+framed; `n' is then the compressed size, while the sha256 still covers
+the uncompressed data.
+
+Besides the chained sha256 ("sha256-chain"), a stream may use a per-piece
+hash mode: each digest then covers the piece index (a 64 bit integer,
+network byte order) followed by the uncompressed piece, so pieces can be
+verified independently and in parallel while reordering, loss and
+truncation are still detected.
 """
 from contextlib import contextmanager
 import os
+import mmap
+import errno
+import fcntl
+import Queue
 import hashlib
 import struct
-import shutil
+
+from .common import bounded_imap, default_workers, threaded
+from .compression import compress_pieces
+from .metrics import disabled
+from . import fsutil
+from . import common
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 piece_size = 4 * 1024 ** 2  # 4MB
+read_ahead = 4  # pieces buffered between pipeline stages
 
 
 magic = b'reliable-encap'
@@ -30,18 +63,149 @@ class IntegrityError(ValueError):
     pass
 
 
-def yield_pieces(input_file, with_magic=True):
-    if with_magic:
-        yield magic
-    hasher = hashlib.sha256()
+class UnknownHashMode(ValueError):
+    pass
+
+
+class ResumeMismatch(IntegrityError):
+    pass
+
+
+class HashMode(object):
+    def __init__(self, name, constructor, chained):
+        self.name = name
+        self.constructor = constructor
+        self.chained = chained
+        self.digest_size = constructor().digest_size
+
+    def __repr__(self):
+        return 'HashMode(%r)' % self.name
+
+    def piece_digest(self, index, buf):
+        hasher = self.constructor()
+        hasher.update(struct.pack('!Q', index))
+        hasher.update(buf)
+        return hasher.digest()
+
+
+HASH_MODES = [
+    HashMode('sha256-chain', hashlib.sha256, True),
+    HashMode('sha256', hashlib.sha256, False),
+]
+if blake2b is not None:
+    HASH_MODES.append(HashMode('blake2b', blake2b, False))
+if xxhash is not None:
+    HASH_MODES.append(HashMode('xxh64', xxhash.xxh64, False))
+
+_HASH_MODES_BY_NAME = dict((mode.name, mode) for mode in HASH_MODES)
+
+DEFAULT_HASH_MODE = _HASH_MODES_BY_NAME['sha256-chain']
+
+
+def available_hash_modes():
+    return [mode.name for mode in HASH_MODES]
+
+
+def get_hash_mode(name):
+    try:
+        return _HASH_MODES_BY_NAME[name]
+    except KeyError:
+        raise UnknownHashMode(name)
+
+
+def choose_hash_mode(preference, offered):
+    if preference in offered and preference in _HASH_MODES_BY_NAME:
+        return _HASH_MODES_BY_NAME[preference]
+    return DEFAULT_HASH_MODE
+
+
+def _read_pieces(input_file):
     while True:
         buf = input_file.read(piece_size)
-        hasher.update(buf)
-        yield struct.pack('!I', len(buf))
         yield buf
-        yield hasher.digest()
         if not buf:
             break
+
+
+def skip_pieces(input_file, count):
+    """
+    Reads and discards the first `count' pieces of `input_file', returning
+    a sha256 over them to compare with what the server already has.
+    """
+    hasher = hashlib.sha256()
+    for _ in xrange(count):
+        buf = input_file.read(piece_size)
+        if len(buf) != piece_size:
+            raise ResumeMismatch("Stream is shorter than the partial upload")
+        hasher.update(buf)
+    return hasher
+
+
+def _chain_digests(pieces, hasher, metrics):
+    for buf, payload in pieces:
+        with metrics.timer('hash'):
+            hasher.update(buf)
+            digest = hasher.digest()
+        yield payload, digest
+
+
+def frame_pieces(pieces, codec=None, workers=None,
+                 hash_mode=DEFAULT_HASH_MODE, first_index=0, hasher=None,
+                 metrics=disabled):
+    """
+    Yields the framing of each of `pieces', which must end with an empty
+    piece.  Compressing and hashing run on their own threads; time spent
+    hashing goes to the `hash' stage of `metrics'.
+    """
+    if codec is None:
+        pieces = ((buf, buf) for buf in pieces)
+    else:
+        pieces = compress_pieces(codec, pieces, workers)
+    if hash_mode.chained:
+        hasher = hasher or hashlib.sha256()
+        frames = threaded(
+            _chain_digests(pieces, hasher, metrics),
+            read_ahead
+        )
+    else:
+        def _digest((index, (buf, payload))):
+            with metrics.timer('hash'):
+                return payload, hash_mode.piece_digest(index, buf)
+        frames = bounded_imap(
+            _digest,
+            enumerate(pieces, first_index),
+            workers
+        )
+    for payload, digest in frames:
+        yield struct.pack('!I', len(payload))
+        yield payload
+        yield digest
+
+
+def yield_pieces(input_file, with_magic=True, codec=None, workers=None,
+                 hash_mode=DEFAULT_HASH_MODE, first_index=0, hasher=None,
+                 metrics=disabled):
+    """
+    Reading, compressing, hashing and the consumer's writes all overlap:
+    the input is read ahead on its own thread, chained hashing runs on
+    another and per-piece digests are computed on a pool of `workers'.
+
+    To resume a stream, pass the index of its first piece and, for the
+    chained mode, the sha256 over the pieces before it.
+    """
+    if with_magic:
+        yield magic
+    frames = frame_pieces(
+        threaded(_read_pieces(input_file), read_ahead),
+        codec,
+        workers,
+        hash_mode,
+        first_index,
+        hasher,
+        metrics
+    )
+    for frame in frames:
+        yield frame
     if with_magic:
         yield end_magic
 
@@ -58,35 +222,361 @@ def yield_pieces_output_manager(output_file):
         output_file.close()
 
 
-def yield_input(input_file):
-    hasher = hashlib.sha256()
-    if not input_file.read(len(magic)) == magic:
-        raise IntegrityError("Beginning magic number missing")
+class _BufferPool(object):
+    """
+    Piece buffers that are handed out and returned, so a stream of any
+    length is received in the same, bounded amount of memory.
+    """
+    def __init__(self, count, size):
+        self._free = Queue.Queue()
+        self._unallocated = count
+        self._size = size
+
+    def get(self, size):
+        try:
+            buf = self._free.get_nowait()
+        except Queue.Empty:
+            if self._unallocated:
+                self._unallocated -= 1
+                buf = bytearray(self._size)
+            else:
+                buf = self._free.get()
+        if len(buf) < size:
+            # an incompressible piece grows slightly when compressed
+            buf = bytearray(size)
+        return buf
+
+    def put(self, buf):
+        self._free.put(buf)
+
+
+def _in_flight(workers):
+    """Upper bound on the pieces held by the receive pipeline at once."""
+    pooled = 4 * workers if workers > 1 else 0
+    return 2 * (read_ahead + 1) + 1 + pooled
+
+
+def _read_exact(input_file, size):
+    try:
+        return common.read_exact(input_file, size)
+    except common.TruncatedRead:
+        raise IntegrityError("Truncated stream")
+
+
+def _readinto_exact(input_file, view):
+    while len(view):
+        count = input_file.readinto(view)
+        if not count:
+            raise IntegrityError("Truncated stream")
+        view = view[count:]
+
+
+def _read_frames(input_file, digest_size, buffers):
+    header_size = struct.calcsize('!I')
     while True:
-        length, = struct.unpack('!I', input_file.read(struct.calcsize('!I')))
-        buf = input_file.read(length)
-        hasher.update(buf)
-        cur_hash = input_file.read(hasher.digest_size)
-        if not hasher.digest() == cur_hash:
-            raise IntegrityError("Hash Mismatch")
+        header = _read_exact(input_file, header_size)
+        length, = struct.unpack('!I', header)
+        backing = buffers.get(length)
+        payload = memoryview(backing)[:length]
+        _readinto_exact(input_file, payload)
+        yield payload, _read_exact(input_file, digest_size), backing
         if length == 0:
             break
-        yield buf
-    if not input_file.read(len(end_magic)) == end_magic:
+
+
+def _verify_chained(frames, hasher, metrics):
+    for buf, payload, digest, backing in frames:
+        with metrics.timer('hash'):
+            hasher.update(buf)
+            ok = hasher.digest() == digest
+        if not ok:
+            raise IntegrityError("Hash Mismatch")
+        yield buf, payload, backing
+
+
+def _verified(frames, codec, workers, hash_mode, first_index, hasher,
+              metrics):
+    """
+    Decompresses and verifies (payload, digest, backing) frames, yielding
+    (piece, payload, backing) in order.
+    """
+    if codec is None:
+        frames = (
+            (payload, payload, digest, backing)
+            for payload, digest, backing in frames
+        )
+    else:
+        def _decompress((payload, digest, backing)):
+            buf = codec.decompress(payload) if payload else b''
+            return buf, payload, digest, backing
+        frames = bounded_imap(_decompress, frames, workers)
+    if hash_mode.chained:
+        hasher = hasher or hashlib.sha256()
+        return threaded(
+            _verify_chained(frames, hasher, metrics),
+            read_ahead
+        )
+
+    def _verify((index, (buf, payload, digest, backing))):
+        with metrics.timer('hash'):
+            ok = hash_mode.piece_digest(index, buf) == digest
+        if not ok:
+            raise IntegrityError("Hash Mismatch")
+        return buf, payload, backing
+    return bounded_imap(_verify, enumerate(frames, first_index), workers)
+
+
+def yield_input_pieces(input_file, codec=None, workers=None,
+                       hash_mode=DEFAULT_HASH_MODE, first_index=0,
+                       hasher=None, metrics=disabled):
+    """
+    Yields (piece, payload) where `payload' is the piece as it was sent
+    on the wire, so it can be stored without compressing it again.
+
+    Frames are read ahead on their own thread; decompression and
+    per-piece verification run on a pool of `workers'.  `first_index'
+    and `hasher' continue a resumed stream, as for yield_pieces.
+
+    Pieces are read with readinto into a fixed pool of buffers and handed
+    out as memoryviews, which are only valid until the next piece is
+    requested.
+    """
+    if not _read_exact(input_file, len(magic)) == magic:
+        raise IntegrityError("Beginning magic number missing")
+    if workers is None:
+        workers = default_workers()
+    buffers = _BufferPool(_in_flight(workers), piece_size)
+    frames = threaded(
+        _read_frames(input_file, hash_mode.digest_size, buffers),
+        read_ahead
+    )
+    pieces = _verified(
+        frames, codec, workers, hash_mode, first_index, hasher, metrics
+    )
+    for buf, payload, backing in pieces:
+        if payload:
+            yield buf, payload
+        buffers.put(backing)
+    if not _read_exact(input_file, len(end_magic)) == end_magic:
         raise IntegrityError("Terminating magic number missing")
 
 
+class _SpliceReader(object):
+    """
+    Reads the rest of a buffered pipe straight from its file descriptor,
+    starting with whatever the buffered reader already holds.
+    """
+    def __init__(self, input_file):
+        self._fd = input_file.fileno()
+        self._pending = input_file.read(len(input_file.peek(1)))
+
+    def _take_pending(self, size):
+        taken = self._pending[:size]
+        self._pending = self._pending[size:]
+        return taken
+
+    def read(self, size):
+        chunks = [self._take_pending(size)]
+        size -= len(chunks[0])
+        while size:
+            buf = os.read(self._fd, size)
+            if not buf:
+                raise IntegrityError("Truncated stream")
+            chunks.append(buf)
+            size -= len(buf)
+        return b''.join(chunks)
+
+    def splice_to(self, fd_out, size):
+        taken = self._take_pending(size)
+        size -= len(taken)
+        while taken:
+            taken = taken[os.write(fd_out, taken):]
+        if fsutil.splice(self._fd, fd_out, size) != size:
+            raise IntegrityError("Truncated stream")
+
+
+def _map_written(fd, offset, length):
+    if not length:
+        return b''
+    delta = offset % mmap.ALLOCATIONGRANULARITY
+    mapping = mmap.mmap(
+        fd, length + delta, prot=mmap.PROT_READ, offset=offset - delta
+    )
+    if not delta:
+        return mapping
+    try:
+        return mapping[delta:]
+    finally:
+        mapping.close()
+
+
+def _splice_frames(reader, output_file, digest_size):
+    header_size = struct.calcsize('!I')
+    fd_out = output_file.fileno()
+    offset = output_file.tell()
+    os.lseek(fd_out, offset, os.SEEK_SET)
+    read_fd = os.open(output_file.name, os.O_RDONLY)
+    try:
+        while True:
+            length, = struct.unpack('!I', reader.read(header_size))
+            reader.splice_to(fd_out, length)
+            digest = reader.read(digest_size)
+            offset += length
+            written = _map_written(read_fd, offset - length, length)
+            yield written, digest, (written, offset)
+            if length == 0:
+                break
+    finally:
+        os.close(read_fd)
+
+
+def can_splice_input(input_file, output_file):
+    """
+    True if splice_input can move a stream from `input_file' to
+    `output_file': the input must be a buffered reader on a pipe and the
+    output a plain file.
+    """
+    if not hasattr(input_file, 'peek') or not isinstance(output_file, file):
+        return False
+    return fsutil.can_splice(input_file.fileno())
+
+
+def splice_input(input_file, output_file, workers=None,
+                 hash_mode=DEFAULT_HASH_MODE, first_index=0, hasher=None,
+                 on_piece=None, metrics=disabled):
+    """
+    Receives a stream without a codec straight into `output_file': pieces
+    are moved from the pipe with splice(2) and verified from the page
+    cache through mmap, then passed to `on_piece', if given.  If the
+    stream turns out bad the file is cut back to the end of the last
+    verified piece, so it can still be resumed.
+    """
+    if not _read_exact(input_file, len(magic)) == magic:
+        raise IntegrityError("Beginning magic number missing")
+    output_file.flush()
+    verified_end = output_file.tell()
+    reader = _SpliceReader(input_file)
+    try:
+        frames = _splice_frames(reader, output_file, hash_mode.digest_size)
+        pieces = _verified(
+            frames, None, workers, hash_mode, first_index, hasher, metrics
+        )
+        for buf, payload, (written, end) in pieces:
+            if on_piece is not None:
+                on_piece(buf)
+            if isinstance(written, mmap.mmap):
+                written.close()
+            verified_end = end
+        if not reader.read(len(end_magic)) == end_magic:
+            raise IntegrityError("Terminating magic number missing")
+    except:
+        os.ftruncate(output_file.fileno(), verified_end)
+        raise
+    finally:
+        output_file.seek(verified_end)
+
+
+def yield_input(input_file, codec=None, workers=None,
+                hash_mode=DEFAULT_HASH_MODE):
+    for buf, _ in yield_input_pieces(input_file, codec, workers, hash_mode):
+        yield buf
+
+
+def _is_open_file(fh, path):
+    """Whether `path' still names the file `fh' has open."""
+    try:
+        return os.path.samestat(os.fstat(fh.fileno()), os.stat(path))
+    except OSError:
+        return False
+
+
+def _open_temp(temp_file):
+    """
+    Opens `temp_file' without truncating it and takes its lock, waiting
+    out the write of another session, if any.
+    """
+    while True:
+        # opened by name, which splice_input opens it by again
+        os.close(os.open(temp_file, os.O_WRONLY | os.O_CREAT, 0o666))
+        try:
+            fh = open(temp_file, 'r+b')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        # it may have been renamed into place or discarded meanwhile
+        if _is_open_file(fh, temp_file):
+            return fh
+        fh.close()
+
+
 @contextmanager
-def transactional_write(filename):
+def claimed_partial(temp_file):
+    """
+    Yields the `.tmp' file `temp_file' of a transactional_write, open for
+    reading and locked against writers, or None if a write to it is still
+    running or it is gone.
+    """
+    try:
+        fh = open(temp_file, 'rb')
+    except IOError:
+        yield None
+        return
+    with fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield None
+            return
+        yield fh if _is_open_file(fh, temp_file) else None
+
+
+@contextmanager
+def transactional_write(filename, resume_at=None, keep_partial=False,
+                        size_hint=None):
+    """
+    Writes `filename' through `<filename>.tmp', which is renamed into place
+    on success.  With `keep_partial' a failed write leaves the `.tmp' file
+    behind; passing its length of good data as `resume_at' continues it.
+    The `.tmp' file is locked while it is written, so other sessions leave
+    it alone (see claimed_partial) and a second write of it waits.
+
+    The file is fsynced before the rename and the directory after it, so
+    a crash never leaves a truncated file under `filename'.  Meanwhile
+    data is written back as it comes in and dropped from the page cache;
+    `size_hint', the expected size, is preallocated.
+    """
     temp_file = '%s.tmp' % filename
-    with open(temp_file, 'w') as fh:
+    with _open_temp(temp_file) as fh:
+        writeback = None
         try:
             if os.path.exists(filename):
                 raise FileExists()
+            fh.truncate(resume_at or 0)
+            fh.seek(resume_at or 0)
+            fd = fh.fileno()
+            if size_hint and fsutil.fallocate is not None:
+                try:
+                    fsutil.fallocate(fd, fh.tell(), size_hint)
+                except OSError:
+                    pass
+            writeback = fsutil.Writeback(fd, fh.tell())
             yield fh
-            shutil.move(temp_file, filename)
+            fh.flush()
+            writeback.stop()
+            # drops blocks preallocated past the end
+            if size_hint:
+                fh.truncate()
+            os.fsync(fd)
+            fsutil.drop_cache(fd)
+            os.rename(temp_file, filename)
+            fsutil.fsync_directory(os.path.dirname(filename) or '.')
         except:
-            os.unlink(temp_file)
+            if writeback is not None:
+                writeback.stop()
+            if not keep_partial:
+                os.unlink(temp_file)
             raise
 
 
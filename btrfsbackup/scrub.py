@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""
+Scrubbing: re-reading the edges of a pool to find the ones that rotted on
+disk, and the snapshots that can no longer be restored because of them.
+
+A server can keep the sha256 of every `piece_size' block of an edge's send
+stream next to it, computed as the edge is received, in
+`FROM__TO.btrfs.digests':
+
+    8 bytes     "bbdigest"
+    32 bits     the block size, network byte order
+    64 bits     the size of the stream, network byte order
+    32 bytes    the sha256 of each block, in order
+
+Edges kept in a chunk store need no such index, each chunk is verified
+against its sha256 as it is read.  Other edges without one are indexed
+the first time they are scrubbed, which can only catch the damage done
+since.
+"""
+import os
+import struct
+import hashlib
+from functools import partial
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from .reliable_rw import transactional_write, piece_size
+from .graphanalyze import DirectedGraph, graph_of
+from . import fsutil
+
+
+index_suffix = '.digests'
+_index_magic = 'bbdigest'
+_index_header = '!8sIQ'
+
+
+# The outcome of scrubbing an edge: `status' is `ok', `indexed' (it had no
+# index yet) or `damaged', with what was wrong in `detail'.
+ScrubResult = namedtuple(
+    'ScrubResult', ['from_node', 'to_node', 'status', 'detail', 'size']
+)
+
+
+class PieceIndex(object):
+    """The sha256 of every `block_size' block of a stream, as it is fed."""
+    def __init__(self, block_size=piece_size):
+        self.block_size = block_size
+        self.size = 0
+        self.digests = []
+        self._hasher = None
+        self._filled = 0
+
+    def add(self, data):
+        """Adds the next bytes of the stream, however they are split."""
+        start = 0
+        while start < len(data):
+            if self._hasher is None:
+                self._hasher = hashlib.sha256()
+                self._filled = 0
+            take = min(len(data) - start, self.block_size - self._filled)
+            if start == 0 and take == len(data):
+                self._hasher.update(data)
+            else:
+                self._hasher.update(data[start:start + take])
+            start += take
+            self._filled += take
+            if self._filled == self.block_size:
+                self._finish_block()
+        self.size += len(data)
+
+    def _finish_block(self):
+        self.digests.append(self._hasher.digest())
+        self._hasher = None
+
+    def finish(self):
+        if self._hasher is not None:
+            self._finish_block()
+        return self
+
+    def save(self, path):
+        self.finish()
+        with transactional_write(path) as fh:
+            fh.write(struct.pack(
+                _index_header, _index_magic, self.block_size, self.size
+            ))
+            fh.write(''.join(self.digests))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            header = fh.read(struct.calcsize(_index_header))
+            magic, block_size, size = struct.unpack(_index_header, header)
+            if magic != _index_magic:
+                raise ValueError("Not a piece index: %s" % path)
+            index = cls(block_size)
+            index.size = size
+            data = fh.read()
+        index.digests = [
+            data[offset:offset + 32] for offset in xrange(0, len(data), 32)
+        ]
+        return index
+
+    def differences(self, other):
+        """What differs between this index and `other', or None."""
+        if self.size != other.size:
+            return "size is %d bytes, was %d" % (other.size, self.size)
+        if len(self.digests) != len(other.digests):
+            return "index has %d blocks, stream %d" % (
+                len(self.digests), len(other.digests))
+        bad = [
+            index for index, (digest, other_digest) in
+            enumerate(zip(self.digests, other.digests))
+            if digest != other_digest
+        ]
+        if bad:
+            return "block%s %s of %d damaged" % (
+                's' if len(bad) > 1 else '',
+                ', '.join(str(index) for index in bad[:8]) +
+                (', ...' if len(bad) > 8 else ''),
+                len(self.digests)
+            )
+        return None
+
+
+def scrub_edge(driver, edge, bucket=None):
+    """
+    Reads the edge (FROM, TO) of `driver' back and checks it against its
+    index, writing one if it has none yet.  Reads are throttled through the
+    TokenBucket `bucket', if any, and dropped from the page cache after.
+    """
+    from_, to_ = edge
+    index_path = driver.index_path(from_, to_)
+    expected = None
+    found = PieceIndex()
+    try:
+        if index_path is not None and os.path.exists(index_path):
+            expected = PieceIndex.load(index_path)
+            found = PieceIndex(expected.block_size)
+        with driver.open_edge(from_, to_) as fh:
+            while True:
+                buf = fh.read(found.block_size)
+                if not buf:
+                    break
+                if bucket is not None:
+                    bucket.consume(len(buf))
+                found.add(buf)
+        found.finish()
+        fullpath = driver.find_fullpath(from_, to_)
+        if fullpath is not None:
+            with open(fullpath, 'rb') as fh:
+                fsutil.drop_cache(fh.fileno())
+    except Exception as e:
+        return ScrubResult(from_, to_, 'damaged', str(e), found.size)
+    if expected is not None:
+        detail = expected.differences(found)
+        if detail is not None:
+            return ScrubResult(from_, to_, 'damaged', detail, found.size)
+    elif index_path is not None:
+        found.save(index_path)
+        return ScrubResult(from_, to_, 'indexed', None, found.size)
+    return ScrubResult(from_, to_, 'ok', None, found.size)
+
+
+def scrub(driver, workers=4, bucket=None):
+    """
+    Scrubs every edge of `driver', `workers' at a time, all of them
+    sharing `bucket'.  Yields a ScrubResult per edge as it is done.
+    """
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(
+                partial(scrub_edge, driver, bucket=bucket),
+                sorted(driver.get_edges())):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def damage(edges, damaged):
+    """
+    Maps each of the `damaged' edges to the nodes whose restore chains can
+    pass through it, given all the `edges' of the pool.  Also returns the
+    nodes left without any chain from FULL over undamaged edges.
+    """
+    graph = graph_of(edges)
+    damaged = set(damaged)
+
+    def _reachable(roots, usable):
+        seen = set(roots)
+        pending = list(roots)
+        while pending:
+            node = pending.pop()
+            for child in graph.children(node):
+                if child not in seen and usable((node, child)):
+                    seen.add(child)
+                    pending.append(child)
+        return seen
+
+    affected = dict(
+        (edge, _reachable([edge[1]], lambda _: True)) for edge in damaged
+    )
+    restorable = _reachable(
+        [DirectedGraph.ROOT_NODE],
+        lambda edge: edge not in damaged
+    )
+    lost = set()
+    for nodes in affected.values():
+        lost.update(nodes - restorable)
+    return affected, lost
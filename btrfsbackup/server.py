@@ -2,9 +2,35 @@
 from __future__ import absolute_import
 
 import os
+import sys
+import fcntl
+import struct
+import hashlib
+import time
+import threading
+import traceback
 from functools import partial
+from itertools import islice
+from collections import namedtuple
+from contextlib import contextmanager
 
-from .reliable_rw import transactional_write, yield_input
+from .reliable_rw import (
+    FileExists, available_hash_modes, can_splice_input, claimed_partial,
+    get_hash_mode, splice_input, transactional_write, yield_input_pieces,
+    yield_pieces, piece_size, DEFAULT_HASH_MODE
+)
+from .compression import (
+    CODECS, CompressedReader, CompressedWriter, available_codecs, get_codec
+)
+from .chunkstore import (
+    ManifestReader, ManifestWriter, read_manifest_size, receive_dedup
+)
+from .mux import Multiplexer
+from .objectstore import MultipartWriter, RangedReader
+from .scrub import PieceIndex, index_suffix
+from .throttle import admitted, throttled
+from .metrics import Metrics, disabled
+from . import fsutil
 from . import wire_pb2
 from . import common
 
@@ -13,7 +39,125 @@ def reliable_decode():
     pass
 
 
+# What the server knows about a stored edge: its size in bytes and when
+# it was stored, in seconds since the epoch.
+EdgeStat = namedtuple('EdgeStat', ['size', 'timestamp'])
+
+
+# An interrupted upload: `pieces' whole pieces ending at byte `offset' of
+# the partial file, and a sha256 `hasher' over them.
+PartialUpload = namedtuple(
+    'PartialUpload',
+    ['from_node', 'to_node', 'fullpath', 'codec', 'pieces', 'offset', 'hasher']
+)
+
+
+class GraphJournal(object):
+    """
+    An append-only log of the edges added to and removed from a pool.  The
+    first line holds the journal's random epoch, every other line is `+' or
+    `-', FROM and TO, tab separated.  A client that has seen the first
+    `generation' entries of an epoch only needs the entries after them.
+    """
+    # rewrite the journal once it has this many more entries than edges
+    compact_slack = 4096
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        self._inode = inode
+        self._offset = 0
+        self.epoch = None
+        self.entries = []
+        self.edges = set()
+
+    def _load(self, fh):
+        """Reads whatever was appended to the journal since the last call."""
+        st = os.fstat(fh.fileno())
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._reset(st.st_ino)
+        fh.seek(self._offset)
+        for line in iter(fh.readline, ''):
+            if not line.endswith('\n'):
+                break
+            self._offset += len(line)
+            if self.epoch is None:
+                self.epoch = line[:-1].decode('hex')
+                continue
+            op, from_, to_ = line[:-1].split('\t')
+            self.entries.append((op, (from_, to_)))
+            if op == '+':
+                self.edges.add((from_, to_))
+            else:
+                self.edges.discard((from_, to_))
+
+    def _open_locked(self):
+        while True:
+            fh = open(self._path, 'a+')
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            # someone may have compacted the journal while we waited
+            if os.fstat(fh.fileno()).st_ino == os.stat(self._path).st_ino:
+                return fh
+            fh.close()
+
+    def _write(self, fh, lines):
+        fh.seek(0, os.SEEK_END)
+        fh.write(''.join(lines))
+        fh.flush()
+        self._load(fh)
+
+    def _compact(self, edges):
+        tmp_path = '%s.tmp' % self._path
+        with open(tmp_path, 'w') as fh:
+            fh.write('%s\n' % os.urandom(16).encode('hex'))
+            for from_, to_ in sorted(edges):
+                fh.write('+\t%s\t%s\n' % (from_, to_))
+        os.rename(tmp_path, self._path)
+
+    def sync(self, edges, epoch, generation):
+        """
+        Records how the pool's `edges' differ from the journal.  Returns
+        (epoch, generation, changes), where `changes' are the (op, edge)
+        entries after `generation' of `epoch', or None if the caller has
+        to be sent all edges.
+        """
+        edges = set(edges)
+        with self._lock:
+            fh = self._open_locked()
+            try:
+                self._load(fh)
+                if len(self.entries) > 2 * len(edges) + self.compact_slack:
+                    self._compact(edges)
+                    fh.close()
+                    fh = self._open_locked()
+                    self._load(fh)
+                if self.epoch is None:
+                    self._write(fh, [
+                        '%s\n' % os.urandom(16).encode('hex')
+                    ])
+                self._write(fh, [
+                    '%s\t%s\t%s\n' % (op, from_, to_)
+                    for op, added in [('-', self.edges - edges),
+                                      ('+', edges - self.edges)]
+                    for from_, to_ in sorted(added)
+                ])
+                changes = None
+                if epoch == self.epoch and generation <= len(self.entries):
+                    changes = self.entries[generation:]
+                return self.epoch, len(self.entries), changes
+            finally:
+                fh.close()
+
+
 class StorageDriver(object):
+    # whether open_file sinks take the chunks of dedup streams
+    dedup = False
+    # whether to keep a PieceIndex of every edge received
+    index_pieces = False
+
     def get_edges(self):
         raise NotImplementedError
         return [("from", "to")]
@@ -22,59 +166,885 @@ class StorageDriver(object):
         raise NotImplementedError
         return "%(from)s->%(to)s" % {'from': from_, 'to': to_}
 
-    def open_file(self, from_, to_):
+    def open_file(self, from_, to_, resume=None, size_hint=None):
         raise NotImplementedError
         return open(os.path.devnull, 'w')
 
+    def open_edge(self, from_, to_):
+        raise NotImplementedError
+        return open(os.path.devnull, 'r')
+
+    def get_edge_stat(self, from_, to_):
+        return None
+
+    def get_edge_size(self, from_, to_):
+        stat = self.get_edge_stat(from_, to_)
+        return None if stat is None else stat.size
+
+    def index_path(self, from_, to_):
+        """Where the PieceIndex of a stored edge goes, or None."""
+        return None
+
+    def find_fullpath(self, from_, to_):
+        """The local file of a stored edge, or None."""
+        return None
+
+    def supported_codecs(self):
+        return available_codecs()
+
+    def get_partials(self):
+        return []
+
+    def load_partial(self, upload):
+        """
+        The PartialUpload `upload', as listed by get_partials, with the
+        sha256 over its pieces to carry on with.
+        """
+        raise NotImplementedError
+
+    def discard_partials(self, keep=None):
+        pass
+
+    def get_graph_changes(self, epoch, generation):
+        """
+        Returns (epoch, generation, changes) like GraphJournal.sync, for
+        drivers that keep a journal of their edges.
+        """
+        return None, 0, None
+
 
 class StandardStorageDriver(StorageDriver):
-    def __init__(self, pool_root):
+    journal_filename = '.graph-journal'
+
+    def __init__(self, pool_root, compression=None, index_pieces=False):
         self._pool_root = pool_root
+        self._codec = get_codec(compression) if compression else None
+        self.index_pieces = index_pieces
+        self._journal = GraphJournal(
+            os.path.join(pool_root, self.journal_filename)
+        )
+
+    def filename_to_codec(self, filename):
+        return filename.rpartition('.btrfs')[2][1:] or None
 
     def filename_to_edge(self, filename):
-        return tuple(filename[0:-6].split('__', 1))
+        return tuple(filename.rpartition('.btrfs')[0].split('__', 1))
+
+    def is_edge_filename(self, filename):
+        base, sep, suffix = filename.rpartition('.btrfs')
+        if '__' not in base or not sep:
+            return False
+        return suffix in [''] + ['.%s' % codec.name for codec in CODECS]
 
     def get_edges(self):
-        filter_condition = lambda x: '__' in x and x.endswith('.btrfs')
         all_files = os.listdir(self._pool_root)
         return map(
             self.filename_to_edge,
-            filter(filter_condition, all_files)
+            filter(self.is_edge_filename, all_files)
         )
 
-    def generate_filename(self, from_, to_):
-        return "%s__%s.btrfs" % (from_, to_)
+    def generate_filename(self, from_, to_, codec=None):
+        filename = "%s__%s.btrfs" % (from_, to_)
+        if codec is not None:
+            filename = "%s.%s" % (filename, codec.name)
+        return filename
 
     def generate_fullpath(self, *args):
         return os.path.join(self._pool_root, self.generate_filename(*args))
 
+    def upload_path(self, from_, to_):
+        """Where open_file writes a new upload of the edge."""
+        return self.generate_fullpath(from_, to_, self._codec)
+
+    def find_fullpath(self, from_, to_):
+        for codec in [None] + CODECS:
+            fullpath = self.generate_fullpath(from_, to_, codec)
+            if os.path.exists(fullpath):
+                return fullpath
+        return None
+
+    def supported_codecs(self):
+        codecs = available_codecs()
+        if self._codec is not None:
+            codecs.remove(self._codec.name)
+            codecs.insert(0, self._codec.name)
+        return codecs
+
+    def _whole_pieces(self, fh, codec):
+        """Yields (piece, end offset) for each whole piece of a partial."""
+        header_size = struct.calcsize('!I')
+        while True:
+            if codec is None:
+                buf = fh.read(piece_size)
+                if len(buf) < piece_size:
+                    break
+            else:
+                header = fh.read(header_size)
+                if len(header) < header_size:
+                    break
+                length, = struct.unpack('!I', header)
+                payload = fh.read(length)
+                if not length or len(payload) < length:
+                    break
+                buf = codec.decompress(payload)
+            yield buf, fh.tell()
+
+    def _piece_ends(self, fh, codec):
+        """
+        Yields the end offset of each whole piece of a partial, going by
+        its size or its frame headers alone.
+        """
+        size = os.fstat(fh.fileno()).st_size
+        if codec is None:
+            for end in xrange(piece_size, size + 1, piece_size):
+                yield end
+            return
+        header_size = struct.calcsize('!I')
+        end = 0
+        while True:
+            fh.seek(end)
+            header = fh.read(header_size)
+            if len(header) < header_size:
+                break
+            length, = struct.unpack('!I', header)
+            if not length or end + header_size + length > size:
+                break
+            end += header_size + length
+            yield end
+
+    def _partial_filenames(self):
+        for filename in os.listdir(self._pool_root):
+            base, ext = os.path.splitext(filename)
+            if ext == '.tmp' and self.is_edge_filename(base):
+                yield base
+
+    def get_partials(self):
+        """
+        Lists the partial uploads in the pool without reading them; their
+        `hasher' is None until load_partial.  Uploads other sessions are
+        still writing are left out.
+        """
+        partials = []
+        for filename in self._partial_filenames():
+            fullpath = os.path.join(self._pool_root, filename)
+            codec_name = self.filename_to_codec(filename)
+            codec = get_codec(codec_name) if codec_name else None
+            pieces = offset = 0
+            with claimed_partial('%s.tmp' % fullpath) as fh:
+                if fh is None:
+                    continue
+                for offset in self._piece_ends(fh, codec):
+                    pieces += 1
+            if pieces:
+                from_, to_ = self.filename_to_edge(filename)
+                partials.append(PartialUpload(
+                    from_, to_, fullpath, codec, pieces, offset, None
+                ))
+        return partials
+
+    def load_partial(self, upload):
+        hasher = hashlib.sha256()
+        with open('%s.tmp' % upload.fullpath, 'rb') as fh:
+            pieces = islice(
+                self._whole_pieces(fh, upload.codec), upload.pieces
+            )
+            for buf, _ in pieces:
+                hasher.update(buf)
+        return upload._replace(hasher=hasher)
+
+    def discard_partials(self, keep=None):
+        # uploads other sessions are still writing hold their lock
+        for filename in self._partial_filenames():
+            fullpath = os.path.join(self._pool_root, filename)
+            if keep is not None and fullpath == keep.fullpath:
+                continue
+            with claimed_partial('%s.tmp' % fullpath) as fh:
+                if fh is not None:
+                    os.unlink('%s.tmp' % fullpath)
+
+    def get_graph_changes(self, epoch, generation):
+        return self._journal.sync(self.get_edges(), epoch, generation)
+
+    def get_edge_stat(self, from_, to_):
+        fullpath = self.find_fullpath(from_, to_)
+        if fullpath is None:
+            return None
+        st = os.stat(fullpath)
+        return EdgeStat(st.st_size, int(st.st_mtime))
+
+    def index_path(self, from_, to_):
+        fullpath = self.find_fullpath(from_, to_)
+        if fullpath is None:
+            return None
+        return fullpath + index_suffix
+
+    def edge_files(self, from_, to_):
+        """The files a stored edge takes up."""
+        fullpath = self.find_fullpath(from_, to_)
+        if fullpath is None:
+            return []
+        return [
+            path for path in (fullpath, fullpath + index_suffix)
+            if os.path.exists(path)
+        ]
+
+    def stored_size(self, from_, to_):
+        """The bytes deleting a stored edge frees."""
+        return sum(
+            os.path.getsize(path) for path in self.edge_files(from_, to_)
+        )
+
+    def delete_edges(self, edges):
+        """
+        Deletes `edges' and syncs the pool directory once, after all of
+        them.  Clients learn of the deletions through the journal.
+        """
+        for from_, to_ in edges:
+            for path in self.edge_files(from_, to_):
+                os.unlink(path)
+        fsutil.fsync_directory(self._pool_root)
+
+    @contextmanager
+    def open_edge(self, from_, to_):
+        """Opens the send stream of a stored edge, uncompressed."""
+        fullpath = self.find_fullpath(from_, to_)
+        if fullpath is None:
+            raise Exception("No such edge: %s -> %s" % (from_, to_))
+        codec_name = self.filename_to_codec(os.path.basename(fullpath))
+        with open(fullpath, 'rb') as fh:
+            if codec_name is None:
+                yield fh
+            else:
+                yield CompressedReader(fh, get_codec(codec_name))
+
+    @contextmanager
+    def open_file(self, from_, to_, resume=None, size_hint=None):
+        """
+        Opens a sink for the edge, or continues the PartialUpload `resume'.
+        An interrupted write is kept so it can be resumed later.  The
+        expected size of the stream, `size_hint', is preallocated.
+        """
+        if self.find_fullpath(from_, to_) is not None:
+            raise FileExists()
+        if resume is None:
+            codec = self._codec
+            filename = self.upload_path(from_, to_)
+            resume_at = None
+        else:
+            codec = resume.codec
+            filename = resume.fullpath
+            resume_at = resume.offset
+        if codec is not None:
+            size_hint = None
+        with transactional_write(filename, resume_at, True,
+                                 size_hint) as fh:
+            if codec is None:
+                yield fh
+            else:
+                sink = CompressedWriter(fh, codec)
+                yield sink
+                sink.close()
+
+
+class ChunkStorageDriver(StandardStorageDriver):
+    """
+    Keeps edges as manifests, `FROM__TO.btrfs.chunks', of content-defined
+    chunks held once each in a ChunkStore, which may be shared by several
+    pools.  Data the store already holds is neither written nor stored
+    again.  Edges stored whole are still read as before; uploads into the
+    chunk store cannot be resumed.
+    """
+    manifest_suffix = '.chunks'
+    dedup = True
+
+    def __init__(self, pool_root, store):
+        super(ChunkStorageDriver, self).__init__(pool_root)
+        self._store = store
+
+    def _manifest_path(self, from_, to_):
+        return self.generate_fullpath(from_, to_) + self.manifest_suffix
+
+    def is_edge_filename(self, filename):
+        if filename.endswith(self.manifest_suffix):
+            filename = filename[:-len(self.manifest_suffix)]
+        return super(ChunkStorageDriver, self).is_edge_filename(filename)
+
+    def find_fullpath(self, from_, to_):
+        fullpath = self._manifest_path(from_, to_)
+        if os.path.exists(fullpath):
+            return fullpath
+        return super(ChunkStorageDriver, self).find_fullpath(from_, to_)
+
+    def upload_path(self, from_, to_):
+        return self._manifest_path(from_, to_)
+
+    def get_partials(self):
+        return []
+
+    def get_edge_stat(self, from_, to_):
+        fullpath = self._manifest_path(from_, to_)
+        if not os.path.exists(fullpath):
+            return super(ChunkStorageDriver, self).get_edge_stat(from_, to_)
+        with open(fullpath, 'rb') as fh:
+            size = read_manifest_size(fh)
+        return EdgeStat(size, int(os.path.getmtime(fullpath)))
+
+    def index_path(self, from_, to_):
+        # chunks are verified as they are read
+        if os.path.exists(self._manifest_path(from_, to_)):
+            return None
+        return super(ChunkStorageDriver, self).index_path(from_, to_)
+
+    @contextmanager
+    def open_edge(self, from_, to_):
+        fullpath = self._manifest_path(from_, to_)
+        if not os.path.exists(fullpath):
+            parent = super(ChunkStorageDriver, self)
+            with parent.open_edge(from_, to_) as fh:
+                yield fh
+            return
+        with open(fullpath, 'rb') as fh:
+            yield ManifestReader(self._store, fh)
 
-def server_io(driver, instream, outstream):
+    @contextmanager
+    def open_file(self, from_, to_, resume=None, size_hint=None):
+        if resume is not None:
+            raise Exception("Uploads to a chunk store cannot be resumed")
+        if self.find_fullpath(from_, to_) is not None:
+            raise FileExists()
+        with transactional_write(self.upload_path(from_, to_)) as fh:
+            with self._store.session() as session:
+                sink = ManifestWriter(fh, session)
+                yield sink
+                sink.close()
+
+
+class ObjectStorageDriver(StorageDriver):
+    """
+    Keeps edges as objects, `FROM__TO.btrfs[.CODEC]', in an ObjectStore.
+    Each stored edge has an empty marker object as well,
+    `edges/FROM__TO.btrfs[.CODEC].SIZE', written once the edge's upload
+    completes and deleted before the edge is; the pool's edges are found
+    by listing those.  No object is ever read, changed and written back,
+    so any number of hosts can write to a pool.  Uploads into an object
+    store cannot be resumed.
+    """
+    marker_prefix = 'edges/'
+
+    def __init__(self, store, compression=None):
+        self._store = store
+        self._codec = get_codec(compression) if compression else None
+        self._lock = threading.Lock()
+        self._edges = None
+
+    def _marker(self, edge):
+        return '%s%s.%d' % (self.marker_prefix, self._key(edge), edge.size)
+
+    def _parse_marker(self, key, stat):
+        """The GraphEdge a marker object stands for, or None."""
+        filename, _, size = key[len(self.marker_prefix):].rpartition('.')
+        base, sep, suffix = filename.rpartition('.btrfs')
+        if not size.isdigit() or '__' not in base or not sep:
+            return None
+        edge = wire_pb2.Graph.GraphEdge()
+        edge.from_node, edge.to_node = base.split('__', 1)
+        edge.size = int(size)
+        edge.timestamp = stat.timestamp
+        if suffix:
+            edge.compression = suffix[1:]
+        return edge
+
+    def _load(self):
+        edges = {}
+        for key, stat in self._store.list(self.marker_prefix):
+            edge = self._parse_marker(key, stat)
+            if edge is not None:
+                edges[(edge.from_node, edge.to_node)] = edge
+        with self._lock:
+            self._edges = edges
+        return edges
+
+    def _manifest(self):
+        with self._lock:
+            edges = self._edges
+        return edges if edges is not None else self._load()
+
+    def generate_filename(self, from_, to_, codec=None):
+        filename = "%s__%s.btrfs" % (from_, to_)
+        if codec is not None:
+            filename = "%s.%s" % (filename, codec.name)
+        return filename
+
+    def _key(self, edge):
+        codec = None
+        if edge.HasField('compression'):
+            codec = get_codec(edge.compression)
+        return self.generate_filename(edge.from_node, edge.to_node, codec)
+
+    def get_edges(self):
+        # a new session: pick up what other servers changed
+        return self._load().keys()
+
+    def get_edge_stat(self, from_, to_):
+        edge = self._manifest().get((from_, to_))
+        if edge is None:
+            return None
+        return EdgeStat(edge.size, edge.timestamp)
+
+    def stored_size(self, from_, to_):
+        return self.get_edge_size(from_, to_) or 0
+
+    def supported_codecs(self):
+        codecs = available_codecs()
+        if self._codec is not None:
+            codecs.remove(self._codec.name)
+            codecs.insert(0, self._codec.name)
+        return codecs
+
+    def delete_edges(self, edges):
+        """
+        Deletes the markers of `edges', then their objects, so no marker
+        ever stands for an edge that is gone.
+        """
+        manifest = self._load()
+        for edge in edges:
+            if edge in manifest:
+                self._store.delete(self._marker(manifest[edge]))
+                self._store.delete(self._key(manifest[edge]))
+                with self._lock:
+                    self._edges.pop(edge, None)
+
+    @contextmanager
+    def open_edge(self, from_, to_):
+        """Opens the send stream of a stored edge, uncompressed."""
+        edge = self._manifest().get((from_, to_))
+        if edge is None:
+            raise Exception("No such edge: %s -> %s" % (from_, to_))
+        fh = RangedReader(self._store, self._key(edge), edge.size)
+        if edge.HasField('compression'):
+            fh = CompressedReader(fh, get_codec(edge.compression))
+        yield fh
+
+    @contextmanager
+    def open_file(self, from_, to_, resume=None, size_hint=None):
+        """
+        Opens a sink for the edge, which is uploaded in parts as it is
+        written and gets its marker once all of it is stored.
+        """
+        if resume is not None:
+            raise Exception("Uploads to an object store cannot be resumed")
+        if self.get_edge_stat(from_, to_) is not None:
+            raise FileExists()
+        key = self.generate_filename(from_, to_, self._codec)
+        writer = MultipartWriter(self._store, key, size_hint)
+        try:
+            if self._codec is None:
+                yield writer
+            else:
+                sink = CompressedWriter(writer, self._codec)
+                yield sink
+                sink.close()
+            writer.close()
+        except:
+            writer.abort()
+            raise
+        edge = wire_pb2.Graph.GraphEdge()
+        edge.from_node = from_
+        edge.to_node = to_
+        edge.size = writer.size
+        edge.timestamp = int(time.time())
+        if self._codec is not None:
+            edge.compression = self._codec.name
+        self._store.put(self._marker(edge), '')
+        with self._lock:
+            if self._edges is not None:
+                self._edges[(from_, to_)] = edge
+
+
+class CachedStorageDriver(StandardStorageDriver):
+    """
+    A StandardStorageDriver for long-running servers.  The pool's edges are
+    kept in memory: read from disk once, updated as uploads commit and kept
+    in step with outside changes through inotify, or without it by reading
+    the pool again whenever its directory changes.
+    """
+    _watched_events = (
+        fsutil.IN_CREATE | fsutil.IN_DELETE |
+        fsutil.IN_MOVED_FROM | fsutil.IN_MOVED_TO
+    )
+
+    def __init__(self, pool_root, **kwargs):
+        super(CachedStorageDriver, self).__init__(pool_root, **kwargs)
+        self._lock = threading.Lock()
+        self._edges = None
+        self._mtime = None
+        self._watching = False
+
+    def _watch(self):
+        inotify = fsutil.Inotify()
+        inotify.add_watch(self._pool_root, self._watched_events)
+
+        def _run():
+            while True:
+                for mask, name in inotify.read_events():
+                    self._apply_event(mask, name)
+        watcher = threading.Thread(target=_run)
+        watcher.daemon = True
+        watcher.start()
+        self._watching = True
+
+    def _apply_event(self, mask, name):
+        with self._lock:
+            if self._edges is None:
+                return
+            if mask & fsutil.IN_Q_OVERFLOW:
+                self._edges = None
+            elif self.is_edge_filename(name):
+                edge = self.filename_to_edge(name)
+                if mask & (fsutil.IN_CREATE | fsutil.IN_MOVED_TO):
+                    self._edges.add(edge)
+                else:
+                    self._edges.discard(edge)
+
+    def get_edges(self):
+        with self._lock:
+            if not self._watching and fsutil.inotify_available:
+                # watch before reading so no change can slip in between
+                self._watch()
+            mtime = os.stat(self._pool_root).st_mtime
+            stale = not self._watching and mtime != self._mtime
+            if self._edges is None or stale:
+                self._edges = set(
+                    super(CachedStorageDriver, self).get_edges()
+                )
+                self._mtime = mtime
+            return list(self._edges)
+
+    @contextmanager
+    def open_file(self, from_, to_, resume=None, size_hint=None):
+        parent = super(CachedStorageDriver, self)
+        with parent.open_file(from_, to_, resume, size_hint) as sink:
+            yield sink
+        with self._lock:
+            if self._edges is not None:
+                self._edges.add((from_, to_))
+
+
+class CachedChunkStorageDriver(CachedStorageDriver, ChunkStorageDriver):
+    """A ChunkStorageDriver for long-running servers; see the two."""
+
+
+def reachable_edges(edges, roots):
+    """
+    The edges on the paths from FULL to any of `roots', and the edges
+    leaving `roots'.
+    """
+    parents = {}
+    for from_, to_ in edges:
+        parents.setdefault(to_, []).append(from_)
+    wanted = set(roots)
+    pending = list(wanted)
+    while pending:
+        for parent in parents.get(pending.pop(), []):
+            if parent not in wanted:
+                wanted.add(parent)
+                pending.append(parent)
+    roots = set(roots)
+    return [
+        (from_, to_) for from_, to_ in edges
+        if to_ in wanted or from_ in roots
+    ]
+
+
+def send_chain(driver, request, outstream):
+    """Sends every edge of a RestoreRequest as a reliable stream, in order."""
+    codec = None
+    if request.HasField('compression'):
+        codec = get_codec(request.compression)
+    hash_mode = DEFAULT_HASH_MODE
+    if request.HasField('hash_mode'):
+        hash_mode = get_hash_mode(request.hash_mode)
+    for edge in request.chain:
+        if driver.get_edge_size(edge.from_node, edge.to_node) is None:
+            raise Exception(
+                "No such edge: %s -> %s" % (edge.from_node, edge.to_node)
+            )
+    for edge in request.chain:
+        with driver.open_edge(edge.from_node, edge.to_node) as fh:
+            for piece in yield_pieces(fh, codec=codec, hash_mode=hash_mode):
+                outstream.write(piece)
+    outstream.flush()
+
+
+def server_io(driver, instream, outstream, scheduler=None,
+              metrics=disabled):
+    """
+    Serves one client session.  Uploads wait for admission by the
+    UploadScheduler `scheduler', if any, which may also throttle them.
+    The time each stage takes is recorded in `metrics'.
+    """
     write_framed = partial(common.write_framed, '!I', outstream)
     read_framed = partial(common.read_framed, '!I', instream)
 
-    def _serialize_graph():
-        graph = wire_pb2.Graph()
-        for from_node, to_node in driver.get_edges():
-            edge = graph.edges.add()
+    def _add_edges(repeated, edges, sizes):
+        for from_node, to_node in edges:
+            edge = repeated.add()
             edge.from_node = from_node
             edge.to_node = to_node
+            if sizes:
+                stat = driver.get_edge_stat(from_node, to_node)
+                if stat is not None:
+                    edge.size = stat.size
+                    edge.timestamp = stat.timestamp
+
+    def _serialize_graph(request):
+        graph = wire_pb2.Graph()
+        graph.compression.extend(driver.supported_codecs())
+        graph.hash_modes.extend(available_hash_modes())
+        if driver.dedup:
+            graph.dedup = True
+        if request is None:
+            _add_edges(graph.edges, driver.get_edges(), False)
+        elif request.roots:
+            _add_edges(
+                graph.edges,
+                reachable_edges(driver.get_edges(), request.roots),
+                request.sizes
+            )
+        else:
+            epoch, generation, changes = driver.get_graph_changes(
+                request.epoch,
+                request.generation
+            )
+            if epoch is not None:
+                graph.epoch = epoch
+                graph.generation = generation
+            if changes is None:
+                _add_edges(graph.edges, driver.get_edges(), request.sizes)
+            else:
+                # only the last change to an edge matters
+                last_op = dict((edge, op) for op, edge in changes)
+                graph.delta = True
+                for op, repeated in [('+', graph.edges),
+                                     ('-', graph.removed_edges)]:
+                    _add_edges(repeated, [
+                        edge for edge, edge_op in last_op.items()
+                        if edge_op == op
+                    ], request.sizes and op == '+')
+        for upload in partials.values():
+            partial_upload = graph.partials.add()
+            partial_upload.from_node = upload.from_node
+            partial_upload.to_node = upload.to_node
+            partial_upload.pieces = upload.pieces
         return graph.SerializeToString()
 
-    # validate magic number
-    if instream.read(len(common.magic_number)) != common.magic_number:
+    # validate magic number; newer clients follow it with a request for
+    # only part of the graph, and restore sessions use their own
+    magic = common.read_exact(instream, len(common.magic_number))
+    if magic == common.magic_number:
+        request = None
+    elif magic in (common.sync_magic_number, common.restore_magic_number):
+        request = wire_pb2.GraphRequest()
+        request.ParseFromString(read_framed())
+    else:
         raise Exception("Invalid magic number")
+    restoring = magic == common.restore_magic_number
+
+    partials = {}
+    if not restoring:
+        partials = dict(
+            ((upload.from_node, upload.to_node), upload)
+            for upload in driver.get_partials()
+        )
 
     # send graph
-    write_framed(_serialize_graph())
+    with metrics.timer('graph_serialize'):
+        serialized = _serialize_graph(request)
+    metrics.count('graph_serialize', len(serialized))
+    write_framed(serialized)
     outstream.flush()
 
-    # what edge are we saving?
+    # which edges does the client want back?
+    if restoring:
+        restore_request = wire_pb2.RestoreRequest()
+        restore_request.ParseFromString(read_framed())
+        with metrics.timer('restore'):
+            send_chain(driver, restore_request, outstream)
+        return
+
+    # what edge are we saving?  A client that only wanted the graph hangs
+    # up here.
+    try:
+        serialized = read_framed()
+    except common.TruncatedRead:
+        return
     edge = wire_pb2.Graph.GraphEdge()
-    edge.ParseFromString(read_framed())
+    edge.ParseFromString(serialized)
+
+    # are we continuing an interrupted upload?  Only the partial the client
+    # asks for is read back, and only if its pieces are what the client's
+    # stream starts with; otherwise the client starts the edge over.
+    resume = None
+    if edge.resume_pieces:
+        resume = partials.get((edge.from_node, edge.to_node))
+        if resume is None or resume.pieces != edge.resume_pieces:
+            raise Exception("No partial upload to resume")
+        with metrics.timer('resume'):
+            resume = driver.load_partial(resume)
+        if edge.HasField('resume_digest'):
+            matches = resume.hasher.digest() == edge.resume_digest
+            write_framed('\x01' if matches else '\x00')
+            outstream.flush()
+            if not matches:
+                resume = None
+                edge.ParseFromString(read_framed())
+                if edge.resume_pieces:
+                    raise Exception("Partial upload was dropped")
+    # Only one upload is kept around per pool, any other partial is stale
+    # now; those other sessions are still writing are left alone.
+    driver.discard_partials(keep=resume)
 
-    # do the saving
-    filename = driver.generate_fullpath(edge.from_node, edge.to_node)
-    with transactional_write(filename) as sink:
-        for piece in yield_input(instream):
-            sink.write(piece)
+    codec = None
+    if edge.HasField('compression'):
+        codec = get_codec(edge.compression)
+    hash_mode = DEFAULT_HASH_MODE
+    if edge.HasField('hash_mode'):
+        hash_mode = get_hash_mode(edge.hash_mode)
+
+    if edge.dedup and not driver.dedup:
+        raise Exception("Pool does not take dedup streams")
+
+    # do the saving, reusing the wire encoding if it matches the stored one
+    # and moving raw streams to disk without copying them where we can
+    size_hint = None
+    if edge.HasField('size') and resume is None:
+        size_hint = edge.size
+    # the pieces before a resumed upload's are indexed by the next scrub
+    index = None
+    if driver.index_pieces and resume is None and not edge.dedup:
+        index = PieceIndex()
+    started = time.time()
+    with admitted(scheduler) as bucket:
+        metrics.add_time('admission', time.time() - started)
+        upload = driver.open_file(
+            edge.from_node, edge.to_node, resume, size_hint
+        )
+        with upload as sink:
+            with metrics.timer('receive'):
+                _receive(sink, instream, outstream, edge, codec, hash_mode,
+                         resume, bucket, index, metrics)
+            received = time.time()
+        index_path = driver.index_path(edge.from_node, edge.to_node)
+        if index is not None and index_path is not None:
+            index.save(index_path)
+        metrics.add_time('commit', time.time() - received)
+
+
+def _receive(sink, instream, outstream, edge, codec, hash_mode, resume,
+             bucket, index, metrics):
+    first_index, hasher = 0, None
+    if resume is not None:
+        first_index, hasher = resume.pieces, resume.hasher
+
+    def _size((piece, _)):
+        metrics.count('receive', len(piece))
+        return len(piece)
+
+    if edge.dedup:
+        # one piece at a time: the client holds back the next pieces
+        # until we answer the query in this one
+        pieces = yield_input_pieces(
+            instream,
+            codec,
+            workers=1,
+            hash_mode=hash_mode,
+            metrics=metrics
+        )
+        receive_dedup(throttled(pieces, bucket, _size), sink, outstream)
+        return
+    if (codec is None and bucket is None and
+            can_splice_input(instream, sink)):
+        start = sink.tell()
+        splice_input(
+            instream,
+            sink,
+            hash_mode=hash_mode,
+            first_index=first_index,
+            hasher=hasher,
+            on_piece=index.add if index is not None else None,
+            metrics=metrics
+        )
+        metrics.count('receive', sink.tell() - start)
+        return
+    store_codec = getattr(sink, 'codec', None)
+    keep_encoded = codec is not None and store_codec is codec
+    pieces = yield_input_pieces(
+        instream,
+        codec,
+        hash_mode=hash_mode,
+        first_index=first_index,
+        hasher=hasher,
+        metrics=metrics
+    )
+    for piece, payload in throttled(pieces, bucket, _size):
+        if index is not None:
+            index.add(piece)
+        with metrics.timer('disk'):
+            if keep_encoded:
+                sink.write_encoded(payload)
+            else:
+                sink.write(piece)
+
+
+def resolve_pool(pool_base, pool_name):
+    """Maps a pool name sent by a client to a directory below `pool_base'."""
+    pool_base = os.path.normpath(pool_base)
+    pool_root = os.path.normpath(os.path.join(pool_base, pool_name))
+    if not pool_root.startswith(os.path.join(pool_base, '')):
+        raise Exception("Pool outside of the pool base: %s" % pool_name)
+    return pool_root
+
+
+def _serve_channel(driver_for_pool, scheduler, reporter, channel):
+    status = 1
+    metrics = disabled
+    try:
+        pool_name = common.read_framed('!I', channel.reader)
+        if reporter is not None:
+            metrics = Metrics(role='server', pool=pool_name)
+        server_io(
+            driver_for_pool(pool_name),
+            channel.reader,
+            channel.writer,
+            scheduler,
+            metrics
+        )
+        status = 0
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        channel.close(status)
+        if metrics is not disabled:
+            reporter.report(metrics)
+
+
+def mux_server_io(driver_for_pool, instream, outstream, scheduler=None,
+                  reporter=None):
+    """
+    Serves every session a batch client opens over one transport, each on
+    its own thread.  A session starts with the framed name of its pool,
+    which `driver_for_pool' turns into a StorageDriver.  The metrics of
+    every session go to `reporter', if any.
+    """
+    mux = Multiplexer(instream, outstream)
+    mux.start_server()
+    sessions = []
+    for channel in mux.accept():
+        session = threading.Thread(
+            target=_serve_channel,
+            args=(driver_for_pool, scheduler, reporter, channel)
+        )
+        session.start()
+        sessions.append(session)
+    for session in sessions:
+        session.join()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""
+A queue of edges waiting to be uploaded, kept on local disk so that
+`btrfs send' runs at disk speed whatever the link to the server does.
+
+Each edge is a file SPOOL_DIR/NNNNNNNN.edge:
+    a 32 bit integer, network byte order: the size of the GraphEdge
+    the GraphEdge to send
+    the reliable stream of the edge, just as it goes on the wire
+Edges are uploaded in the order of their numbers, each in a session of its
+own.  SPOOL_DIR/graph holds the server's graph as of the last upload.
+"""
+import os
+from contextlib import contextmanager
+
+from .reliable_rw import transactional_write
+from . import wire_pb2
+from . import common
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def read_edge(fh):
+    """Reads the GraphEdge at the start of a spooled edge."""
+    edge = wire_pb2.Graph.GraphEdge()
+    edge.ParseFromString(common.read_framed('!I', fh))
+    return edge
+
+
+class _BudgetedWriter(object):
+    def __init__(self, fh, room):
+        self._fh = fh
+        self._room = room
+
+    def write(self, buf):
+        if self._room is not None:
+            self._room -= len(buf)
+            if self._room < 0:
+                raise SpoolFull("Spool is over its budget")
+        self._fh.write(buf)
+
+
+class Spool(object):
+    """
+    The edges spooled in `spool_dir', which hold at most `budget' bytes
+    in all, if given.
+    """
+    suffix = '.edge'
+    graph_filename = 'graph'
+
+    def __init__(self, spool_dir, budget=None):
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self._spool_dir = spool_dir
+        self.budget = budget
+        self.graph_path = os.path.join(spool_dir, self.graph_filename)
+
+    def _paths(self):
+        return sorted(
+            os.path.join(self._spool_dir, filename)
+            for filename in os.listdir(self._spool_dir)
+            if filename.endswith(self.suffix)
+        )
+
+    def queued(self):
+        """Yields (path, GraphEdge) of every spooled edge, oldest first."""
+        for path in self._paths():
+            with open(path, 'rb') as fh:
+                yield path, read_edge(fh)
+
+    def used(self):
+        return sum(os.path.getsize(path) for path in self._paths())
+
+    def near_full(self, size=None):
+        """
+        Whether spooling `size' more bytes, by default as many as the newest
+        spooled edge holds, would take the spool over its budget.  An empty
+        spool never is.
+        """
+        paths = self._paths()
+        if self.budget is None or not paths:
+            return False
+        if size is None:
+            size = os.path.getsize(paths[-1])
+        return self.used() + size > self.budget
+
+    def with_queued(self, graph):
+        """
+        A copy of the wire_pb2.Graph `graph' with the spooled edges added,
+        which picking the parent of a new snapshot can go by while the
+        server is out of reach.
+        """
+        spooled = wire_pb2.Graph()
+        spooled.CopyFrom(graph)
+        # a partial upload is only resumed by talking to the server
+        spooled.ClearField('partials')
+        for _, edge in self.queued():
+            spooled.edges.add().CopyFrom(edge)
+        return spooled
+
+    @contextmanager
+    def add(self, edge):
+        """
+        Yields a sink for the stream of the GraphEdge `edge', which is
+        queued when the block ends.  Raises SpoolFull, and drops what was
+        written, once the spool would go over its budget.
+        """
+        paths = self._paths()
+        number = 0
+        if paths:
+            number = int(os.path.basename(paths[-1])[:-len(self.suffix)]) + 1
+        path = os.path.join(self._spool_dir, '%08d%s' % (number, self.suffix))
+        room = None
+        if self.budget is not None:
+            room = self.budget - self.used()
+        with transactional_write(path) as fh:
+            sink = _BudgetedWriter(fh, room)
+            common.write_framed('!I', sink, edge.SerializeToString())
+            yield sink
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+"""
+Rate limiting for uploads: token buckets that any number of threads can
+share, rates that follow the time of day, and a scheduler admitting a
+bounded number of uploads at once across every server process.
+
+Rates are bytes per second, with an optional K, M or G suffix (powers of
+1024).  A schedule is a comma separated list of `RATE' or
+`HH:MM-HH:MM=RATE'; the first entry covering the time of day applies, a
+range ending before it starts runs past midnight, and no entry or a rate
+of 0 means unlimited:
+
+    08:00-18:00=2M,18:00-08:00=50M
+"""
+import os
+import re
+import time
+import fcntl
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+
+_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+_entry = re.compile(
+    r'^(?:(\d\d?):(\d\d)-(\d\d?):(\d\d)=)?(\d+(?:\.\d+)?)([KMG]?)$'
+)
+
+
+def parse_rate(text):
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)$', text.strip().upper())
+    if match is None:
+        raise ValueError("Invalid rate: %s" % text)
+    return int(float(match.group(1)) * _units[match.group(2)])
+
+
+class RateSchedule(object):
+    """The rate that applies at each time of day."""
+    def __init__(self, text):
+        self._entries = []
+        for entry in text.split(','):
+            match = _entry.match(entry.strip().upper())
+            if match is None:
+                raise ValueError("Invalid schedule entry: %s" % entry)
+            start_h, start_m, end_h, end_m, rate, unit = match.groups()
+            span = None
+            if start_h is not None:
+                span = (
+                    int(start_h) * 60 + int(start_m),
+                    int(end_h) * 60 + int(end_m)
+                )
+            self._entries.append(
+                (span, int(float(rate) * _units[unit]))
+            )
+
+    def rate_at(self, when):
+        minute = when.hour * 60 + when.minute
+        for span, rate in self._entries:
+            if span is None:
+                return rate
+            start, end = span
+            if start <= end and start <= minute < end:
+                return rate
+            if start > end and (minute >= start or minute < end):
+                return rate
+        return 0
+
+
+class TokenBucket(object):
+    """
+    Lets through `rate' bytes per second on average, and bursts of up to a
+    second's worth.  Callers that overdraw it sleep off their debt outside
+    the lock, so threads sharing a bucket take turns.
+    """
+    def __init__(self, rate):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = rate
+        self._stamp = time.time()
+
+    def rate(self):
+        return self._rate
+
+    def consume(self, count):
+        with self._lock:
+            now = time.time()
+            rate = self.rate()
+            if not rate:
+                self._tokens, self._stamp = 0, now
+                return
+            self._tokens = min(
+                rate,
+                self._tokens + (now - self._stamp) * rate
+            )
+            self._stamp = now
+            self._tokens -= count
+            delay = -float(self._tokens) / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ScheduledBucket(TokenBucket):
+    """A TokenBucket whose rate follows a RateSchedule."""
+    def __init__(self, schedule):
+        super(ScheduledBucket, self).__init__(0)
+        self._schedule = schedule
+
+    def rate(self):
+        return self._schedule.rate_at(datetime.now())
+
+
+def throttled(iterable, bucket, size=len):
+    """Yields the items of `iterable' no faster than `bucket' allows."""
+    if bucket is None:
+        return iterable
+    return _throttled(iterable, bucket, size)
+
+
+def _throttled(iterable, bucket, size):
+    for item in iterable:
+        bucket.consume(size(item))
+        yield item
+
+
+class UploadScheduler(object):
+    """
+    Admits at most `max_uploads' uploads at once across every process
+    sharing `slot_dir', each holding a lock on one of its slot files for
+    as long as it runs, and one on the slot's status file, which is what
+    uploads are counted by; counting never touches the slot files, so it
+    cannot hold up an upload looking for a slot.  With a `disk_rate',
+    every upload admitted gets an even share of it.
+    """
+    poll_interval = 1.0
+
+    def __init__(self, slot_dir, max_uploads, disk_rate=None):
+        if not os.path.isdir(slot_dir):
+            os.makedirs(slot_dir)
+        self._slot_dir = slot_dir
+        self.max_uploads = max_uploads
+        self.disk_rate = disk_rate
+
+    def _open(self, index, suffix=''):
+        return open(
+            os.path.join(self._slot_dir, 'slot.%d%s' % (index, suffix)), 'a'
+        )
+
+    def _try_slot(self, index):
+        fh = self._open(index)
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fh.close()
+            return None
+        # only counting holds this one, and never for long
+        status = self._open(index, '.active')
+        fcntl.flock(status, fcntl.LOCK_EX)
+        return fh, status
+
+    def _acquire(self):
+        while True:
+            for index in xrange(self.max_uploads):
+                slot = self._try_slot(index)
+                if slot is not None:
+                    return slot
+            time.sleep(self.poll_interval)
+
+    def active(self):
+        """The number of uploads admitted right now."""
+        count = 0
+        for index in xrange(self.max_uploads):
+            with self._open(index, '.active') as status:
+                try:
+                    fcntl.flock(status, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except IOError:
+                    count += 1
+        return count
+
+    @contextmanager
+    def session(self):
+        """
+        Waits for a slot, then yields the bucket to throttle the upload
+        with, or None.
+        """
+        slot, status = self._acquire()
+        try:
+            yield FairShareBucket(self) if self.disk_rate else None
+        finally:
+            status.close()
+            slot.close()
+
+
+class FairShareBucket(TokenBucket):
+    """A TokenBucket with an even share of a scheduler's disk rate."""
+    recount_interval = 1.0
+
+    def __init__(self, scheduler):
+        super(FairShareBucket, self).__init__(0)
+        self._scheduler = scheduler
+        self._share = None
+        self._counted = 0
+
+    def rate(self):
+        now = time.time()
+        if self._share is None or now - self._counted > self.recount_interval:
+            active = max(1, self._scheduler.active())
+            self._share = self._scheduler.disk_rate // active
+            self._counted = now
+        return self._share
+
+
+@contextmanager
+def admitted(scheduler):
+    """UploadScheduler.session, or no limits without a `scheduler'."""
+    if scheduler is None:
+        yield None
+        return
+    with scheduler.session() as bucket:
+        yield bucket
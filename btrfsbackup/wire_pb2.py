@@ -11,7 +11,7 @@ from google.protobuf import descriptor_pb2
 DESCRIPTOR = descriptor.FileDescriptor(
   name='wire.proto',
   package='',
-  serialized_pb='\n\nwire.proto\"Y\n\x05Graph\x12\x1f\n\x05\x65\x64ges\x18\x01 \x03(\x0b\x32\x10.Graph.GraphEdge\x1a/\n\tGraphEdge\x12\x11\n\tfrom_node\x18\x01 \x02(\t\x12\x0f\n\x07to_node\x18\x02 \x02(\t')
+  serialized_pb='\n\nwire.proto\"\xf0\x03\n\x05Graph\x12\x1f\n\x05\x65\x64ges\x18\x01 \x03(\x0b\x32\x10.Graph.GraphEdge\x12\x13\n\x0b\x63ompression\x18\x02 \x03(\t\x12\x12\n\nhash_modes\x18\x03 \x03(\t\x12&\n\x08partials\x18\x04 \x03(\x0b\x32\x14.Graph.PartialUpload\x12\r\n\x05\x65poch\x18\x05 \x01(\x0c\x12\x12\n\ngeneration\x18\x06 \x01(\x04\x12\r\n\x05\x64\x65lta\x18\x07 \x01(\x08\x12\'\n\rremoved_edges\x18\x08 \x03(\x0b\x32\x10.Graph.GraphEdge\x12\r\n\x05\x64\x65\x64up\x18\t \x01(\x08\x1a\xb5\x01\n\tGraphEdge\x12\x11\n\tfrom_node\x18\x01 \x02(\t\x12\x0f\n\x07to_node\x18\x02 \x02(\t\x12\x13\n\x0b\x63ompression\x18\x03 \x01(\t\x12\x11\n\thash_mode\x18\x04 \x01(\t\x12\x15\n\rresume_pieces\x18\x05 \x01(\x04\x12\x0c\n\x04size\x18\x06 \x01(\x04\x12\x11\n\ttimestamp\x18\x07 \x01(\x04\x12\r\n\x05\x64\x65\x64up\x18\x08 \x01(\x08\x12\x15\n\rresume_digest\x18\t \x01(\x0c\x1aS\n\rPartialUpload\x12\x11\n\tfrom_node\x18\x01 \x02(\t\x12\x0f\n\x07to_node\x18\x02 \x02(\t\x12\x0e\n\x06pieces\x18\x03 \x02(\x04\x12\x0e\n\x06\x64igest\x18\x04 \x01(\x0c\"O\n\x0cGraphRequest\x12\r\n\x05\x65poch\x18\x01 \x01(\x0c\x12\x12\n\ngeneration\x18\x02 \x01(\x04\x12\r\n\x05roots\x18\x03 \x03(\t\x12\r\n\x05sizes\x18\x04 \x01(\x08\"Y\n\x0eRestoreRequest\x12\x1f\n\x05\x63hain\x18\x01 \x03(\x0b\x32\x10.Graph.GraphEdge\x12\x13\n\x0b\x63ompression\x18\x02 \x01(\t\x12\x11\n\thash_mode\x18\x03 \x01(\t')
 
 
 
@@ -37,6 +37,103 @@ _GRAPH_GRAPHEDGE = descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    descriptor.FieldDescriptor(
+      name='compression', full_name='Graph.GraphEdge.compression', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=unicode("", "utf-8"),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='hash_mode', full_name='Graph.GraphEdge.hash_mode', index=3,
+      number=4, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=unicode("", "utf-8"),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='resume_pieces', full_name='Graph.GraphEdge.resume_pieces', index=4,
+      number=5, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='size', full_name='Graph.GraphEdge.size', index=5,
+      number=6, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='timestamp', full_name='Graph.GraphEdge.timestamp', index=6,
+      number=7, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='dedup', full_name='Graph.GraphEdge.dedup', index=7,
+      number=8, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='resume_digest', full_name='Graph.GraphEdge.resume_digest', index=8,
+      number=9, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value="",
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  extension_ranges=[],
+  serialized_start=245,
+  serialized_end=426,
+)
+
+_GRAPH_PARTIALUPLOAD = descriptor.Descriptor(
+  name='PartialUpload',
+  full_name='Graph.PartialUpload',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    descriptor.FieldDescriptor(
+      name='from_node', full_name='Graph.PartialUpload.from_node', index=0,
+      number=1, type=9, cpp_type=9, label=2,
+      has_default_value=False, default_value=unicode("", "utf-8"),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='to_node', full_name='Graph.PartialUpload.to_node', index=1,
+      number=2, type=9, cpp_type=9, label=2,
+      has_default_value=False, default_value=unicode("", "utf-8"),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='pieces', full_name='Graph.PartialUpload.pieces', index=2,
+      number=3, type=4, cpp_type=4, label=2,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='digest', full_name='Graph.PartialUpload.digest', index=3,
+      number=4, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value="",
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -46,8 +143,8 @@ _GRAPH_GRAPHEDGE = descriptor.Descriptor(
   options=None,
   is_extendable=False,
   extension_ranges=[],
-  serialized_start=56,
-  serialized_end=103,
+  serialized_start=428,
+  serialized_end=511,
 )
 
 _GRAPH = descriptor.Descriptor(
@@ -64,22 +161,173 @@ _GRAPH = descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    descriptor.FieldDescriptor(
+      name='compression', full_name='Graph.compression', index=1,
+      number=2, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='hash_modes', full_name='Graph.hash_modes', index=2,
+      number=3, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='partials', full_name='Graph.partials', index=3,
+      number=4, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='epoch', full_name='Graph.epoch', index=4,
+      number=5, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value="",
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='generation', full_name='Graph.generation', index=5,
+      number=6, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='delta', full_name='Graph.delta', index=6,
+      number=7, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='removed_edges', full_name='Graph.removed_edges', index=7,
+      number=8, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='dedup', full_name='Graph.dedup', index=8,
+      number=9, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[_GRAPH_GRAPHEDGE, _GRAPH_PARTIALUPLOAD, ],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  extension_ranges=[],
+  serialized_start=15,
+  serialized_end=511,
+)
+
+_GRAPHREQUEST = descriptor.Descriptor(
+  name='GraphRequest',
+  full_name='GraphRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    descriptor.FieldDescriptor(
+      name='epoch', full_name='GraphRequest.epoch', index=0,
+      number=1, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value="",
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='generation', full_name='GraphRequest.generation', index=1,
+      number=2, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='roots', full_name='GraphRequest.roots', index=2,
+      number=3, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='sizes', full_name='GraphRequest.sizes', index=3,
+      number=4, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  extension_ranges=[],
+  serialized_start=513,
+  serialized_end=592,
+)
+
+_RESTOREREQUEST = descriptor.Descriptor(
+  name='RestoreRequest',
+  full_name='RestoreRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    descriptor.FieldDescriptor(
+      name='chain', full_name='RestoreRequest.chain', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='compression', full_name='RestoreRequest.compression', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=unicode("", "utf-8"),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='hash_mode', full_name='RestoreRequest.hash_mode', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=unicode("", "utf-8"),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
-  nested_types=[_GRAPH_GRAPHEDGE, ],
+  nested_types=[],
   enum_types=[
   ],
   options=None,
   is_extendable=False,
   extension_ranges=[],
-  serialized_start=14,
-  serialized_end=103,
+  serialized_start=594,
+  serialized_end=683,
 )
 
 _GRAPH_GRAPHEDGE.containing_type = _GRAPH;
+_GRAPH_PARTIALUPLOAD.containing_type = _GRAPH;
 _GRAPH.fields_by_name['edges'].message_type = _GRAPH_GRAPHEDGE
+_GRAPH.fields_by_name['partials'].message_type = _GRAPH_PARTIALUPLOAD
+_GRAPH.fields_by_name['removed_edges'].message_type = _GRAPH_GRAPHEDGE
+_RESTOREREQUEST.fields_by_name['chain'].message_type = _GRAPH_GRAPHEDGE
 DESCRIPTOR.message_types_by_name['Graph'] = _GRAPH
+DESCRIPTOR.message_types_by_name['GraphRequest'] = _GRAPHREQUEST
+DESCRIPTOR.message_types_by_name['RestoreRequest'] = _RESTOREREQUEST
 
 class Graph(message.Message):
   __metaclass__ = reflection.GeneratedProtocolMessageType
@@ -89,8 +337,25 @@ class Graph(message.Message):
     DESCRIPTOR = _GRAPH_GRAPHEDGE
     
     # @@protoc_insertion_point(class_scope:Graph.GraphEdge)
+  class PartialUpload(message.Message):
+    __metaclass__ = reflection.GeneratedProtocolMessageType
+    DESCRIPTOR = _GRAPH_PARTIALUPLOAD
+    
+    # @@protoc_insertion_point(class_scope:Graph.PartialUpload)
   DESCRIPTOR = _GRAPH
   
   # @@protoc_insertion_point(class_scope:Graph)
 
+class GraphRequest(message.Message):
+  __metaclass__ = reflection.GeneratedProtocolMessageType
+  DESCRIPTOR = _GRAPHREQUEST
+  
+  # @@protoc_insertion_point(class_scope:GraphRequest)
+
+class RestoreRequest(message.Message):
+  __metaclass__ = reflection.GeneratedProtocolMessageType
+  DESCRIPTOR = _RESTOREREQUEST
+  
+  # @@protoc_insertion_point(class_scope:RestoreRequest)
+
 # @@protoc_insertion_point(module_scope)